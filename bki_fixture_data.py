@@ -0,0 +1,739 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+import bki_functions as bf
+import bki_server_information as bsi
+
+
+# =============================================================================
+# Synthetic data
+# =============================================================================
+# Flavor columns of grades and cupping profiles
+flavor_columns = ["Syre","Krop","Aroma","Eftersmag","Robusta"]
+# Recipes used for BAR blends, see ti_data_preprocessing
+bar_recipes = ["10401005","10401207"]
+# Locations of available coffee and the share of the available contracts placed at each location
+location_shares = {
+    "SPOT": 0.15
+    ,"AARHUSHAVN": 0.2
+    ,"UDLAND": 0.1
+    ,"AFLOAT": 0.15
+    ,"SILOER": 0.25
+    ,"WAREHOUSE": 0.15}
+# Locations read from Probat, where quantities are available per delivery
+probat_locations = ["SILOER","WAREHOUSE"]
+origins = ["Brasilien","Colombia","Etiopien","Guatemala","Honduras","Indien","Indonesien","Kenya","Nicaragua"
+           ,"Peru","Rwanda","Uganda","Vietnam"]
+# Certification labels of items and the share of items with each label
+certification_labels = {"": 0.55, "FAIRTRADE": 0.1, "ØKO": 0.1, "FAIRTRADE ØKO": 0.05, "RFA": 0.1, "UTZ": 0.1}
+users = ["ALH","MBK","KHO","JSN","TBL"]
+# Date columns of each table, stored as ISO 8601 text so they compare correctly with bf.sql_since_filter
+date_columns = {
+    "gc_grades": ["Dato"]
+    ,"finished_goods_grades": ["Dato"]
+    ,"roaster_input": ["Dato"]
+    ,"test_roastings": ["Dato_r","Dato_rist","Dato_p"]
+    ,"Receptforslag_log": ["Dato"]}
+# Indexes on the columns the readers filter and join on
+table_indexes = {
+    "finished_goods_grades": ["Dato","Ordrenummer"]
+    ,"order_relationships": ["Ordre","Relateret ordre"]
+    ,"roaster_output": ["Ordrenummer"]
+    ,"roaster_input": ["Ordrenummer"]
+    ,"test_roastings": ["Dato_p"]
+    ,"available_quantities": ["Lokation"]
+    ,"recipe_costs": ["Receptnummer"]
+    ,"Receptforslag_log": ["Status"]}
+
+
+def round_grades(grades: np.ndarray) -> np.ndarray:
+    """Rounds grades to whole numbers on the 1-10 scale used in the tastings. Missing grades stay missing."""
+    return np.clip(np.round(grades), 1, 10)
+
+
+def choose_within_groups(rng, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Returns a random position within each group of rows given by the position of its first row and its size."""
+    return starts + np.floor(rng.random(len(starts)) * counts).astype(np.int64)
+
+
+def create_coffees(rng, number_of_contracts: int, start_date, end_date) -> dict:
+    """
+    Creates green coffee items, contracts of the items and deliveries of the contracts with true flavors,
+    and the tables with the contracts, the grades of the deliveries, the target cupping profiles and the
+    available quantities.
+    Returns a dictionary with the tables and the arrays used to create recipes and production.
+    """
+    total_days = (end_date - start_date).days
+    # Items with an origin, type, screen size and certification label
+    number_of_items = min(int(np.clip(number_of_contracts // 20, 10, 150)), number_of_contracts)
+    item_numbers = np.array([f"1020{number}" for number in rng.choice(np.arange(1000, 9999), number_of_items, replace=False)])
+    item_robusta = rng.random(number_of_items) < 0.15
+    item_origins = rng.choice(origins, number_of_items)
+    item_screensizes = rng.choice(["14/15","15/16","16/17","17/18","18+"], number_of_items)
+    item_labels = rng.choice(list(certification_labels), number_of_items, p=list(certification_labels.values()))
+    item_names = np.array([f"{origin} {'Robusta' if robusta else 'Arabica'} {screensize} {label}".strip()
+                           for origin, robusta, screensize, label in zip(item_origins, item_robusta, item_screensizes, item_labels)])
+    item_flavors = np.column_stack([rng.uniform(3, 8, (number_of_items, 4))
+                                    ,np.where(item_robusta, rng.uniform(4, 9, number_of_items), np.nan)])
+    item_flavors[item_robusta, 0] -= 1.5
+    item_costs = np.where(item_robusta, rng.uniform(12, 22, number_of_items), rng.uniform(20, 45, number_of_items))
+    item_forecasts = item_costs[:, None] * np.cumprod(1 + rng.normal(0, 0.03, (number_of_items, 3)), axis=1)
+
+    # Contracts, each item has at least one contract. Contracts are numbered by year in date order, e.g. 21-037.
+    contract_items = np.concatenate([np.arange(number_of_items), rng.integers(number_of_items, size=number_of_contracts - number_of_items)])
+    rng.shuffle(contract_items)
+    contract_days = np.sort(rng.integers(0, total_days, number_of_contracts))
+    contract_dates = start_date + pd.to_timedelta(contract_days, unit="D")
+    contract_sequence = pd.Series(contract_dates.year).groupby(contract_dates.year).cumcount().to_numpy() + 1
+    contract_numbers = np.array([f"{year % 100:02d}-{sequence:03d}" for year, sequence in zip(contract_dates.year, contract_sequence)])
+    contract_flavors = np.clip(item_flavors[contract_items] + rng.normal(0, 0.4, (number_of_contracts, 5)), 1, 10)
+    labels = pd.Series(item_labels[contract_items])
+    contracts = pd.DataFrame({
+        "Kontraktnummer": contract_numbers
+        ,"Metode": rng.choice(["Vasket","Ej vasket"], number_of_contracts)
+        ,"Sort": item_numbers[contract_items]
+        ,"Mærkningsordning": labels
+        ,"Differentiale": rng.normal(0.3, 0.2, number_of_contracts).round(2)
+        ,"Varenavn": item_names[contract_items]
+        ,"Kostpris": (item_costs[contract_items] * rng.normal(1, 0.05, number_of_contracts)).round(2)
+        ,"Standard Cost": item_costs[contract_items].round(2)
+        ,"Forecast Unit Cost +1M": item_forecasts[contract_items, 0].round(2)
+        ,"Forecast Unit Cost +2M": item_forecasts[contract_items, 1].round(2)
+        ,"Forecast Unit Cost +3M": item_forecasts[contract_items, 2].round(2)
+        ,"Fairtrade": labels.str.contains("FAIR").astype(int)
+        ,"Økologi": labels.str.contains("ØKO").astype(int)
+        ,"Rainforest": labels.str.contains("RFA|UTZ").astype(int)
+        ,"Konventionel": (labels == "").astype(int)
+        ,"Kaffetype": np.where(item_robusta[contract_items], "R", "A")})
+
+    # Deliveries, 1-4 per contract, arriving 1-5 months after the contract
+    delivery_counts = rng.integers(1, 5, number_of_contracts)
+    delivery_starts = np.cumsum(delivery_counts) - delivery_counts
+    delivery_contracts = np.repeat(np.arange(number_of_contracts), delivery_counts)
+    number_of_deliveries = len(delivery_contracts)
+    delivery_names = np.array([str(number) for number in 300000 + np.arange(number_of_deliveries)])
+    delivery_dates = contract_dates[delivery_contracts] + pd.to_timedelta(rng.integers(30, 150, number_of_deliveries), unit="D")
+    delivery_flavors = np.clip(contract_flavors[delivery_contracts] + rng.normal(0, 0.25, (number_of_deliveries, 5)), 1, 10)
+
+    # Grades of green coffee, 1-3 tastings per delivery. Some tastings are only registered on the contract.
+    grade_counts = rng.integers(1, 4, number_of_deliveries)
+    grade_deliveries = np.repeat(np.arange(number_of_deliveries), grade_counts)
+    number_of_grades = len(grade_deliveries)
+    gc_grades = pd.DataFrame({
+        "Dato": delivery_dates[grade_deliveries] + pd.to_timedelta(rng.integers(-20, 60, number_of_grades) * 24
+                                                                  + rng.integers(8, 16, number_of_grades), unit="h")
+        ,"Bruger": rng.choice(users, number_of_grades)
+        ,"Kontraktnummer": contract_numbers[delivery_contracts[grade_deliveries]]
+        ,"Modtagelse": np.where(rng.random(number_of_grades) < 0.1, None, delivery_names[grade_deliveries])
+        ,"Smagningstype": rng.choice(["Forsendelsesprøve","Ankomstprøve","Typeprøve"], number_of_grades)})
+    gc_grades[flavor_columns] = round_grades(delivery_flavors[grade_deliveries] + rng.normal(0, 0.5, (number_of_grades, 5)))
+
+    # Target cupping profiles from Navision for most contracts
+    profiled = rng.random(number_of_contracts) < 0.8
+    target_cupping_profiles = pd.DataFrame(round_grades(contract_flavors[profiled]), columns=flavor_columns)
+    target_cupping_profiles.insert(0, "Kontraktnummer", contract_numbers[profiled])
+    target_cupping_profiles = target_cupping_profiles[["Kontraktnummer","Syre","Aroma","Krop","Eftersmag","Robusta"]]
+
+    # Available quantities of some of the contracts from the last 18 months. Probat has quantities per delivery.
+    available = np.flatnonzero((contract_dates >= end_date - pd.Timedelta(days=540)) & (rng.random(number_of_contracts) < 0.6))
+    available_locations = rng.choice(list(location_shares), len(available), p=list(location_shares.values()))
+    probat = np.isin(available_locations, probat_locations)
+    probat_contracts = np.repeat(available[probat], delivery_counts[available[probat]])
+    probat_deliveries = np.concatenate([np.arange(start, start + count) for start, count
+                                        in zip(delivery_starts[available[probat]], delivery_counts[available[probat]])] or [[]]).astype(np.int64)
+    available_quantities = pd.concat([
+        pd.DataFrame({"Lokation": available_locations[~probat]
+                      ,"Kontraktnummer": contract_numbers[available[~probat]]
+                      ,"Modtagelse": None})
+        ,pd.DataFrame({"Lokation": np.repeat(available_locations[probat], delivery_counts[available[probat]])
+                       ,"Kontraktnummer": contract_numbers[probat_contracts]
+                       ,"Modtagelse": delivery_names[probat_deliveries]})
+        ], ignore_index=True)
+    available_quantities["Beholdning"] = rng.lognormal(8.5, 1.0, len(available_quantities)).round()
+
+    return {"tables": {"coffee_contracts": contracts
+                       ,"gc_grades": gc_grades
+                       ,"target_cupping_profiles": target_cupping_profiles
+                       ,"available_quantities": available_quantities}
+            ,"item_numbers": item_numbers
+            ,"item_flavors": item_flavors
+            ,"item_costs": item_costs
+            ,"item_forecasts": item_forecasts
+            ,"contract_items": contract_items
+            ,"contract_days": contract_days
+            ,"contract_numbers": contract_numbers
+            ,"delivery_counts": delivery_counts
+            ,"delivery_starts": delivery_starts
+            ,"delivery_names": delivery_names
+            ,"delivery_dates": delivery_dates
+            ,"delivery_flavors": delivery_flavors}
+
+
+def create_recipes(rng, coffees: dict, number_of_recipes: int) -> dict:
+    """
+    Creates recipes of 2-6 items with the recipe masterdata, cupping profiles and calculated costs.
+    Returns a dictionary with the tables and the arrays used to create production.
+    """
+    number_of_items = len(coffees["item_numbers"])
+    recipe_numbers = np.array(bar_recipes + [f"1040{number}" for number in rng.choice(np.arange(2000, 9999), number_of_recipes - len(bar_recipes), replace=False)])
+    recipe_sizes = rng.integers(2, 7, number_of_recipes).clip(max=number_of_items)
+    recipe_items = np.full((number_of_recipes, 6), -1)
+    recipe_weights = np.zeros((number_of_recipes, 6))
+    for recipe, size in enumerate(recipe_sizes):
+        recipe_items[recipe, :size] = rng.choice(number_of_items, size, replace=False)
+        recipe_weights[recipe, :size] = rng.dirichlet(np.full(size, 2.0))
+    recipe_colors = rng.integers(90, 135, number_of_recipes)
+    recipe_labels = rng.choice(["", "FAIRTRADE", "ØKO"], number_of_recipes, p=[0.8, 0.1, 0.1])
+
+    # Cupping profiles and costs are the weighted values of the items, robusta only for recipes with robusta items
+    components = np.maximum(recipe_items, 0)
+    flavors = coffees["item_flavors"][components]
+    robusta_weights = np.where(np.isnan(flavors[:, :, 4]), 0, recipe_weights)
+    recipe_flavors = np.column_stack([
+        np.einsum("rc,rcd->rd", recipe_weights, flavors[:, :, :4])
+        ,np.where(robusta_weights.sum(axis=1) > 0
+                  ,np.nansum(robusta_weights * flavors[:, :, 4], axis=1) / np.maximum(robusta_weights.sum(axis=1), 1e-9)
+                  ,np.nan)])
+    recipe_costs = np.einsum("rc,rc->r", recipe_weights, coffees["item_costs"][components])
+    recipe_forecasts = np.einsum("rc,rcm->rm", recipe_weights, coffees["item_forecasts"][components])
+
+    recipe_information = pd.DataFrame({"Receptnummer": recipe_numbers
+                                       ,"Farve sætpunkt": recipe_colors
+                                       ,"Mærkningsordning": recipe_labels})
+    recipe_cupping_profiles = pd.DataFrame({
+        "Receptnummer": recipe_numbers
+        ,"Beskrivelse": [f"Blend {number[-4:]}" for number in recipe_numbers]
+        ,"Mærkningsordning": recipe_labels
+        ,"Kostpris": (recipe_costs * 1.15).round(2)
+        ,"Kost uden tillæg, gas mm.": recipe_costs.round(2)
+        ,"Farve": recipe_colors})
+    recipe_cupping_profiles[["Syre","Krop","Aroma","Eftersmag","Robusta"]] = round_grades(recipe_flavors)
+    recipe_costs = pd.DataFrame({"Receptnummer": recipe_numbers
+                                 ,"Price": recipe_costs.round(4)
+                                 ,"Price +1M": recipe_forecasts[:, 0].round(4)
+                                 ,"Price +2M": recipe_forecasts[:, 1].round(4)
+                                 ,"Price +3M": recipe_forecasts[:, 2].round(4)})
+
+    return {"tables": {"recipe_information": recipe_information
+                       ,"recipe_cupping_profiles": recipe_cupping_profiles
+                       ,"recipe_costs": recipe_costs}
+            ,"recipe_numbers": recipe_numbers
+            ,"recipe_sizes": recipe_sizes
+            ,"recipe_items": recipe_items
+            ,"recipe_weights": recipe_weights
+            ,"recipe_colors": recipe_colors}
+
+
+def product_flavors(rng, flavors: np.ndarray, weights: np.ndarray, groups: np.ndarray, number_of_groups: int
+                    ,colors: np.ndarray) -> np.ndarray:
+    """
+    Returns the flavors of roasted products made from the input rows of green coffee flavors and weights, one row
+    per group. The flavors are the weighted flavors of the green coffees, darker roasts have more body and less acidity.
+    Robusta is the weighted robusta of the robusta coffees, and missing if a product has no robusta.
+    """
+    total_weights = np.bincount(groups, weights, number_of_groups)
+    result = np.column_stack([np.bincount(groups, weights * flavors[:, i], number_of_groups) for i in range(4)]
+                             ) / np.maximum(total_weights, 1e-9)[:, None]
+    robusta_weights = np.where(np.isnan(flavors[:, 4]), 0, weights)
+    robusta_total = np.bincount(groups, robusta_weights, number_of_groups)
+    robusta = np.bincount(groups, robusta_weights * np.nan_to_num(flavors[:, 4]), number_of_groups)
+    result = np.column_stack([result, np.where(robusta_total > 0, robusta / np.maximum(robusta_total, 1e-9), np.nan)])
+    roast = (colors - 110) / 10
+    result[:, 0] -= 0.3 * roast
+    result[:, 1] += 0.3 * roast
+    return result + rng.normal(0, 0.3, result.shape)
+
+
+def create_production(rng, coffees: dict, recipes: dict, start_date, end_date, orders_per_day: float) -> dict:
+    """
+    Creates finished goods orders with grades, the roasting orders they are made from, the roasted batches and
+    the green coffee used for each batch. Each component of a recipe is taken from the newest contracts of its item
+    before the roasting date, and from a random delivery of the contract.
+    Returns a dictionary with the tables.
+    """
+    total_days = (end_date - start_date).days
+    # Finished goods orders
+    number_of_orders = max(int(total_days * orders_per_day), 1)
+    order_dates = start_date + pd.to_timedelta(np.sort(rng.integers(0, total_days, number_of_orders)) * 24
+                                               + rng.integers(6, 22, number_of_orders), unit="h")
+    order_numbers = np.array([str(number) for number in 2000000 + np.arange(number_of_orders)])
+    order_recipes = rng.integers(len(recipes["recipe_numbers"]), size=number_of_orders)
+    # Roasting orders, 1-2 per finished goods order
+    roasting_counts = rng.integers(1, 3, number_of_orders)
+    roasting_orders = np.repeat(np.arange(number_of_orders), roasting_counts)
+    number_of_roastings = len(roasting_orders)
+    roasting_numbers = np.array([str(number) for number in 5000000 + np.arange(number_of_roastings)])
+    order_relationships = pd.DataFrame({"Ordre": order_numbers[roasting_orders]
+                                        ,"Relateret ordre": roasting_numbers})
+    # Batches, 1-3 per roasting order
+    batch_counts = rng.integers(1, 4, number_of_roastings)
+    batch_roastings = np.repeat(np.arange(number_of_roastings), batch_counts)
+    number_of_batches = len(batch_roastings)
+    batch_recipes = order_recipes[roasting_orders[batch_roastings]]
+    batch_weights = rng.uniform(400, 2000, number_of_batches).round(1)
+    roaster_output = pd.DataFrame({
+        "Produktionsordre id": 100000 + batch_roastings
+        ,"Batch id": 1000000 + np.arange(number_of_batches)
+        ,"Ordrenummer": roasting_numbers[batch_roastings]
+        ,"Receptnummer": recipes["recipe_numbers"][batch_recipes]
+        ,"Kilo": (batch_weights * 0.84).round(1)
+        ,"Silo": rng.choice([str(silo) for silo in range(401, 421)], number_of_batches)})
+
+    # Green coffee input, one row per recipe component of each batch
+    component_counts = recipes["recipe_sizes"][batch_recipes]
+    input_batches = np.repeat(np.arange(number_of_batches), component_counts)
+    number_of_inputs = len(input_batches)
+    positions = np.arange(number_of_inputs) - np.repeat(np.cumsum(component_counts) - component_counts, component_counts)
+    input_items = recipes["recipe_items"][batch_recipes[input_batches], positions]
+    input_dates = order_dates[roasting_orders[batch_roastings[input_batches]]].normalize() \
+                  - pd.to_timedelta(rng.integers(1, 4, number_of_inputs), unit="D")
+    input_days = (input_dates - start_date).days.to_numpy()
+    # Find the newest contract of the item before the roasting date, and use it or one of the two before it
+    day_range = total_days + 1000
+    contract_keys = coffees["contract_items"] * day_range + coffees["contract_days"]
+    contracts_by_key = np.argsort(contract_keys, kind="stable")
+    item_counts = np.bincount(coffees["contract_items"], minlength=len(coffees["item_numbers"]))
+    item_starts = np.cumsum(item_counts) - item_counts
+    newest = np.searchsorted(contract_keys[contracts_by_key], input_items * day_range + input_days, side="right") - 1
+    newest = np.maximum(newest - rng.integers(0, 3, number_of_inputs), item_starts[input_items])
+    input_contracts = contracts_by_key[newest]
+    input_deliveries = choose_within_groups(rng, coffees["delivery_starts"][input_contracts], coffees["delivery_counts"][input_contracts])
+    input_weights = (batch_weights[input_batches] * recipes["recipe_weights"][batch_recipes[input_batches], positions]
+                     * rng.uniform(0.97, 1.03, number_of_inputs)).round(1)
+    roaster_input = pd.DataFrame({
+        "Dato": input_dates
+        ,"Rister": rng.choice(["R1","R2","R3"], number_of_inputs)
+        ,"Produktionsordre id": 100000 + batch_roastings[input_batches]
+        ,"Batch id": 1000000 + input_batches
+        ,"Kilde silo": rng.choice([str(silo) for silo in range(201, 241)], number_of_inputs)
+        ,"Kontraktnummer": coffees["contract_numbers"][input_contracts]
+        ,"Modtagelse": coffees["delivery_names"][input_deliveries]
+        ,"Sortnummer i silo": coffees["item_numbers"][input_items]
+        ,"Kilo": input_weights
+        # Roasting order of the input, used by the reader to find the input of the graded products
+        ,"Ordrenummer": roasting_numbers[batch_roastings[input_batches]]})
+
+    # Grades of finished goods, 1-2 per order, given the day after production
+    flavors = product_flavors(rng, coffees["delivery_flavors"][input_deliveries], input_weights
+                              ,roasting_orders[batch_roastings[input_batches]], number_of_orders
+                              ,recipes["recipe_colors"][order_recipes])
+    grade_counts = rng.integers(1, 3, number_of_orders)
+    grade_orders = np.repeat(np.arange(number_of_orders), grade_counts)
+    number_of_grades = len(grade_orders)
+    finished_goods_grades = pd.DataFrame({
+        "Dato": order_dates[grade_orders] + pd.to_timedelta(rng.integers(12, 36, number_of_grades), unit="h")
+        ,"Bruger": rng.choice(users, number_of_grades)
+        ,"Ordrenummer": order_numbers[grade_orders]})
+    finished_goods_grades[flavor_columns] = round_grades(flavors[grade_orders] + rng.normal(0, 0.4, (number_of_grades, 5)))
+    finished_goods_grades["Status"] = rng.choice(["Godkendt","Afvist","Ej smagt"], number_of_grades, p=[0.93, 0.05, 0.02])
+    finished_goods_grades["Bemærkning"] = None
+    finished_goods_grades["Silo"] = rng.choice([str(silo) for silo in range(501, 531)], number_of_grades)
+
+    return {"finished_goods_grades": finished_goods_grades
+            ,"order_relationships": order_relationships
+            ,"roaster_output": roaster_output
+            ,"roaster_input": roaster_input}
+
+
+def create_test_roastings(rng, coffees: dict, recipes: dict, start_date, end_date, tastings_per_year: int = 50) -> pd.DataFrame():
+    """
+    Creates graded test roastings of 1-4 deliveries, with the columns of the query in bf.get_test_roastings.
+    """
+    total_days = (end_date - start_date).days
+    number_of_tastings = max(int(total_days / 365 * tastings_per_year), 1)
+    component_counts = rng.integers(1, 5, number_of_tastings)
+    tastings = np.repeat(np.arange(number_of_tastings), component_counts)
+    number_of_components = len(tastings)
+    tasting_dates = start_date + pd.to_timedelta(np.sort(rng.integers(0, total_days, number_of_tastings)), unit="D")
+    deliveries = rng.integers(len(coffees["delivery_names"]), size=number_of_components)
+    contracts = np.repeat(np.arange(len(coffees["delivery_counts"])), coffees["delivery_counts"])[deliveries]
+    weights = rng.integers(10, 50, number_of_components).astype(np.float64)
+    colors = rng.integers(95, 130, number_of_tastings)
+    flavors = product_flavors(rng, coffees["delivery_flavors"][deliveries], weights, tastings, number_of_tastings, colors)
+    df = pd.DataFrame({
+        "Dato_r": coffees["delivery_dates"][deliveries].normalize()
+        ,"Kontraktnummer": coffees["contract_numbers"][contracts]
+        ,"Modtagelse": coffees["delivery_names"][deliveries]
+        ,"Sort": coffees["item_numbers"][coffees["contract_items"][contracts]]
+        ,"Dato_rist": tasting_dates[tastings]
+        ,"Produktionsordre id": 6000000 + tastings
+        ,"Batch id": 7000000 + tastings
+        ,"Kilo_rist_input": weights
+        ,"Ordre_rist": 8000000 + tastings
+        ,"Receptnummer": recipes["recipe_numbers"][rng.integers(len(recipes["recipe_numbers"]), size=number_of_tastings)][tastings]
+        ,"Kilo_rist_output": np.bincount(tastings, weights)[tastings]
+        ,"Farve": colors[tastings].astype(np.float64)
+        ,"Dato_p": (tasting_dates + pd.Timedelta(days=1))[tastings]
+        ,"Ordre_p": 9000000 + tastings})
+    df[["Syre_p","Krop_p","Aroma_p","Eftersmag_p","Robusta_p"]] = round_grades(flavors[tastings])
+    df["Smagningsid"] = None
+    df["Faktorfelt"] = 1
+    df["Komponent id"] = 1
+    return df
+
+
+def create_requests(rng, coffees: dict, recipes: dict, number_of_requests: int, end_date) -> pd.DataFrame():
+    """
+    Creates waiting blend requests for cof.Receptforslag_log, with the cupping profile and color of a recipe as target.
+    Every third request has a locked component, an item with available coffee, aggregates the coffees to item level
+    and includes all locations and certifications.
+    """
+    profiles = recipes["tables"]["recipe_cupping_profiles"]
+    targets = profiles.iloc[rng.integers(len(profiles), size=number_of_requests)].reset_index(drop=True)
+    available_items = coffees["tables"]["coffee_contracts"].set_index("Kontraktnummer")["Sort"] \
+        .reindex(coffees["tables"]["available_quantities"]["Kontraktnummer"].unique()).to_numpy()
+    locked = (np.arange(number_of_requests) % 3 == 2) & (len(available_items) > 0)
+    df = pd.DataFrame({
+        "Id": np.arange(1, number_of_requests + 1)
+        ,"Dato": end_date
+        ,"Bruger_email": [f"{rng.choice(users).lower()}@bki.dk" for _ in range(number_of_requests)]
+        ,"Syre": targets["Syre"]
+        ,"Aroma": targets["Aroma"]
+        ,"Krop": targets["Krop"]
+        ,"Eftersmag": targets["Eftersmag"]
+        ,"Robusta": np.nan
+        ,"Farve": targets["Farve"]
+        ,"Receptnummer": targets["Receptnummer"]
+        ,"Aggreger_til_sortniveau": locked.astype(int)
+        ,"Låst_komponent": np.where(locked, rng.choice(available_items, number_of_requests) if len(available_items) else None, None)
+        ,"Låst_komponent_proportion": np.where(locked, 20, 0)
+        ,"Sammensætning": rng.choice(["Blandet","Ren Arabica"], number_of_requests, p=[0.7, 0.3])
+        ,"Inkluder_konventionel": 1
+        ,"Inkluder_fairtrade": rng.choice([0, 1], number_of_requests, p=[0.2, 0.8])
+        ,"Inkluder_økologi": rng.choice([0, 1], number_of_requests, p=[0.2, 0.8])
+        ,"Inkluder_rainforest": 1
+        ,"Lager_siloer": 1
+        ,"Lager_warehouse": 1
+        ,"Lager_havn": 1
+        ,"Lager_spot": rng.choice([0, 1], number_of_requests, p=[0.3, 0.7])
+        ,"Lager_afloat": rng.choice([0, 1], number_of_requests, p=[0.5, 0.5])
+        ,"Lager_udland": rng.choice([0, 1], number_of_requests, p=[0.5, 0.5])
+        ,"Minimum_lager": rng.choice([0, 500, 1000], number_of_requests)
+        ,"Status": 0
+        ,"Filsti": ""
+        ,"Filnavn": ""})
+    # Requests with a locked component include all coffees, so the locked item is available
+    df.loc[locked, ["Inkluder_fairtrade","Inkluder_økologi","Lager_spot","Lager_afloat","Lager_udland"]] = 1
+    df.loc[locked, "Minimum_lager"] = 0
+    df.loc[locked, "Sammensætning"] = "Blandet"
+    return df
+
+
+def create_fixture_tables(number_of_contracts: int = 3000, years: float = 5, orders_per_day: float = 20
+                          ,number_of_requests: int = 10, end_date=None, seed: int = 0) -> dict:
+    """
+    Returns a dictionary with a dataframe for each table of the fixture database, see generate_fixture_database.
+    """
+    rng = np.random.default_rng(seed)
+    end_date = pd.Timestamp(end_date if end_date is not None else pd.Timestamp.today()).normalize()
+    start_date = end_date - pd.Timedelta(days=int(365 * years))
+    coffees = create_coffees(rng, number_of_contracts, start_date, end_date)
+    recipes = create_recipes(rng, coffees, int(np.clip(number_of_contracts // 30, 10, 120)))
+    tables = {**coffees["tables"], **recipes["tables"]}
+    tables.update(create_production(rng, coffees, recipes, start_date, end_date, orders_per_day))
+    tables["test_roastings"] = create_test_roastings(rng, coffees, recipes, start_date, end_date)
+    tables["Receptforslag_log"] = create_requests(rng, coffees, recipes, number_of_requests, end_date)
+    return tables
+
+
+def write_fixture_database(path: str, tables: dict):
+    """
+    Writes the input tables into a new SQLite database in path, replacing any existing file, and creates the
+    log tables written to by the scripts. Dates are written as ISO 8601 text.
+    """
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    con = sqlite3.connect(path)
+    try:
+        # Write-ahead logging lets the worker processes read while the log tables are written
+        con.execute("PRAGMA journal_mode=WAL")
+        for name, df in tables.items():
+            df = df.copy()
+            for column in date_columns.get(name, []):
+                df[column] = pd.to_datetime(df[column]).dt.strftime("%Y-%m-%dT%H:%M:%S")
+            # Requests get an integer primary key, so new requests can be inserted without an id
+            keys = "Id" if name == "Receptforslag_log" else None
+            con.execute(pd.io.sql.get_schema(df, name, keys=keys, con=con))
+            df.to_sql(name, con, if_exists="append", index=False)
+            for column in table_indexes.get(name, []):
+                con.execute(f"CREATE INDEX [ix_{name}_{column}] ON [{name}] ([{column}])")
+        con.execute("""CREATE TABLE [Log] ([Id] INTEGER PRIMARY KEY
+                       ,[Dato] TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%S','now','localtime'))
+                       ,[Event] TEXT ,[Note] TEXT)""")
+        con.execute("""CREATE TABLE [Email_log] ([Id] INTEGER PRIMARY KEY
+                       ,[Dato] TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%S','now','localtime'))
+                       ,[Id_Org] INTEGER ,[Email_type] INTEGER ,[Email_til] TEXT ,[Email_emne] TEXT
+                       ,[Email_tekst] TEXT ,[Id_org_kildenummer] INTEGER)""")
+        con.commit()
+    finally:
+        con.close()
+
+
+def generate_fixture_database(path: str, number_of_contracts: int = 3000, years: float = 5, orders_per_day: float = 20
+                              ,number_of_requests: int = 10, end_date=None, seed: int = 0) -> dict:
+    """
+    Creates a SQLite database with synthetic data in the shape returned by the readers in bki_functions, for running
+    bki_flow_management and ti_data_preprocessing without access to the servers, see use_fixture_database.
+    Green coffees have true flavors, which the grades of deliveries, recipes, finished goods and test roastings are
+    derived from with noise, so a flavor model can be trained on the data.
+    Parameters
+    ----------
+    path : str
+        The database file. An existing file is replaced.
+    number_of_contracts : int, optional
+        The number of coffee contracts. Items and recipes are scaled with the contracts. The default is 3000.
+    years : float, optional
+        The number of years of contracts, production and tastings before end_date. The default is 5.
+    orders_per_day : float, optional
+        The number of graded finished goods orders per day. The default is 20.
+    number_of_requests : int, optional
+        The number of waiting blend requests in cof.Receptforslag_log. The default is 10.
+    end_date : optional
+        The date of the newest data. The default is None, which uses today.
+    seed : int, optional
+        Seed of the random numbers, the same seed and end_date give the same database. The default is 0.
+    Returns
+    -------
+    A dictionary with the number of rows in each table.
+    """
+    tables = create_fixture_tables(number_of_contracts, years, orders_per_day, number_of_requests, end_date, seed)
+    write_fixture_database(path, tables)
+    return {name: len(df) for name, df in tables.items()}
+
+
+# =============================================================================
+# Readers
+# =============================================================================
+# Implementations of the readers in bki_functions for the fixture database, by name of the reader
+readers = {}
+
+def fixture_reader(func):
+    """
+    Decorator setting the function as the implementation of the reader in bki_functions with the same name,
+    when the fixture database is used. The reader checks that the columns returned match its declaration.
+    """
+    readers[func.__name__] = func
+    return func
+
+def get_fixture_version() -> tuple:
+    """Returns the modification time and size of the fixture database, used as probe for the reference snapshots."""
+    return (os.path.getmtime(bsi.fixture_database), os.path.getsize(bsi.fixture_database))
+
+def graded_orders_query(since=None) -> str:
+    """Returns a query for the finished goods orders graded on or after since, or all graded orders."""
+    return f"SELECT [Ordrenummer] FROM [finished_goods_grades] WHERE 1 = 1 {bf.sql_since_filter('[Dato]', since)}"
+
+def roasting_orders_query(since=None) -> str:
+    """Returns a query for the roasting orders used for the finished goods orders graded on or after since."""
+    return f"SELECT [Relateret ordre] FROM [order_relationships] WHERE [Ordre] IN ({graded_orders_query(since)})"
+
+@fixture_reader
+def get_recipe_calculated_costs(recipe: str) -> dict:
+    """Returns a dictionary with calculated prices for the input recipe, 0 if the recipe has no calculated costs."""
+    df = pd.read_sql("SELECT * FROM [recipe_costs] WHERE [Receptnummer] = ?", bsi.con_nav, params=(str(recipe),))
+    prices = {"Price": 0.0, "Price +1M": 0.0, "Price +2M": 0.0, "Price +3M": 0.0}
+    if not df.empty:
+        prices = {key: float(df[key].iloc[0]) for key in prices}
+    return prices
+
+@fixture_reader
+@bf.snapshot(600, get_fixture_version)
+def get_coffee_contracts(certifications: dict = None) -> pd.DataFrame():
+    """Returns the coffee contracts, optionally only contracts fulfilling the criteria in certifications."""
+    query = "SELECT * FROM [coffee_contracts] AS C"
+    conditions = bf.get_contract_certification_conditions(certifications)
+    if conditions:
+        query += f" WHERE {' AND '.join(conditions)}"
+    return bf.set_column_types(pd.read_sql(query, bsi.con_nav))
+
+@fixture_reader
+@bf.snapshot(600, get_fixture_version)
+def get_recipe_information() -> pd.DataFrame():
+    """Returns masterdata for recipes as a pandas DataFrame."""
+    return pd.read_sql("SELECT * FROM [recipe_information]", bsi.con_nav)
+
+@fixture_reader
+@bf.cached_query
+@bf.snapshot(300, get_fixture_version)
+def get_gc_grades() -> pd.DataFrame():
+    """Returns all grades given to green coffees as a pandas DataFrame."""
+    df = pd.read_sql("SELECT * FROM [gc_grades]", bsi.con_ds, parse_dates=["Dato"])
+    return bf.set_column_types(df, grade_columns=flavor_columns)
+
+@fixture_reader
+@bf.cached_query
+def get_finished_goods_grades(since=None) -> pd.DataFrame():
+    """Returns all grades given to finished goods, optionally only grades given on or after since."""
+    query = f"SELECT * FROM [finished_goods_grades] WHERE 1 = 1 {bf.sql_since_filter('[Dato]', since)}"
+    return bf.set_column_types(pd.read_sql(query, bsi.con_ds, parse_dates=["Dato"]), ["Ordrenummer"], flavor_columns)
+
+@fixture_reader
+@bf.cached_query
+def get_nav_order_related(since=None) -> pd.DataFrame():
+    """
+    Returns the graded orders and their related orders. The fixture database has all relationships as reservations
+    in Navision, directly on the roasting orders.
+    """
+    query = f"SELECT [Ordre], [Relateret ordre] FROM [order_relationships] WHERE [Ordre] IN ({graded_orders_query(since)})"
+    return bf.set_column_types(pd.read_sql(query, bsi.con_nav), ["Ordre","Relateret ordre"])
+
+@fixture_reader
+@bf.cached_query
+def get_probat_orders_related(since=None) -> pd.DataFrame():
+    """Returns an empty dataframe, all relationships in the fixture database are found by get_nav_order_related."""
+    return bf.set_column_types(pd.DataFrame(columns=["Ordre","Relateret ordre"]), ["Ordre","Relateret ordre"])
+
+@fixture_reader
+@bf.cached_query
+def get_order_relationships(since=None) -> pd.DataFrame():
+    """Returns the graded orders and the roasting orders they are made from."""
+    df = pd.concat([get_nav_order_related(since), get_probat_orders_related(since)], ignore_index=True)
+    return df.dropna()
+
+@fixture_reader
+def get_roaster_input(since=None) -> pd.DataFrame():
+    """Returns the green coffee used for the roasting orders of graded products, optionally graded on or after since."""
+    query = f""" SELECT [Dato] ,[Rister] ,[Produktionsordre id] ,[Batch id] ,[Kilde silo] ,[Kontraktnummer]
+                 ,[Modtagelse] ,[Sortnummer i silo] ,[Kilo]
+                 FROM [roaster_input] WHERE [Ordrenummer] IN ({roasting_orders_query(since)}) """
+    df = pd.read_sql(query, bsi.con_probat, parse_dates=["Dato"])
+    return bf.set_column_types(df, ["Produktionsordre id","Batch id"])
+
+@fixture_reader
+def get_roaster_output(since=None) -> pd.DataFrame():
+    """Returns the output of the roasting orders of graded products, optionally graded on or after since."""
+    query = f"SELECT * FROM [roaster_output] WHERE [Ordrenummer] IN ({roasting_orders_query(since)})"
+    return bf.set_column_types(pd.read_sql(query, bsi.con_probat), ["Produktionsordre id","Batch id","Ordrenummer"])
+
+@fixture_reader
+def get_ds_blend_request(exit_if_empty: bool = True) -> pd.DataFrame():
+    """Returns the oldest blend request which has not been started, see bf.get_ds_blend_request."""
+    df = pd.read_sql("SELECT * FROM [cof].[Receptforslag_log] WHERE [Status] = 0 ORDER BY [Id] LIMIT 1", bsi.con_ds)
+    if exit_if_empty:
+        bf.get_exit_check(len(df))
+    return df
+
+@fixture_reader
+def claim_ds_blend_requests(number_of_requests: int = 1) -> pd.DataFrame():
+    """
+    Claims up to number_of_requests blend requests which have not been started, oldest first, see
+    bf.claim_ds_blend_requests. A request is only claimed if its status is still 0 when it is updated,
+    so concurrent processes never claim the same request.
+    """
+    with bsi.con_ds.begin() as con:
+        waiting = [row[0] for row in con.exec_driver_sql(
+            "SELECT [Id] FROM [cof].[Receptforslag_log] WHERE [Status] = 0 ORDER BY [Id] LIMIT ?", (int(number_of_requests),))]
+        claimed = [request_id for request_id in waiting if con.exec_driver_sql(
+            "UPDATE [cof].[Receptforslag_log] SET [Status] = 1 WHERE [Id] = ? AND [Status] = 0", (request_id,)).rowcount == 1]
+        df = pd.read_sql(f"SELECT * FROM [cof].[Receptforslag_log] WHERE [Id] IN ({','.join(map(str, claimed)) or 'NULL'})", con)
+    return df.sort_values("Id").reset_index(drop=True)
+
+def get_available_quantities(locations: list, min_quantity: float = None, delivery: bool = False) -> pd.DataFrame():
+    """Returns the available coffee at the input locations, with deliveries for the locations read from Probat."""
+    columns = "[Lokation] ,[Kontraktnummer] ,[Modtagelse]" if delivery else "[Kontraktnummer] ,[Lokation]"
+    query = f""" SELECT {columns} ,[Beholdning] FROM [available_quantities]
+                 WHERE [Lokation] IN ({bf.string_to_sql(locations)}) {bf.sql_minimum_filter("[Beholdning]", min_quantity)} """
+    return bf.set_column_types(pd.read_sql(query, bsi.con_nav if not delivery else bsi.con_probat))
+
+@fixture_reader
+def get_spot_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from SPOT, optionally only rows with at least min_quantity."""
+    return get_available_quantities(["SPOT"], min_quantity)
+
+@fixture_reader
+def get_havn_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from AARHUSHAVN, optionally only rows with at least min_quantity."""
+    return get_available_quantities(["AARHUSHAVN"], min_quantity)
+
+@fixture_reader
+def get_udland_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from UDLAND, optionally only rows with at least min_quantity."""
+    return get_available_quantities(["UDLAND"], min_quantity)
+
+@fixture_reader
+def get_afloat_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from AFLOAT, optionally only rows with at least min_quantity."""
+    return get_available_quantities(["AFLOAT"], min_quantity)
+
+@fixture_reader
+def get_silos_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from the silos, optionally only rows with at least min_quantity."""
+    return get_available_quantities(["SILOER"], min_quantity, delivery=True)
+
+@fixture_reader
+def get_warehouse_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from Warehouse, optionally only rows with at least min_quantity."""
+    return get_available_quantities(["WAREHOUSE"], min_quantity, delivery=True)
+
+@fixture_reader
+@bf.snapshot(600, get_fixture_version)
+def get_target_cupping_profiles() -> pd.DataFrame():
+    """Returns a dataframe containing all target cupping profiles of contracts."""
+    return pd.read_sql("SELECT * FROM [target_cupping_profiles]", bsi.con_nav)
+
+@fixture_reader
+@bf.snapshot(600, get_fixture_version)
+def get_recipe_cupping_profiles() -> pd.DataFrame():
+    """Returns a pandas dataframe with the target cupping profile, color and costs of all recipes."""
+    return pd.read_sql("SELECT * FROM [recipe_cupping_profiles]", bsi.con_nav)
+
+@fixture_reader
+def get_test_roastings(robusta: bool, start_tasting_id: int = 0, since=None) -> pd.DataFrame():
+    """Returns all graded test roastings, optionally graded on or after since, see bf.get_test_roastings."""
+    query = f"SELECT * FROM [test_roastings] WHERE 1 = 1 {bf.sql_since_filter('[Dato_p]', since)}"
+    df = bf.set_column_types(pd.read_sql(query, bsi.con_ds, parse_dates=date_columns["test_roastings"])
+                             ,["Produktionsordre id","Batch id","Ordre_rist","Ordre_p"]
+                             ,["Syre_p","Krop_p","Aroma_p","Eftersmag_p","Robusta_p"])
+    return bf.add_test_roasting_grades(df, robusta, start_tasting_id)
+
+
+def use_fixture_database(path: str):
+    """
+    Reads and writes all data used by bki_flow_management and ti_data_preprocessing in the fixture database in path
+    instead of on the servers. The readers in bki_functions call the readers of this module, the engines
+    connect to the fixture database, and workbooks are written to the folder Receptforslag next to the database.
+    The path is also set in the environment, so processes started later use the fixture database as well.
+    """
+    path = os.path.abspath(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Fixture database not found: {path}")
+    bsi.fixture_database = path
+    os.environ[bsi.fixture_database_variable] = path
+    bsi.filepath_report = os.path.join(os.path.dirname(path), "Receptforslag")
+    os.makedirs(bsi.filepath_report, exist_ok=True)
+    bsi.dispose_engines()
+    bf.reference_snapshots.clear()
+    bf.set_reader_backends(readers)
+
+
+def main(argv):
+    """Creates a fixture database from the command line and prints the number of rows in each table."""
+    parser = argparse.ArgumentParser(description="Create a SQLite database with synthetic data for running the scripts "
+                                                 "without access to the servers.")
+    parser.add_argument("path", help="The database file to create. An existing file is replaced.")
+    parser.add_argument("--contracts", type=int, default=3000, help="Number of coffee contracts. Default 3000.")
+    parser.add_argument("--years", type=float, default=5, help="Years of production and tastings. Default 5.")
+    parser.add_argument("--orders-per-day", type=float, default=20, help="Graded finished goods orders per day. Default 20.")
+    parser.add_argument("--requests", type=int, default=10, help="Number of waiting blend requests. Default 10.")
+    parser.add_argument("--end-date", default=None, help="Date of the newest data. Default today.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random numbers. Default 0.")
+    args = parser.parse_args(argv)
+
+    start_time = pd.Timestamp.now()
+    counts = generate_fixture_database(args.path, args.contracts, args.years, args.orders_per_day, args.requests
+                                       ,args.end_date, args.seed)
+    for name, count in counts.items():
+        print(f"{name}: {count} rows")
+    print(f"Fixture database written to {args.path} in {(pd.Timestamp.now() - start_time).total_seconds():.1f}s.")
+    print(f"Set {bsi.fixture_database_variable}={os.path.abspath(args.path)} to use it.")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,284 +1,483 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
-import joblib
 import bki_functions as bf
 import bki_server_information as bsi
 import ti_price_opt as tpo
+import ti_flavor_surrogate as tfs
+import ti_flavor_inference as tfi
 
 
-# Read request from BKI_Datastore
-df_request = bf.get_ds_blend_request()
-# Create necessary request variables for later use
-request_id = df_request["Id"].iloc[0]
-request_recipient = df_request["Bruger_email"].iloc[0]
-request_syre = df_request["Syre"].iloc[0]
-request_aroma = df_request["Aroma"].iloc[0]
-request_krop = df_request["Krop"].iloc[0]
-request_eftersmag = df_request["Eftersmag"].iloc[0]
-request_farve = df_request["Farve"].iloc[0]
-request_aggregate_input = True if df_request["Aggreger_til_sortniveau"].iloc[0] == 1 else False
-request_required_item = df_request["Låst_komponent"].iloc[0]
-request_required_proportion = df_request["Låst_komponent_proportion"].iloc[0]
-# Setting to differentiate between whether or not algorithm is expected to predict robusta taste or not
-predict_robusta = False
-
-# Update request that it is initiated and write into log
-bf.update_request_log(request_id ,1)
-bf.log_insert("bki_flow_management.py","Request id " + str(request_id) + " initiated.")
-
-# Add locations to dictionary for later
-dict_locations = {
-    "SILOER": df_request["Lager_siloer"].iloc[0]
-    ,"WAREHOUSE": df_request["Lager_warehouse"].iloc[0]
-    ,"AARHUSHAVN": df_request["Lager_havn"].iloc[0]
-    ,"SPOT": df_request["Lager_spot"].iloc[0]
-    ,"AFLOAT": df_request["Lager_afloat"].iloc[0]
-    ,"UDLAND": df_request["Lager_udland"].iloc[0]}
-
-# Minimum available amount of coffee for an item to be included
-min_quantity = df_request["Minimum_lager"].iloc[0]
-# Calculated price for target recipe if such is defined
-requested_recipe_prices = bf.get_recipe_calculated_costs(df_request["Receptnummer"].iloc[0])
-
-# Different types of certifications
-dict_certifications = {
-    "Sammensætning": df_request["Sammensætning"].iloc[0]
-    ,"Fairtrade": df_request["Inkluder_fairtrade"].iloc[0]
-    ,"Økologi": df_request["Inkluder_økologi"].iloc[0]
-    ,"Rainforest": df_request["Inkluder_rainforest"].iloc[0]
-    ,"Konventionel": df_request["Inkluder_konventionel"].iloc[0]}
-
-# Get all available quantities available for use in production.
-df_available_coffee = bf.get_all_available_quantities(
-    dict_locations
-    ,min_quantity
-    ,dict_certifications
-    ,request_aggregate_input)
-column_order_available_coffee = ["Kontraktnummer","Modtagelse","Lokation","Beholdning"
-                                 ,"Syre","Aroma","Krop","Eftersmag","Robusta"
-                                 ,"Differentiale", "Kostpris","Standard Cost"
-                                 ,"Forecast Unit Cost +1M", "Forecast Unit Cost +2M", "Forecast Unit Cost +3M"
-                                 ,"Sort","Varenavn","Screensize","Oprindelsesland","Mærkningsordning"]
-df_available_coffee = df_available_coffee[column_order_available_coffee]
-# Replace all na values for robusta with 10 if algorithm is to predict this, otherwise remove it
-if not predict_robusta:
-    df_available_coffee.drop("Robusta", inplace=True, axis=1)
-df_available_coffee.reset_index(drop=True, inplace=True)
-# Add dataframe index to a column to use for join later on
-df_available_coffee["Kontrakt_id"] = df_available_coffee.index
-
-if predict_robusta:
-    flavor_columns = ["Syre","Aroma","Krop","Eftersmag","Robusta"]
-    flavors_list = df_available_coffee[flavor_columns].to_numpy()
-    target_flavor_list = df_request[["Syre","Aroma","Krop","Eftersmag","Robusta"]].fillna(10).to_numpy()[0]
-    model_name = "flavor_predictor_robusta.sav"
-else:
-    flavor_columns = ["Syre","Aroma","Krop","Eftersmag"]
-    flavors_list = df_available_coffee[flavor_columns].to_numpy()
-    target_flavor_list = df_request[["Syre","Aroma","Krop","Eftersmag"]].to_numpy()[0]
-    model_name = "flavor_predictor_no_robusta.sav"
-# Lists indifferent to whether or not robusta is to be predicted or not
-contract_prices_list = df_available_coffee["Standard Cost"].to_numpy().reshape(-1, 1)
-contracts_list = df_available_coffee["Kontraktnummer"].to_list()
-
-# model for flavor predictor
-flavor_predictor = joblib.load(model_name)
-# Get blend suggestions
-blend_suggestions_hof = tpo.ga_cheapest_blend(
-    contracts_list
-    ,flavors_list
-    ,contract_prices_list
-    ,flavor_predictor
-    ,target_flavor_list
-    ,request_farve)[2]
-
-# =============================================================================
-# Create Excel workbook with relevant sheets
-# =============================================================================
-wb_name = f"Receptforslag_{request_id}.xlsx"
-path_file_wb = bsi.filepath_report + r"\\" + wb_name
-excel_writer = pd.ExcelWriter(path_file_wb, engine="xlsxwriter")
-
-# SHEET 1           
-df_blend_suggestions = bf.convert_blends_lists_to_dataframe(blend_suggestions_hof)
-# Defined column order for final dataframe, only add robusta if it is to be predicted.
-blend_suggestion_columns = ["Blend_nr" ,"Kontraktnummer" ,"Modtagelse" ,"Proportion"
-                            ,"Sort","Varenavn","Beregnet pris" ,"Beregnet pris +1M"
-                            ,"Beregnet pris +2M", "Beregnet pris +3M"
-                            ,"Syre", "Aroma", "Krop", "Eftersmag"]
-if predict_robusta:
-    blend_suggestion_columns[14:14] = ["Robusta"]
-# Merge blend suggestions with input available coffees to add additional info to datafarme, and alter column order
-df_blend_suggestions = pd.merge(
-    left = df_blend_suggestions
-    ,right = df_available_coffee
-    ,how = "left"
-    ,left_on= "Kontraktnummer_index"
-    ,right_on = "Kontrakt_id")
-# Calculate blend cost per component using the standard cost price of each component
-df_blend_suggestions["Beregnet pris"] = df_blend_suggestions["Proportion"] * df_blend_suggestions["Standard Cost"]
-df_blend_suggestions["Beregnet pris +1M"] = df_blend_suggestions["Proportion"] * df_blend_suggestions["Forecast Unit Cost +1M"]
-df_blend_suggestions["Beregnet pris +2M"] = df_blend_suggestions["Proportion"] * df_blend_suggestions["Forecast Unit Cost +2M"]
-df_blend_suggestions["Beregnet pris +3M"] = df_blend_suggestions["Proportion"] * df_blend_suggestions["Forecast Unit Cost +3M"]
-# Insert into workbook
-bf.insert_dataframe_into_excel(
-    excel_writer
-    ,df_blend_suggestions[blend_suggestion_columns]
-    ,"Blend forslag")
-
-
-# SHEET 2
-# Sumarized blend suggestions with total cost
-df_blend_suggestions_summarized = df_blend_suggestions.groupby(["Blend_nr"],dropna=False) \
-                                                      .agg({"Beregnet pris": "sum"
-                                                            ,"Beregnet pris +1M": "sum"
-                                                            ,"Beregnet pris +2M": "sum"
-                                                            ,"Beregnet pris +3M": "sum"}) \
-                                                      .reset_index()
-
-# Get a list over number of blends that needs to be iterated over
-blend_no_iterator = df_blend_suggestions_summarized["Blend_nr"].to_list()
-# Create lists for flavors
-predicted_flavors_syre = []
-predicted_flavors_aroma = []
-predicted_flavors_krop = []
-predicted_flavors_eftersmag = []
-predicted_flavors_robusta = []
-# Iterate over each blend and append flavor to lists
-for blend_no in blend_no_iterator:
-    # Iterate over integers.. cleanup...
-    blend_no = int(blend_no)
-    hof_blend_no_index = int(blend_no) -1
-    # Get hof blend by index
-    hof_blend = blend_suggestions_hof[hof_blend_no_index]
-    # Predict flavor
-    predicted_flavors = tpo.taste_pred(hof_blend, flavor_predictor, flavors_list, request_farve)
-    # Add each flavor to each own list
-    predicted_flavors_syre += [predicted_flavors[0]]
-    predicted_flavors_aroma += [predicted_flavors[1]]
-    predicted_flavors_krop += [predicted_flavors[2]]
-    predicted_flavors_eftersmag += [predicted_flavors[3]]
+# Flavor models loaded by this process. Kept in memory so a worker only loads each model once.
+flavor_models = {}
+flavor_model_names = ["flavor_predictor_robusta.sav", "flavor_predictor_no_robusta.sav"]
+# Status for requests that failed while being processed
+request_status_failed = 3
+
+
+def load_flavor_model(model_name: str):
+    """
+    Returns the flavor model saved in the input file, the file is only read the first time a model is requested.
+    The FlavorPredictor exported with the model is used if it exists, see tfi.load_flavor_model.
+    """
+    if model_name not in flavor_models:
+        flavor_models[model_name] = tfi.load_flavor_model(model_name)
+    return flavor_models[model_name]
+
+
+def load_flavor_surrogate(model_name: str):
+    """
+    Returns the surrogate saved with the input flavor model, or None if no surrogate has been trained for the model.
+    A surrogate which was not fitted to the saved flavor model, e.g. because the model has been trained again
+    without a new surrogate, is not used and is written into the log.
+    """
+    surrogate_name = tfs.surrogate_file_name(model_name)
+    if surrogate_name not in flavor_models and not os.path.exists(surrogate_name):
+        return None
+    surrogate = load_flavor_model(surrogate_name)
+    if not surrogate.matches_flavor_model(model_name):
+        bf.log_insert("bki_flow_management.py", f"{surrogate_name} was not fitted to {model_name} and is not used.")
+        return None
+    return surrogate
+
+
+def process_blend_request(df_request: pd.DataFrame, ga_islands: int = 1, constant_memory_excel: bool = False):
+    """
+    Creates blend suggestions for a request from cof.Receptforslag_log, writes them into an Excel workbook
+    and creates a notification email for the user who made the request.
+    Parameters
+    ----------
+    df_request : pd.DataFrame
+        Dataframe with a single record from cof.Receptforslag_log.
+    ga_islands : int, optional
+        The number of islands evolved in parallel processes by the genetic algorithm. The default is 1.
+    constant_memory_excel : bool, optional
+        Write the Excel workbook in xlsxwriter constant_memory mode, streaming each sheet to disk row by row. The default is False.
+    """
+    # Create necessary request variables for later use
+    request_id = df_request["Id"].iloc[0]
+    request_recipient = df_request["Bruger_email"].iloc[0]
+    request_syre = df_request["Syre"].iloc[0]
+    request_aroma = df_request["Aroma"].iloc[0]
+    request_krop = df_request["Krop"].iloc[0]
+    request_eftersmag = df_request["Eftersmag"].iloc[0]
+    request_farve = df_request["Farve"].iloc[0]
+    request_aggregate_input = True if df_request["Aggreger_til_sortniveau"].iloc[0] == 1 else False
+    request_required_item = df_request["Låst_komponent"].iloc[0]
+    request_required_proportion = df_request["Låst_komponent_proportion"].iloc[0]
+    # Setting to differentiate between whether or not algorithm is expected to predict robusta taste or not
+    predict_robusta = False
+
+    # The request was set to status 1 when it was claimed, write into log that it is initiated
+    bf.log_insert("bki_flow_management.py","Request id " + str(request_id) + " initiated.")
+
+    # Add locations to dictionary for later
+    dict_locations = {
+        "SILOER": df_request["Lager_siloer"].iloc[0]
+        ,"WAREHOUSE": df_request["Lager_warehouse"].iloc[0]
+        ,"AARHUSHAVN": df_request["Lager_havn"].iloc[0]
+        ,"SPOT": df_request["Lager_spot"].iloc[0]
+        ,"AFLOAT": df_request["Lager_afloat"].iloc[0]
+        ,"UDLAND": df_request["Lager_udland"].iloc[0]}
+
+    # Minimum available amount of coffee for an item to be included
+    min_quantity = df_request["Minimum_lager"].iloc[0]
+    # Calculated price for target recipe if such is defined
+    requested_recipe_prices = bf.get_recipe_calculated_costs(df_request["Receptnummer"].iloc[0])
+
+    # Different types of certifications
+    dict_certifications = {
+        "Sammensætning": df_request["Sammensætning"].iloc[0]
+        ,"Fairtrade": df_request["Inkluder_fairtrade"].iloc[0]
+        ,"Økologi": df_request["Inkluder_økologi"].iloc[0]
+        ,"Rainforest": df_request["Inkluder_rainforest"].iloc[0]
+        ,"Konventionel": df_request["Inkluder_konventionel"].iloc[0]}
+
+    # Get all available quantities available for use in production.
+    df_available_coffee = bf.get_all_available_quantities(
+        dict_locations
+        ,min_quantity
+        ,dict_certifications
+        ,request_aggregate_input)
+    column_order_available_coffee = ["Kontraktnummer","Modtagelse","Lokation","Beholdning"
+                                     ,"Syre","Aroma","Krop","Eftersmag","Robusta"
+                                     ,"Differentiale", "Kostpris","Standard Cost"
+                                     ,"Forecast Unit Cost +1M", "Forecast Unit Cost +2M", "Forecast Unit Cost +3M"
+                                     ,"Sort","Varenavn","Screensize","Oprindelsesland","Mærkningsordning"]
+    # Screensize and Oprindelsesland are not returned by get_coffee_contracts, and are empty unless aggregated
+    df_available_coffee = df_available_coffee.reindex(columns=column_order_available_coffee)
+    # Replace all na values for robusta with 10 if algorithm is to predict this, otherwise remove it
+    if not predict_robusta:
+        df_available_coffee.drop("Robusta", inplace=True, axis=1)
+    df_available_coffee.reset_index(drop=True, inplace=True)
+    # Add dataframe index to a column to use for join later on
+    df_available_coffee["Kontrakt_id"] = df_available_coffee.index
+
     if predict_robusta:
-        predicted_flavors_robusta += [predicted_flavors[4]]
-    
-# Add flavors to dataframe
-df_blend_suggestions_summarized["Syre"] = predicted_flavors_syre
-df_blend_suggestions_summarized["Aroma"] = predicted_flavors_aroma
-df_blend_suggestions_summarized["Krop"] = predicted_flavors_krop
-df_blend_suggestions_summarized["Eftersmag"] = predicted_flavors_eftersmag
-if predict_robusta:
-    df_blend_suggestions_summarized["Robusta"] = predicted_flavors_robusta
-
-# Calculate whether or not a suggested recipe indicates any savings in cost
-df_blend_suggestions_summarized["Pris diff"] = df_blend_suggestions_summarized["Beregnet pris"] - requested_recipe_prices["Price"]
-df_blend_suggestions_summarized["Pris diff +1M"] = df_blend_suggestions_summarized["Beregnet pris +1M"] - requested_recipe_prices["Price +1M"]
-df_blend_suggestions_summarized["Pris diff +2M"] = df_blend_suggestions_summarized["Beregnet pris +2M"] - requested_recipe_prices["Price +2M"]
-df_blend_suggestions_summarized["Pris diff +3M"] = df_blend_suggestions_summarized["Beregnet pris +3M"] - requested_recipe_prices["Price +3M"]
-
-# Insert final dataframe into workbook
-bf.insert_dataframe_into_excel(
-    excel_writer
-    ,df_blend_suggestions_summarized
-    ,"Blend forslag opsummeret")
-
-
-# SHEET 3/4
-# Add the required item index value if it exists, don't try to create sheet if it does not exist..
-if request_required_item in df_available_coffee["Sort"].to_list():
-    request_required_item = df_available_coffee["Sort"].to_list().index(request_required_item)
-    # Get all the best fitting blends that fullfill criteria for fixed component and min proportion
-    best_fitting_req_blends,best_fitting_req_fitness = bf.get_fitting_blends_complete_list(
-        request_required_item
-        ,request_required_proportion
-        ,df_available_coffee["Kontrakt_id"].to_list()
+        flavor_columns = ["Syre","Aroma","Krop","Eftersmag","Robusta"]
+        flavors_list = df_available_coffee[flavor_columns].to_numpy()
+        target_flavor_list = df_request[["Syre","Aroma","Krop","Eftersmag","Robusta"]].fillna(10).to_numpy()[0]
+        model_name = "flavor_predictor_robusta.sav"
+    else:
+        flavor_columns = ["Syre","Aroma","Krop","Eftersmag"]
+        flavors_list = df_available_coffee[flavor_columns].to_numpy()
+        target_flavor_list = df_request[["Syre","Aroma","Krop","Eftersmag"]].to_numpy()[0]
+        model_name = "flavor_predictor_no_robusta.sav"
+    # Lists indifferent to whether or not robusta is to be predicted or not
+    contract_prices_list = df_available_coffee["Standard Cost"].to_numpy().reshape(-1, 1)
+    contracts_list = df_available_coffee["Kontraktnummer"].to_list()
+
+    # model for flavor predictor
+    flavor_predictor = load_flavor_model(model_name)
+    # Cache of predictions shared by the optimization and the report, so no blend is predicted twice
+    prediction_cache = tpo.PredictionCache(flavor_predictor, flavors_list)
+    # Get blend suggestions
+    blend_suggestions_hof = tpo.ga_cheapest_blend(
+        contracts_list
+        ,flavors_list
         ,contract_prices_list
         ,flavor_predictor
-        ,flavors_list
         ,target_flavor_list
-        ,request_farve)
-    # Create a hall of fame from blends
-    hof_req_blends = bf.get_blends_hof(best_fitting_req_blends, best_fitting_req_fitness)
-    # Convert hall of fame to dataframe
-    df_requested_blends = bf.convert_blends_lists_to_dataframe(hof_req_blends,1000)
-    # Merge blend suggestions with input available coffees to add additional info to datafarme, and alter column order
-    df_requested_blends = pd.merge(
-        left = df_requested_blends
-        ,right = df_available_coffee
-        ,how = "left"
-        ,left_on= "Kontraktnummer_index"
-        ,right_on = "Kontrakt_id")
-    # Calculate blend cost per component using the standard cost price of each component
-    df_requested_blends["Beregnet pris"] = df_requested_blends["Proportion"] * df_requested_blends["Standard Cost"]
-    df_requested_blends["Beregnet pris +1M"] = df_requested_blends["Proportion"] * df_requested_blends["Forecast Unit Cost +1M"]
-    df_requested_blends["Beregnet pris +2M"] = df_requested_blends["Proportion"] * df_requested_blends["Forecast Unit Cost +2M"]
-    df_requested_blends["Beregnet pris +3M"] = df_requested_blends["Proportion"] * df_requested_blends["Forecast Unit Cost +3M"]
-    # Defined column order for final dataframe
-    blend_suggestion_columns = ["Blend_nr" ,"Sort","Varenavn" ,"Proportion"
-                                ,"Beregnet pris" ,"Beregnet pris +1M"
-                                ,"Beregnet pris +2M", "Beregnet pris +3M"]
-    df_requested_blends = df_requested_blends[blend_suggestion_columns]
-    # Add dataframe to workbook
-    bf.insert_dataframe_into_excel(
-        excel_writer
-        ,df_requested_blends
-        ,"Blends - låst sort")
-
-
-# SHEET 3/4
-# Green coffee input, insert into workbook
-bf.insert_dataframe_into_excel(
-    excel_writer
-    ,df_available_coffee
-    ,"Råkaffe input")
-
-# SHEET 4/5
-# Similar/identical blends, insert into workbook
-bf.insert_dataframe_into_excel(
-    excel_writer
-    ,bf.get_identical_recipes(request_syre, request_aroma, request_krop, request_eftersmag)
-    ,"Identiske, lign. recepter")
-
-# Input data for request, replace 0/1 with text values before transposing
-dict_include_exclude = {0: "Ekskluder", 1: "Inkluder"}
-columns_include_exclude = ["Inkluder_konventionel","Inkluder_fairtrade","Inkluder_økologi"
-                           ,"Inkluder_rainforest","Lager_siloer","Lager_warehouse","Lager_havn"
-                           ,"Lager_spot","Lager_afloat","Lager_udland"]
-for col in columns_include_exclude:
-    df_request[col] = df_request[col].map(dict_include_exclude)
-# Add columns with calculated recipe price
-df_request["Beregnet pris"] = requested_recipe_prices["Price"]
-df_request["Beregnet pris +1M"] = requested_recipe_prices["Price +1M"]
-df_request["Beregnet pris +2M"] = requested_recipe_prices["Price +2M"]
-df_request["Beregnet pris +3M"] = requested_recipe_prices["Price +3M"]
-
-# Transpose and change headers
-df_request = df_request.transpose().reset_index()
-df_request.columns = ["Oplysning","Værdi"]
-# Insert into workbook
-bf.insert_dataframe_into_excel(
-    excel_writer
-    ,df_request
-    ,"Data for anmodning")
-
-# Save and close workbook
-excel_writer.save()
-excel_writer.close()
-
-# Update source table with status, filename and -path
-bf.update_request_log(request_id ,2 ,wb_name, bsi.filepath_report)
-bf.log_insert("bki_flow_management.py","Request id " + str(request_id) + " completed.")
-
-# Create record in cof.email_log
-dict_email = {
-    "Id_Org": request_id
-    ,"Email_type": 5
-    ,"Email_til": request_recipient
-    ,"Email_emne": f"Excel fil med receptforslag klar: {wb_name}"
-    ,"Email_tekst": f"""Excel fil med receptforslag er klar.
-                        Filnavn: {wb_name}
-                        Filsti: {bsi.filepath_report} \n\n\n"""
-    ,"Id_org_kildenummer": 9}
-bf.insert_into_email_log(dict_email)
-bf.log_insert("bki_flow_management.py","Notification email for request id " + str(request_id) + " created.")
+        ,request_farve
+        ,prediction_cache=prediction_cache
+        ,islands=ga_islands)[2]
+
+    # =============================================================================
+    # Create Excel workbook with relevant sheets
+    # =============================================================================
+    wb_name = f"Receptforslag_{request_id}.xlsx"
+    path_file_wb = os.path.join(bsi.filepath_report, wb_name)
+    # The workbook is closed, and written, also if creating a sheet fails
+    with bf.create_excel_writer(path_file_wb, constant_memory_excel) as excel_writer:
+        # SHEET 1           
+        df_blend_suggestions = bf.convert_blends_lists_to_dataframe(blend_suggestions_hof)
+        # Defined column order for final dataframe, only add robusta if it is to be predicted.
+        blend_suggestion_columns = ["Blend_nr" ,"Kontraktnummer" ,"Modtagelse" ,"Proportion"
+                                    ,"Sort","Varenavn","Beregnet pris" ,"Beregnet pris +1M"
+                                    ,"Beregnet pris +2M", "Beregnet pris +3M"
+                                    ,"Syre", "Aroma", "Krop", "Eftersmag"]
+        if predict_robusta:
+            blend_suggestion_columns[14:14] = ["Robusta"]
+        # Merge blend suggestions with input available coffees to add additional info to datafarme, and alter column order
+        df_blend_suggestions = pd.merge(
+            left = df_blend_suggestions
+            ,right = df_available_coffee
+            ,how = "left"
+            ,left_on= "Kontraktnummer_index"
+            ,right_on = "Kontrakt_id")
+        # Calculate blend cost per component using the standard cost price of each component
+        df_blend_suggestions["Beregnet pris"] = df_blend_suggestions["Proportion"] * df_blend_suggestions["Standard Cost"]
+        df_blend_suggestions["Beregnet pris +1M"] = df_blend_suggestions["Proportion"] * df_blend_suggestions["Forecast Unit Cost +1M"]
+        df_blend_suggestions["Beregnet pris +2M"] = df_blend_suggestions["Proportion"] * df_blend_suggestions["Forecast Unit Cost +2M"]
+        df_blend_suggestions["Beregnet pris +3M"] = df_blend_suggestions["Proportion"] * df_blend_suggestions["Forecast Unit Cost +3M"]
+        # Insert into workbook
+        bf.insert_dataframe_into_excel(
+            excel_writer
+            ,df_blend_suggestions[blend_suggestion_columns]
+            ,"Blend forslag")
+
+
+        # SHEET 2
+        # Sumarized blend suggestions with total cost
+        df_blend_suggestions_summarized = df_blend_suggestions.groupby(["Blend_nr"],dropna=False) \
+                                                              .agg({"Beregnet pris": "sum"
+                                                                    ,"Beregnet pris +1M": "sum"
+                                                                    ,"Beregnet pris +2M": "sum"
+                                                                    ,"Beregnet pris +3M": "sum"}) \
+                                                              .reset_index()
+
+        # Get a list over number of blends that needs to be iterated over
+        blend_no_iterator = df_blend_suggestions_summarized["Blend_nr"].to_list()
+        # Create lists for flavors
+        predicted_flavors_syre = []
+        predicted_flavors_aroma = []
+        predicted_flavors_krop = []
+        predicted_flavors_eftersmag = []
+        predicted_flavors_robusta = []
+        # Iterate over each blend and append flavor to lists
+        for blend_no in blend_no_iterator:
+            # Iterate over integers.. cleanup...
+            blend_no = int(blend_no)
+            hof_blend_no_index = int(blend_no) -1
+            # Get hof blend by index
+            hof_blend = blend_suggestions_hof[hof_blend_no_index]
+            # Predict flavor
+            predicted_flavors = tpo.taste_pred(hof_blend, flavor_predictor, flavors_list, request_farve, prediction_cache)
+            # Add each flavor to each own list
+            predicted_flavors_syre += [predicted_flavors[0]]
+            predicted_flavors_aroma += [predicted_flavors[1]]
+            predicted_flavors_krop += [predicted_flavors[2]]
+            predicted_flavors_eftersmag += [predicted_flavors[3]]
+            if predict_robusta:
+                predicted_flavors_robusta += [predicted_flavors[4]]
+
+        # Add flavors to dataframe
+        df_blend_suggestions_summarized["Syre"] = predicted_flavors_syre
+        df_blend_suggestions_summarized["Aroma"] = predicted_flavors_aroma
+        df_blend_suggestions_summarized["Krop"] = predicted_flavors_krop
+        df_blend_suggestions_summarized["Eftersmag"] = predicted_flavors_eftersmag
+        if predict_robusta:
+            df_blend_suggestions_summarized["Robusta"] = predicted_flavors_robusta
+        bf.log_insert("bki_flow_management.py","Request id " + str(request_id) + ". " + prediction_cache.statistics())
+
+        # Calculate whether or not a suggested recipe indicates any savings in cost
+        df_blend_suggestions_summarized["Pris diff"] = df_blend_suggestions_summarized["Beregnet pris"] - requested_recipe_prices["Price"]
+        df_blend_suggestions_summarized["Pris diff +1M"] = df_blend_suggestions_summarized["Beregnet pris +1M"] - requested_recipe_prices["Price +1M"]
+        df_blend_suggestions_summarized["Pris diff +2M"] = df_blend_suggestions_summarized["Beregnet pris +2M"] - requested_recipe_prices["Price +2M"]
+        df_blend_suggestions_summarized["Pris diff +3M"] = df_blend_suggestions_summarized["Beregnet pris +3M"] - requested_recipe_prices["Price +3M"]
+
+        # Insert final dataframe into workbook
+        bf.insert_dataframe_into_excel(
+            excel_writer
+            ,df_blend_suggestions_summarized
+            ,"Blend forslag opsummeret")
+
+
+        # SHEET 3/4
+        # Add the required item index value if it exists, don't try to create sheet if it does not exist..
+        if request_required_item in df_available_coffee["Sort"].to_list():
+            request_required_item = df_available_coffee["Sort"].to_list().index(request_required_item)
+            # Get all the best fitting blends that fullfill criteria for fixed component and min proportion
+            best_fitting_req_blends,best_fitting_req_fitness = bf.get_fitting_blends_complete_list(
+                request_required_item
+                ,request_required_proportion
+                ,df_available_coffee["Kontrakt_id"].to_list()
+                ,contract_prices_list
+                ,flavor_predictor
+                ,flavors_list
+                ,target_flavor_list
+                ,request_farve
+                ,surrogate=load_flavor_surrogate(model_name))
+            # Create a hall of fame from blends
+            hof_req_blends = bf.get_blends_hof(best_fitting_req_blends, best_fitting_req_fitness)
+            # Convert hall of fame to dataframe
+            df_requested_blends = bf.convert_blends_lists_to_dataframe(hof_req_blends,1000)
+            # Merge blend suggestions with input available coffees to add additional info to datafarme, and alter column order
+            df_requested_blends = pd.merge(
+                left = df_requested_blends
+                ,right = df_available_coffee
+                ,how = "left"
+                ,left_on= "Kontraktnummer_index"
+                ,right_on = "Kontrakt_id")
+            # Calculate blend cost per component using the standard cost price of each component
+            df_requested_blends["Beregnet pris"] = df_requested_blends["Proportion"] * df_requested_blends["Standard Cost"]
+            df_requested_blends["Beregnet pris +1M"] = df_requested_blends["Proportion"] * df_requested_blends["Forecast Unit Cost +1M"]
+            df_requested_blends["Beregnet pris +2M"] = df_requested_blends["Proportion"] * df_requested_blends["Forecast Unit Cost +2M"]
+            df_requested_blends["Beregnet pris +3M"] = df_requested_blends["Proportion"] * df_requested_blends["Forecast Unit Cost +3M"]
+            # Defined column order for final dataframe
+            blend_suggestion_columns = ["Blend_nr" ,"Sort","Varenavn" ,"Proportion"
+                                        ,"Beregnet pris" ,"Beregnet pris +1M"
+                                        ,"Beregnet pris +2M", "Beregnet pris +3M"]
+            df_requested_blends = df_requested_blends[blend_suggestion_columns]
+            # Add dataframe to workbook
+            bf.insert_dataframe_into_excel(
+                excel_writer
+                ,df_requested_blends
+                ,"Blends - låst sort")
+
+
+        # SHEET 3/4
+        # Green coffee input, insert into workbook
+        bf.insert_dataframe_into_excel(
+            excel_writer
+            ,df_available_coffee
+            ,"Råkaffe input")
+
+        # SHEET 4/5
+        # Similar/identical blends, insert into workbook
+        bf.insert_dataframe_into_excel(
+            excel_writer
+            ,bf.get_identical_recipes(request_syre, request_aroma, request_krop, request_eftersmag)
+            ,"Identiske, lign. recepter")
+
+        # Input data for request, replace 0/1 with text values before transposing
+        dict_include_exclude = {0: "Ekskluder", 1: "Inkluder"}
+        columns_include_exclude = ["Inkluder_konventionel","Inkluder_fairtrade","Inkluder_økologi"
+                                   ,"Inkluder_rainforest","Lager_siloer","Lager_warehouse","Lager_havn"
+                                   ,"Lager_spot","Lager_afloat","Lager_udland"]
+        for col in columns_include_exclude:
+            df_request[col] = df_request[col].map(dict_include_exclude)
+        # Add columns with calculated recipe price
+        df_request["Beregnet pris"] = requested_recipe_prices["Price"]
+        df_request["Beregnet pris +1M"] = requested_recipe_prices["Price +1M"]
+        df_request["Beregnet pris +2M"] = requested_recipe_prices["Price +2M"]
+        df_request["Beregnet pris +3M"] = requested_recipe_prices["Price +3M"]
+
+        # Transpose and change headers
+        df_request = df_request.transpose().reset_index()
+        df_request.columns = ["Oplysning","Værdi"]
+        # Insert into workbook
+        bf.insert_dataframe_into_excel(
+            excel_writer
+            ,df_request
+            ,"Data for anmodning")
+
+
+    # Update source table with status, filename and -path
+    bf.update_request_log(request_id ,2 ,wb_name, bsi.filepath_report)
+    bf.log_insert("bki_flow_management.py","Request id " + str(request_id) + ". " + bf.reference_snapshots.statistics())
+    bf.log_insert("bki_flow_management.py","Request id " + str(request_id) + " completed.")
+
+    # Create record in cof.email_log
+    dict_email = {
+        "Id_Org": request_id
+        ,"Email_type": 5
+        ,"Email_til": request_recipient
+        ,"Email_emne": f"Excel fil med receptforslag klar: {wb_name}"
+        ,"Email_tekst": f"""Excel fil med receptforslag er klar.
+                            Filnavn: {wb_name}
+                            Filsti: {bsi.filepath_report} \n\n\n"""
+        ,"Id_org_kildenummer": 9}
+    bf.insert_into_email_log(dict_email)
+    bf.log_insert("bki_flow_management.py","Notification email for request id " + str(request_id) + " created.")
+
+
+def init_worker_process():
+    """
+    Prepares a process in the worker pool. Connections and log records inherited from the parent process are
+    discarded so each process opens its own connections and records are only written by the parent, and the
+    flavor models are loaded before the first request arrives.
+    """
+    bsi.dispose_engines(close=False)
+    bf.clear_logs()
+    for model_name in flavor_model_names:
+        if os.path.exists(model_name):
+            load_flavor_model(model_name)
+            load_flavor_surrogate(model_name)
+
+
+def process_claimed_request(df_request: pd.DataFrame, ga_islands: int = 1, constant_memory_excel: bool = False) -> bool:
+    """
+    Processes a claimed blend request. If processing fails, the request is marked as failed and the error is logged,
+    so a failing request never stops other requests or leaves the request in status 1.
+    The buffered log and email records are written when the request is done.
+    Returns True if the request was completed.
+    """
+    request_id = df_request["Id"].iloc[0]
+    try:
+        process_blend_request(df_request, ga_islands, constant_memory_excel)
+        return True
+    except Exception as e:
+        mark_request_failed(request_id, e)
+        return False
+    finally:
+        # The records stay buffered if they can not be written, which must not change the result of the request
+        try:
+            bf.flush_logs()
+        except Exception as e:
+            print(f"Log records for request id {request_id} could not be written: {e!r}")
+
+
+def mark_request_failed(request_id: int, error: BaseException):
+    """Sets the status of a request to failed and writes the error into the log at once."""
+    bf.update_request_log(request_id, request_status_failed)
+    bf.log_insert("bki_flow_management.py", "Request id " + str(request_id) + " failed: " + repr(error), flush=True)
+
+
+def run_worker(poll_interval: float = 30, max_requests: int = None, processes: int = 1, ga_islands: int = 1
+               ,constant_memory_excel: bool = False):
+    """
+    Processes blend requests in a loop, keeping imported modules and loaded flavor models in memory between requests.
+    Requests are claimed atomically, so several workers can run at the same time.
+    When no requests are waiting, the log is polled again after poll_interval seconds.
+    Parameters
+    ----------
+    poll_interval : float, optional
+        Seconds to wait before polling again when no requests are waiting. The default is 30.
+    max_requests : int, optional
+        The number of requests to process before stopping. The default is None, which never stops.
+    processes : int, optional
+        The number of requests processed concurrently, each in its own process. The default is 1,
+        which processes requests one at a time in the current process.
+    ga_islands : int, optional
+        The number of islands evolved in parallel processes by the genetic algorithm for each request. The default is 1.
+    constant_memory_excel : bool, optional
+        Write the Excel workbooks in xlsxwriter constant_memory mode. The default is False.
+    """
+    if processes > 1:
+        run_worker_pool(poll_interval, max_requests, processes, ga_islands, constant_memory_excel)
+        return
+    processed_requests = 0
+    while max_requests is None or processed_requests < max_requests:
+        df_request = bf.claim_ds_blend_requests(1)
+        if df_request.empty:
+            time.sleep(poll_interval)
+            continue
+        process_claimed_request(df_request, ga_islands, constant_memory_excel)
+        processed_requests += 1
+
+
+def run_worker_pool(poll_interval: float, max_requests: int, processes: int, ga_islands: int = 1
+                    ,constant_memory_excel: bool = False):
+    """
+    Processes blend requests concurrently in a pool of processes. New requests are claimed whenever a process is free.
+    Parameters are the same as for run_worker().
+    """
+    claimed_requests = 0
+    running_requests = {}
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker_process) as executor:
+        while True:
+            free_processes = processes - len(running_requests)
+            if max_requests is not None:
+                free_processes = min(free_processes, max_requests - claimed_requests)
+            if free_processes > 0:
+                df_requests = bf.claim_ds_blend_requests(free_processes)
+                for i in range(len(df_requests)):
+                    df_request = df_requests.iloc[[i]].reset_index(drop=True)
+                    future = executor.submit(process_claimed_request, df_request, ga_islands, constant_memory_excel)
+                    running_requests[future] = df_request["Id"].iloc[0]
+                claimed_requests += len(df_requests)
+            if not running_requests:
+                if max_requests is not None and claimed_requests >= max_requests:
+                    break
+                time.sleep(poll_interval)
+                continue
+            done, _ = wait(running_requests, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                request_id = running_requests.pop(future)
+                # Failures inside a request are handled in the process, this catches processes that died
+                if future.exception() is not None:
+                    mark_request_failed(request_id, future.exception())
+
+
+def main(argv: list = None):
+    """Processes a single blend request, or keeps processing requests with the --worker option."""
+    parser = argparse.ArgumentParser(description="Create blend suggestions for requests in cof.Receptforslag_log.")
+    parser.add_argument("--worker", action="store_true",
+                        help="Keep running and process requests as they arrive instead of processing a single request.")
+    parser.add_argument("--poll-interval", type=float, default=30,
+                        help="Seconds between polls for new requests in worker mode. Default 30.")
+    parser.add_argument("--max-requests", type=int, default=None,
+                        help="Stop the worker after this number of requests. Default is to never stop.")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of requests processed concurrently in worker mode. Default 1.")
+    parser.add_argument("--ga-islands", type=int, default=1,
+                        help="Number of islands evolved in parallel processes by the genetic algorithm. Default 1.")
+    parser.add_argument("--constant-memory-excel", action="store_true",
+                        help="Stream the Excel workbooks to disk row by row instead of keeping them in memory.")
+    parser.add_argument("--fixture-database", default=None,
+                        help="Read and write the data in a SQLite fixture database created with bki_fixture_data "
+                             "instead of on the servers.")
+    args = parser.parse_args(argv)
+
+    if args.fixture_database:
+        import bki_fixture_data
+        bki_fixture_data.use_fixture_database(args.fixture_database)
+
+    if args.worker:
+        run_worker(args.poll_interval, args.max_requests, args.processes, args.ga_islands, args.constant_memory_excel)
+    else:
+        # Claim a request from BKI_Datastore, the script exits if there are no requests
+        df_request = bf.claim_ds_blend_requests(1)
+        bf.get_exit_check(len(df_request))
+        process_claimed_request(df_request, args.ga_islands, args.constant_memory_excel)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
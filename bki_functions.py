@@ -2,14 +2,217 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import atexit
+import math
+import heapq
 import time
 import itertools
+import functools
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import bki_server_information as bsi
 import ti_price_opt as tpo
+import ti_flavor_surrogate as tfs
 
 
 
+# Results of queries from functions decorated with cached_query, while a query_cache() is active
+query_cache_results = None
+
+# Share query results within a block of code, e.g. a single ETL run
+@contextlib.contextmanager
+def query_cache():
+    """
+    Within the block, each function decorated with cached_query runs its query once for each set of arguments.
+    Later calls return a copy of the first result, so the functions depending on the same source data share it.
+    The results are discarded when the outermost block exits.
+    Can also be used as a decorator, @query_cache(), to cache queries for each call of a function.
+    """
+    global query_cache_results
+    outermost = query_cache_results is None
+    if outermost:
+        query_cache_results = {}
+    try:
+        yield
+    finally:
+        if outermost:
+            query_cache_results = None
+
+def cached_query(func):
+    """Decorator for functions returning a dataframe from a query, which is reused while a query_cache() is active."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if query_cache_results is None:
+            return func(*args, **kwargs)
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in query_cache_results:
+            query_cache_results[key] = func(*args, **kwargs)
+        return query_cache_results[key].copy()
+    return wrapper
+
+# Snapshots of slowly changing reference data, kept in memory between requests
+class SnapshotCache:
+    """
+    Snapshots of query results for reference data, which a long-running worker keeps between requests.
+    A snapshot is used without querying the source until it is older than its ttl. After that the probe of the
+    snapshot is called, which returns a small value that changes when the source tables change, e.g. the number of
+    rows and the highest timestamp. If the value is unchanged, the snapshot is used for another ttl seconds,
+    otherwise the query is run again. Snapshots without a probe are always reloaded after ttl seconds.
+    The cache can be used from several threads, e.g. readers called by read_concurrently. Each key has its own lock,
+    so a snapshot is probed or loaded by one thread at a time while the other threads wait for the result.
+    """
+
+    def __init__(self):
+        self.snapshots = {}
+        self.key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str, loader, ttl: float, probe=None) -> pd.DataFrame():
+        """Returns a copy of the snapshot with the input key, which is loaded with loader() if it is missing or outdated."""
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                snapshot = self.snapshots.get(key)
+            if snapshot is not None:
+                if time.monotonic() - snapshot["Loaded"] < ttl:
+                    return self.hit(snapshot)
+                if probe is not None:
+                    version = probe()
+                    with self.lock:
+                        self.probes += 1
+                    if version == snapshot["Version"]:
+                        with self.lock:
+                            snapshot["Loaded"] = time.monotonic()
+                        return self.hit(snapshot)
+            # Probe before loading, so changes made while loading are detected next time
+            version = probe() if probe is not None else None
+            snapshot = {"Data": loader(), "Version": version, "Loaded": time.monotonic()}
+            with self.lock:
+                self.snapshots[key] = snapshot
+                self.misses += 1
+            return snapshot["Data"].copy()
+
+    def hit(self, snapshot: dict) -> pd.DataFrame():
+        with self.lock:
+            self.hits += 1
+        return snapshot["Data"].copy()
+
+    def clear(self):
+        """Removes all snapshots."""
+        with self.lock:
+            self.snapshots.clear()
+
+    def statistics(self) -> str:
+        """Returns a text with the hit and miss statistics of the cache."""
+        return f"Reference data snapshots: {self.hits} hits, {self.misses} misses, {self.probes} change probes."
+
+reference_snapshots = SnapshotCache()
+
+def snapshot(ttl: float, probe=None):
+    """
+    Decorator for functions returning reference data from a query, which is kept in reference_snapshots.
+    Each set of arguments has its own snapshot. See SnapshotCache for ttl and probe.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = func.__name__ + repr(args) + repr(sorted(kwargs.items()))
+            return reference_snapshots.get(key, lambda: func(*args, **kwargs), ttl, probe)
+        return wrapper
+    return decorator
+
+# Implementations of the readers used instead of the queries on the servers, by name of the reader
+reader_backends = {}
+# Readers which can be given an implementation in reader_backends, by name
+readers = {}
+
+def reader(columns: dict = None, optional_columns: tuple = ()):
+    """
+    Decorator for functions reading source data from the servers. If an implementation of the reader is set in
+    reader_backends, e.g. by bki_fixture_data.use_fixture_database, it is called instead of the function,
+    and the dataframe it returns must have the declared columns and types, see check_reader_columns.
+    \n Parameters
+    ----------
+    columns : dict, optional
+        The columns returned by the reader and their dtypes. A dtype of None is not checked.
+        The default is None, which does not check the result.
+    optional_columns : tuple, optional
+        Columns which the reader only returns for some arguments. The default is ().
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            backend = reader_backends.get(func.__name__)
+            if backend is None:
+                return func(*args, **kwargs)
+            result = backend(*args, **kwargs)
+            if columns is not None:
+                check_reader_columns(func.__name__, result, columns, optional_columns)
+            return result
+        wrapper.columns = columns
+        readers[func.__name__] = wrapper
+        return wrapper
+    return decorator
+
+def check_reader_columns(name: str, df: pd.DataFrame(), columns: dict, optional_columns: tuple = ()):
+    """
+    Raises a ValueError if the input dataframe returned by an implementation of the reader with the input name
+    does not have the declared columns, or a column has another dtype than declared.
+    """
+    missing_columns = [column for column in columns if column not in df.columns and column not in optional_columns]
+    extra_columns = [column for column in df.columns if column not in columns]
+    wrong_dtypes = [f"{column} is {df[column].dtype}, expected {dtype}" for column, dtype in columns.items()
+                    if dtype is not None and column in df.columns and str(df[column].dtype) != dtype]
+    if missing_columns or extra_columns or wrong_dtypes:
+        raise ValueError(f"Columns returned by the implementation of {name} do not match the reader. "
+                         f"Missing: {missing_columns}, not declared: {extra_columns}, dtypes: {wrong_dtypes}")
+
+def set_reader_backends(backends: dict):
+    """
+    Replaces the implementations of the readers in reader_backends with the input dictionary of names and functions.
+    Raises a ValueError if a name is not a reader, so implementations of removed or renamed readers are found.
+    """
+    unknown_names = sorted(set(backends) - set(readers))
+    if unknown_names:
+        raise ValueError(f"Not readers in bki_functions: {', '.join(unknown_names)}")
+    reader_backends.clear()
+    reader_backends.update(backends)
+
+# Get a value which changes when any of the input Navision tables change
+def get_nav_tables_version(*tables: str) -> tuple:
+    """
+    Returns the number of rows and the highest timestamp of each of the input Navision tables,
+    e.g. 'Item' for [dbo].[BKI foods a_s$Item]. The timestamp column of Navision tables is a rowversion, which is
+    set on every insert and update, so inserts and edits change the highest timestamp and deletes change the count.
+    """
+    query = " UNION ALL ".join(f"""SELECT '{table}' AS [Tabel], COUNT_BIG(*) AS [Rækker]
+                                   ,MAX(CAST([timestamp] AS BIGINT)) AS [Version]
+                                   FROM [dbo].[BKI foods a_s${table}]""" for table in tables)
+    df = pd.read_sql(query, bsi.con_nav)
+    return tuple(df.itertuples(index=False, name=None))
+
+# Get a value which changes when grades are added to, edited in or removed from BKI_Datastore
+def get_tastings_version() -> tuple:
+    """
+    Returns the number of rows, the highest id and a checksum of the grades in cof.Smageskema.
+    cof.Smageskema has no rowversion, so edits of grades are detected by the checksum of the columns read by the
+    queries of grades, which is computed from all rows on the server.
+    """
+    query = """ SELECT COUNT_BIG(*) AS [Rækker], MAX([Id]) AS [Id]
+                ,CHECKSUM_AGG(BINARY_CHECKSUM([Id] ,[Dato] ,[Bruger] ,[Kontraktnummer] ,[Id_org] ,[Id_org_kildenummer]
+                    ,[Smagningstype] ,[Smag_Syre] ,[Smag_Krop] ,[Smag_Aroma] ,[Smag_Eftersmag] ,[Smag_Robusta]
+                    ,[Status])) AS [Checksum]
+                FROM [cof].[Smageskema] """
+    df = pd.read_sql(query, bsi.con_ds)
+    return tuple(df.itertuples(index=False, name=None))
+
 # Convert list into string for SQL IN operator
 def string_to_sql(list_with_values: list) -> str:
     """
@@ -29,6 +232,126 @@ def string_to_sql(list_with_values: list) -> str:
     else:
         return "'{}'".format("','".join(list_with_values))
 
+# Condition for SQL WHERE clauses to only include records from a given date
+def sql_since_filter(column: str, since=None) -> str:
+    """
+    Returns an AND condition for a SQL WHERE clause including records where column >= since.
+    If since is None an empty string is returned, which includes all records.
+    The date is written in ISO 8601 format, which SQL Server reads the same way regardless of language settings.
+    """
+    if since is None:
+        return ""
+    return f"AND {column} >= '{pd.Timestamp(since):%Y-%m-%dT%H:%M:%S}'"
+
+# Condition for SQL WHERE or HAVING clauses to only include records with a minimum value
+def sql_minimum_filter(expression: str, minimum: float = None, keyword: str = "AND") -> str:
+    """
+    Returns a condition for a SQL WHERE or HAVING clause including records where expression >= minimum,
+    preceded by keyword, e.g. AND or HAVING. If minimum is None an empty string is returned, which includes all records.
+    """
+    if minimum is None:
+        return ""
+    return f"{keyword} {expression} >= {float(minimum)}"
+
+# Run a query joining against a list of keys staged in a temporary table
+def read_sql_with_keys(query: str, con, keys: list, key_type: str = "VARCHAR(100)") -> pd.DataFrame():
+    """
+    Loads the unique values of a list of keys into the temporary table #Keys with the single column [Key],
+    and returns the result of a query that joins against #Keys as a pandas DataFrame.
+    Used instead of a literal IN list, so the size of the query does not grow with the number of keys.
+    The keys are inserted with fast_executemany, and the table is created, queried and dropped on the same connection.
+    \n Parameters
+    ----------
+    query : str
+        Query which uses #Keys, e.g. INNER JOIN #Keys AS K ON T.[Column] = K.[Key]
+    con : SQLAlchemy engine
+        Engine for the database to query.
+    keys : list
+        Values to load into #Keys. Missing values are skipped.
+    key_type : str, optional
+        The SQL type of [Key], which must be the type of the column joined against #Keys, so the join does not
+        convert the column and can use its indexes. Keys are converted to integers for INT and BIGINT and to
+        strings for other types. The default is "VARCHAR(100)".
+    """
+    integer_keys = key_type.upper() in ("INT", "BIGINT")
+    collation = "" if integer_keys else " COLLATE DATABASE_DEFAULT"
+    unique_keys = [(key,) for key in dict.fromkeys(int(key) if integer_keys else str(key)
+                                                   for key in keys if not pd.isna(key))]
+    with con.connect() as connection:
+        cursor = connection.connection.cursor()
+        cursor.execute(f"""IF OBJECT_ID('tempdb..#Keys') IS NOT NULL DROP TABLE #Keys;
+                          CREATE TABLE #Keys ([Key] {key_type}{collation} PRIMARY KEY) """)
+        if unique_keys:
+            cursor.fast_executemany = True
+            cursor.executemany("INSERT INTO #Keys ([Key]) VALUES (?)", unique_keys)
+        df = pd.read_sql(query, connection)
+        cursor.execute("DROP TABLE #Keys")
+        cursor.close()
+    return df
+
+
+# Call functions returning dataframes from queries at the same time
+def read_concurrently(functions: dict, max_workers: int = None) -> dict:
+    """
+    Calls each function in the input dictionary in a pool of threads and returns a dictionary with the same keys
+    and the values returned by the functions. The queries wait on the database servers at the same time,
+    so the total time is close to the time of the slowest query instead of the sum of all queries.
+    The time spent on each function is printed.
+    \n Parameters
+    ----------
+    functions : dict
+        Dictionary with names and functions that take no arguments.
+    max_workers : int, optional
+        The maximum number of threads. The default is None, which uses one thread per function.
+    """
+    def timed_call(function):
+        start_time = time.perf_counter()
+        result = function()
+        return result, time.perf_counter() - start_time
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(functions), 1)) as executor:
+        futures = {name: executor.submit(timed_call, function) for name, function in functions.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    print("Query times: " + ", ".join(f"{name} {seconds:.2f}s" for name, (_, seconds) in results.items()))
+
+    return {name: result for name, (result, _) in results.items()}
+
+# Columns stored as categoricals in the dataframes returned by the readers
+category_columns = ["Kontraktnummer", "Sort", "Lokation"]
+
+# Set column types of a dataframe returned by a query
+def set_column_types(df: pd.DataFrame(), order_columns: list = (), grade_columns: list = ()) -> pd.DataFrame():
+    """
+    Normalizes and types the columns of a dataframe once when it is loaded, so the readers return the same types
+    every time and merges and groupbys downstream work on compact columns.
+    Kontraktnummer is upper cased to prevent join issues, and the columns in category_columns are converted to categoricals.
+    Columns which are not in the dataframe are ignored.
+    \n Parameters
+    ----------
+    df : pd.DataFrame()
+        Dataframe returned by pd.read_sql. The columns are converted in place and the dataframe is returned.
+    order_columns : list, optional
+        Columns with order numbers or ids, converted to nullable integers. Values which are not numbers become <NA>,
+        and the number of these values is written into the log.
+    grade_columns : list, optional
+        Columns with grades, converted to float64. Grades are not downcast, so they keep the values stored in the
+        database and samples built from them are identical whichever way they are built.
+    """
+    if "Kontraktnummer" in df.columns:
+        df["Kontraktnummer"] = df["Kontraktnummer"].astype(object).str.upper() # Upper case to prevent join issues
+    for column in df.columns.intersection(category_columns):
+        df[column] = df[column].astype("category")
+    for column in df.columns.intersection(order_columns):
+        order_numbers = pd.to_numeric(df[column], errors="coerce").astype("Int64")
+        # Rows with order numbers which are not numbers drop out of later joins, so the number is logged
+        number_coerced = int((order_numbers.isna() & df[column].notna()).sum())
+        if number_coerced:
+            log_insert("set_column_types", f"{number_coerced} values of {column} are not numbers and are set to <NA>.")
+        df[column] = order_numbers
+    for column in df.columns.intersection(grade_columns):
+        df[column] = df[column].astype(np.float64)
+    return df
+
 
 # Check if script is supposed to exit. 0 value = exit
 def get_exit_check(value: int):
@@ -38,12 +361,125 @@ def get_exit_check(value: int):
     else:
         pass
 
+# Records for a table in BKI_Datastore, written in batches
+class LogBuffer:
+    """
+    Collects records for a table in BKI_Datastore and inserts them in batches with a single executemany,
+    instead of a pandas to_sql with table reflection for each record.
+    The records are written when max_records are collected, by a timer max_seconds after the first record
+    is added to the buffer, when flush() is called, and when the interpreter exits.
+    """
+
+    def __init__(self, schema: str, table: str, max_records: int = 50, max_seconds: float = 10):
+        self.schema = schema
+        self.table = table
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self.records = []
+        self.first_added = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, record: dict):
+        """Adds a record with keys matching field names in the table, and writes the buffer if it is full or old."""
+        with self.lock:
+            if not self.records:
+                self.first_added = time.monotonic()
+            self.records.append(record)
+            self.start_timer()
+            full = len(self.records) >= self.max_records or time.monotonic() - self.first_added >= self.max_seconds
+        if full:
+            self.flush()
+
+    def start_timer(self):
+        """Starts a timer writing the buffer after max_seconds, unless one is running. Call with the lock held."""
+        # A timer inherited by a forked process is not running in the new process, so a new one is started
+        if self.timer is None or not self.timer.is_alive():
+            self.timer = threading.Timer(self.max_seconds, self.flush_in_background)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush_in_background(self):
+        """Writes the buffer from the timer. Errors are printed, and the records are written by the next flush."""
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Records for [{self.schema}].[{self.table}] could not be written: {e!r}")
+
+    def flush(self):
+        """
+        Writes all collected records. If the insert fails, the records are kept, a new attempt is made when
+        the timer runs out, and the error is raised.
+        """
+        with self.lock:
+            records, self.records = self.records, []
+        if not records:
+            return
+        try:
+            with bsi.con_ds.begin() as connection:
+                # Records with the same fields are inserted with one statement
+                for columns, group in itertools.groupby(records, key=lambda record: tuple(record)):
+                    query = f"""INSERT INTO [{self.schema}].[{self.table}] ({",".join(f"[{column}]" for column in columns)})
+                                VALUES ({",".join("?" * len(columns))})"""
+                    connection.exec_driver_sql(query, [tuple(record.values()) for record in group])
+        except Exception:
+            with self.lock:
+                self.records = records + self.records
+                self.first_added = time.monotonic()
+                self.timer = None
+                self.start_timer()
+            raise
+
+    def clear(self):
+        """
+        Discards the collected records without writing them. Used in a forked process, where the records
+        inherited from the parent process are written by the parent. The lock is replaced, as it may have been
+        held by another thread of the parent when the process was forked.
+        """
+        self.lock = threading.Lock()
+        self.records = []
+        self.first_added = None
+        self.timer = None
+
+log_buffers = {
+    "Log": LogBuffer("dbo", "Log")
+    ,"Email_log": LogBuffer("cof", "Email_log")}
+
+# Write all buffered log records into BKI_Datastore
+def flush_logs():
+    """Writes all records buffered by log_insert and insert_into_email_log into BKI_Datastore."""
+    for log_buffer in log_buffers.values():
+        log_buffer.flush()
+
+# Discard the log records inherited by a forked process
+def clear_logs():
+    """Discards the records buffered by log_insert and insert_into_email_log, see LogBuffer.clear."""
+    for log_buffer in log_buffers.values():
+        log_buffer.clear()
+
+# Write the buffered log records when the interpreter exits
+def flush_logs_at_exit():
+    """Writes all buffered log records. Errors are printed, as there is no caller to handle them at exit."""
+    try:
+        flush_logs()
+    except Exception as e:
+        print(f"Log records could not be written at exit: {e!r}")
+
+atexit.register(flush_logs_at_exit)
+
 # Write into dbo.log
-def log_insert(event: str, note: str):
-    """Inserts a record into BKI_Datastore dbo.log with event and note."""
+def log_insert(event: str, note: str, flush: bool = False):
+    """
+    Inserts a record into BKI_Datastore dbo.log with event and note.
+    The record is buffered and written in a batch, see LogBuffer and flush_logs.
+    Use flush=True to write the record and any buffered records at once, e.g. when a script starts,
+    so the record gets the time it was logged.
+    """
     dict_log = {"Note": note
                 ,"Event": event}
-    pd.DataFrame(data=dict_log, index=[0]).to_sql("Log", con=bsi.con_ds, schema="dbo", if_exists="append", index=False)
+    log_buffers["Log"].add(dict_log)
+    if flush:
+        log_buffers["Log"].flush()
 
 # Write dataframe into Excel sheet
 def insert_dataframe_into_excel (engine, dataframe, sheetname: str, include_index: bool = False):
@@ -59,7 +495,46 @@ def insert_dataframe_into_excel (engine, dataframe, sheetname: str, include_inde
     include_index : bool
         True if index is supposed to be included in insert into Excel, False if not.
     """
-    dataframe.to_excel(engine, sheet_name=sheetname, index=include_index)
+    # pandas writes a sheet column by column, which loses data when the workbook only keeps the current row in memory
+    if getattr(engine.book, "constant_memory", False):
+        write_dataframe_rows(engine, dataframe, sheetname, include_index)
+    else:
+        dataframe.to_excel(engine, sheet_name=sheetname, index=include_index)
+
+# Create Excel engine for a workbook
+def create_excel_writer(path: str, constant_memory: bool = False) -> pd.ExcelWriter:
+    """
+    Returns an xlsxwriter Excel engine for a new workbook.
+    \n Parameters
+    ----------
+    path : str
+        Path of the workbook.
+    constant_memory : bool, optional
+        If True, each row is written to disk when the next row is started, so the memory used does not grow
+        with the size of the sheets. Sheets must then be written in one pass, which insert_dataframe_into_excel does.
+        The default is False.
+    """
+    options = {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss"} if constant_memory else {}
+    return pd.ExcelWriter(path, engine="xlsxwriter", engine_kwargs={"options": options})
+
+# Write dataframe into Excel sheet one row at a time
+def write_dataframe_rows(engine, dataframe, sheetname: str, include_index: bool = False):
+    """
+    Inserts a dataframe into a new Excel sheet one row at a time, with a header row formatted as by pandas.
+    Used for workbooks in constant_memory mode, where rows must be written in order. Missing values are left blank.
+    Parameters are the same as for insert_dataframe_into_excel.
+    """
+    header = [str(column) for column in dataframe.columns]
+    if include_index:
+        # Unnamed index levels get an empty header, as when pandas writes the sheet
+        header = ["" if name is None else str(name) for name in dataframe.index.names] + header
+        dataframe = dataframe.reset_index()
+    worksheet = engine.book.add_worksheet(sheetname)
+    header_format = engine.book.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    worksheet.write_row(0, 0, header, header_format)
+    values = dataframe.astype(object).where(dataframe.notna(), None)
+    for row_number, row in enumerate(values.itertuples(index=False, name=None), 1):
+        worksheet.write_row(row_number, 0, row)
 
 # Update BKI_Datastore with input ID with a new status
 def update_request_log(request_id: int, status: int, filename: str = "", filepath: str = ""):
@@ -83,14 +558,13 @@ def update_request_log(request_id: int, status: int, filename: str = "", filepat
 # Write into section log
 def insert_into_email_log(dictionary: dict):
     """
-    Writes into BKI_Datastore cof.Receptforslag_log. \n
+    Writes into BKI_Datastore cof.Email_log. The record is buffered and written in a batch, see LogBuffer and flush_logs. \n
     Parameters
     ----------
     dictionary : dict
         Dictionary containing keys matching field names in table in the database.
     """
-    df = pd.DataFrame(data= dictionary ,index= [0])
-    df.to_sql("Email_log", con=bsi.con_ds, schema="cof", if_exists="append", index=False)
+    log_buffers["Email_log"].add(dict(dictionary))
 
 # Compare two dataframes with specified columns and see if dataframe 2 is missing any values compared to dataframe 1
 def get_list_of_missing_values(df_total:pd.DataFrame(), total_column_name:str, df_compare:pd.DataFrame(), compare_column_name:str) -> list:
@@ -120,6 +594,7 @@ def get_list_of_missing_values(df_total:pd.DataFrame(), total_column_name:str, d
     return missing_values
 
 # Get a calculated price of a given input recipe
+@reader()
 def get_recipe_calculated_costs(recipe:str) -> float:
     """
     Returns a dictionary with calculated prices for the input recipe.
@@ -159,9 +634,17 @@ def get_recipe_calculated_costs(recipe:str) -> float:
     return prices 
 
 # Get information from coffee contracts from Navision
-def get_coffee_contracts() -> pd.DataFrame():
+@reader({"Kontraktnummer": "category", "Metode": None, "Sort": "category", "Mærkningsordning": None
+         ,"Differentiale": "float64", "Varenavn": None, "Kostpris": "float64", "Standard Cost": "float64"
+         ,"Forecast Unit Cost +1M": "float64", "Forecast Unit Cost +2M": "float64", "Forecast Unit Cost +3M": "float64"
+         ,"Fairtrade": "int64", "Økologi": "int64", "Rainforest": "int64", "Konventionel": "int64", "Kaffetype": None})
+@snapshot(600, functools.partial(get_nav_tables_version, "Purchase Header", "Purchase Line", "Item", "PROBAT Item"
+                                  ,"Forecast Item Unit Cost"))
+def get_coffee_contracts(certifications: dict = None) -> pd.DataFrame():
     """
     Returns information from Navision for coffee contracts as a Pandas DataFrame.
+    If certifications is given, only contracts fulfilling the criteria are returned,
+    see get_contract_certification_conditions.
     """
     query = """ SELECT PH.[No_] AS [Kontraktnummer]
         	,CASE WHEN PH.[Washed Coffee] = 1 THEN 'Vasket'
@@ -192,13 +675,44 @@ def get_coffee_contracts() -> pd.DataFrame():
 				AND I.[No_] NOT LIKE '1012%'
 				AND I.[Sub Product Group Code] NOT IN ('111','112')
 				AND I.[Withdrawal Status] <> 2 """
-    df = pd.read_sql(query, bsi.con_nav)
+    # Filter on the calculated certification columns, if any certifications are excluded
+    conditions = get_contract_certification_conditions(certifications)
+    if conditions:
+        query = f""" SELECT * FROM ({query}) AS C
+                     WHERE {" AND ".join(conditions)} """
+    df = set_column_types(pd.read_sql(query, bsi.con_nav))
     
     # Ensure forecast unit costs have a value, just punish the blend enough that it's obvious that there is an issue with prices
     df[["Forecast Unit Cost +1M","Forecast Unit Cost +2M","Forecast Unit Cost +3M"]].fillna(999, inplace=True)
     return df
 
+# Get conditions for contracts based on certifications and composition
+def get_contract_certification_conditions(certifications: dict = None) -> list:
+    """
+    Returns a list of SQL conditions for the columns calculated in get_coffee_contracts.
+    Certifications with the value 0 are excluded, and Sammensætning 'Ren Arabica' or 'Ren Robusta'
+    only includes the given type of coffee. Returns an empty list if certifications is None.
+    \n Parameters
+    ----------
+    certifications : dict
+        A dctionary with keys == Fairtrade,Konventionel,Rainforest,Sammensætning,Økologi 0/1 whether to include or not
+    """
+    conditions = []
+    if certifications is None:
+        return conditions
+    for certification in ["Fairtrade","Økologi","Rainforest","Konventionel"]:
+        if certifications[certification] == 0:
+            conditions.append(f"C.[{certification}] = 0")
+    # Remove or add Arabica/Robusta if chosen
+    if certifications["Sammensætning"] == "Ren Arabica":
+        conditions.append("C.[Kaffetype] = 'A'")
+    if certifications["Sammensætning"] == "Ren Robusta":
+        conditions.append("C.[Kaffetype] = 'R'")
+    return conditions
+
 # Get masterdata for recipes (green coffee blends)
+@reader({"Receptnummer": None, "Farve sætpunkt": None, "Mærkningsordning": None})
+@snapshot(600, functools.partial(get_nav_tables_version, "PROBAT Item", "Item"))
 def get_recipe_information() -> pd.DataFrame():
     """
     Returns masterdata for recipes (blends of green coffee) as a pandas DataFrame.
@@ -214,6 +728,10 @@ def get_recipe_information() -> pd.DataFrame():
 
 
 # Get all records for grades given to green coffe
+@reader({"Dato": "datetime64[ns]", "Bruger": None, "Kontraktnummer": "category", "Modtagelse": None, "Smagningstype": None
+         ,"Syre": "float64", "Krop": "float64", "Aroma": "float64", "Eftersmag": "float64", "Robusta": "float64"})
+@cached_query
+@snapshot(300, get_tastings_version)
 def get_gc_grades() -> pd.DataFrame():
     """
     Returns all grades given to green coffees as a pandas DataFrame.
@@ -235,20 +753,24 @@ def get_gc_grades() -> pd.DataFrame():
             WHERE S.[Kontraktnummer] IS NOT NULL
             	AND COALESCE(S.[Smag_Syre],S.[Smag_Krop],S.[Smag_Aroma],S.[Smag_Eftersmag],S.[Smag_Robusta]) IS NOT NULL
             AND S.[Status] = 1 """
-    df = pd.read_sql(query, bsi.con_ds)
-    df["Kontraktnummer"] = df["Kontraktnummer"].str.upper() # Upper case to prevent join issues
+    df = set_column_types(pd.read_sql(query, bsi.con_ds), grade_columns=["Syre","Krop","Aroma","Eftersmag","Robusta"])
     return df
 
 # Get all records for grades given to finished goods
-def get_finished_goods_grades() -> pd.DataFrame():
+@reader({"Dato": "datetime64[ns]", "Bruger": None, "Ordrenummer": "Int64", "Syre": "float64", "Krop": "float64"
+         ,"Aroma": "float64", "Eftersmag": "float64", "Robusta": "float64", "Status": None, "Bemærkning": None
+         ,"Silo": None})
+@cached_query
+def get_finished_goods_grades(since=None) -> pd.DataFrame():
     """
     Returns all grades given to finished goods as a pandas DataFrame.
     Records are included whether or not the finished product has been approved or rejected.
     Any given order number 'ordrenummer' may have multiple records related to it.
     Only one of the grading-parameters need to be used for a record to be included.
     Grading done for all of syre, krop, aroma, eftersmag, robusta is not guarenteed.
+    If since is given, only grades given on or after this date are returned.
     """
-    query = """ SELECT S.[Dato] ,S.[Bruger] ,S.[Referencenummer] AS [Ordrenummer]
+    query = f""" SELECT S.[Dato] ,S.[Bruger] ,S.[Referencenummer] AS [Ordrenummer]
         	,S.[Smag_Syre] AS [Syre] ,S.[Smag_Krop] AS [Krop] ,S.[Smag_Aroma] AS [Aroma]
         	,S.[Smag_Eftersmag] AS [Eftersmag] ,S.[Smag_Robusta] AS [Robusta]
         	,CASE WHEN S.[Status] = 1 THEN 'Godkendt' WHEN S.[Status] = 0 THEN 'Afvist'
@@ -263,43 +785,54 @@ def get_finished_goods_grades() -> pd.DataFrame():
             	AND S.[Referencenummer] IS NOT NULL
                 AND S.[Varenummer] NOT LIKE '1090%'
                 AND S.[Smagningstype] = 4
-                AND S.[Id_org_kildenummer] <> 10 """
-    df = pd.read_sql(query, bsi.con_ds)
+                AND S.[Id_org_kildenummer] <> 10
+                {sql_since_filter("S.[Dato]", since)} """
+    df = set_column_types(pd.read_sql(query, bsi.con_ds), ["Ordrenummer"], ["Syre","Krop","Aroma","Eftersmag","Robusta"])
     return df
 
+# Columns of the readers of relationships between orders
+order_relationship_columns = {"Ordre": "Int64", "Relateret ordre": "Int64"}
+
 # Get all related orders from Navision for orders which have been given a grade
-def get_nav_order_related() -> pd.DataFrame():
+@reader(order_relationship_columns)
+@cached_query
+def get_nav_order_related(since=None) -> pd.DataFrame():
     """
     Returns a set of orders and the directly related orders from Navision returned as a pandas DataFrame.
+    If since is given, only orders graded on or after this date are included.
     """
-    # Get dataframe with orders given grades, convert til liste and string used for SQL query.
-    df_orders = get_finished_goods_grades()
+    # Get dataframe with orders given grades and convert to list of keys used for SQL query.
+    df_orders = get_finished_goods_grades(since)
     graded_orders_list = df_orders["Ordrenummer"].unique().tolist()
-    po_sql_string = string_to_sql(graded_orders_list)
     # Get related orders from Navision
-    query_nav_order_related = f""" SELECT [Prod_ Order No_] AS [Ordre]
-                                   ,[Reserved Prod_ Order No_] AS [Relateret ordre]
-                                   FROM [dbo].[BKI foods a_s$Reserved Prod_ Order No_]
-                                   WHERE [Prod_ Order No_] IN ({po_sql_string})
-                                   AND [Invalid] = 0 """
-    df_nav_order_related = pd.read_sql(query_nav_order_related, bsi.con_nav)
+    query_nav_order_related = """ SELECT RPO.[Prod_ Order No_] AS [Ordre]
+                                  ,RPO.[Reserved Prod_ Order No_] AS [Relateret ordre]
+                                  FROM [dbo].[BKI foods a_s$Reserved Prod_ Order No_] AS RPO
+                                  INNER JOIN #Keys AS K
+                                      ON RPO.[Prod_ Order No_] = K.[Key]
+                                  WHERE RPO.[Invalid] = 0 """
+    # Order numbers are text fields of 20 characters in Navision, and integers in Probat
+    df_nav_order_related = set_column_types(read_sql_with_keys(query_nav_order_related, bsi.con_nav, graded_orders_list
+                                                               ,"VARCHAR(20)")
+                                            ,["Ordre","Relateret ordre"])
     return df_nav_order_related
 
 # Get all related orders from Probat for remainder of orders, which have no reservations in Navision
-def get_probat_orders_related() -> pd.DataFrame():
+@reader(order_relationship_columns)
+@cached_query
+def get_probat_orders_related(since=None) -> pd.DataFrame():
     """
     Returns a set of orders and the directly related orders from Probat returned as a pandas DataFrame.
     Only returns orders which have no relationships defined in Navision
+    If since is given, only orders graded on or after this date are included.
     """
     # Get a list of orders which do not have valid relationships defined in Navision
-    orders_to_search = get_list_of_missing_values(get_finished_goods_grades()
+    orders_to_search = get_list_of_missing_values(get_finished_goods_grades(since)
                                                   ,"Ordrenummer"
-                                                  ,get_nav_order_related()
+                                                  ,get_nav_order_related(since)
                                                   ,"Ordre")
-    # Convert list to a string valid for SQL query
-    sql_search_string = string_to_sql(orders_to_search)
 
-    query = f""" WITH CTE_ORDERS AS (
+    query = """ WITH CTE_ORDERS AS (
                 SELECT [ORDER_NAME] AS [Ordre] ,[S_ORDER_NAME] AS [Relateret ordre]
                 FROM [dbo].[PRO_EXP_ORDER_SEND_PG]
                 WHERE [S_ORDER_NAME] <> 'Retour Ground' AND [ORDER_NAME] <> ''
@@ -310,17 +843,21 @@ def get_probat_orders_related() -> pd.DataFrame():
                 WHERE [S_ORDER_NAME] <> 'Retour Ground' AND [ORDER_NAME] <> ''
                 GROUP BY [ORDER_NAME],[S_ORDER_NAME]
                 )
-                SELECT *
+                SELECT CTE_ORDERS.*
                 FROM CTE_ORDERS
-                WHERE [Ordre] IN ({sql_search_string}) """
-    df = pd.read_sql(query, bsi.con_probat)
+                INNER JOIN #Keys AS K
+                    ON CTE_ORDERS.[Ordre] = K.[Key] """
+    df = set_column_types(read_sql_with_keys(query, bsi.con_probat, orders_to_search, "INT"), ["Ordre","Relateret ordre"])
     return df
 
 # Get roasting orders from grinding orders from Probat
-def get_order_relationships() -> pd.DataFrame():
+@reader(order_relationship_columns)
+@cached_query
+def get_order_relationships(since=None) -> pd.DataFrame():
     """
     Adds roasting orders to the complete dataframe with Navision and Probat related orders.
     Returns a new dataframe with roasting orders added
+    If since is given, only orders graded on or after this date are included.
     """
     # Read all orders from Probat. Roasting orders are unioned to ease data transformation in final df.
     query = """ SELECT [ORDER_NAME],[S_ORDER_NAME]
@@ -332,9 +869,9 @@ def get_order_relationships() -> pd.DataFrame():
                 FROM [dbo].[PRO_EXP_ORDER_UNLOAD_R]
                 WHERE [ORDER_NAME] IS NOT NULL
                 GROUP BY [ORDER_NAME],[ORDER_NAME] """
-    df_orders = pd.read_sql(query, bsi.con_probat)
+    df_orders = set_column_types(pd.read_sql(query, bsi.con_probat), ["ORDER_NAME","S_ORDER_NAME"])
     # Get a dataframe with Probat and Navision relationships unioned.
-    df_orders_total = pd.concat([get_nav_order_related(), get_probat_orders_related()])
+    df_orders_total = pd.concat([get_nav_order_related(since), get_probat_orders_related(since)])
     # Left join roasting orders on df_orders_total
     df_with_roasting_orders = pd.merge(
                                 df_orders_total
@@ -351,38 +888,43 @@ def get_order_relationships() -> pd.DataFrame():
 
 
 # Get input coffees used for roasting orders identified
-def get_roaster_input() -> pd.DataFrame():
+@reader({"Dato": "datetime64[ns]", "Rister": None, "Produktionsordre id": "Int64", "Batch id": "Int64"
+         ,"Kilde silo": None, "Kontraktnummer": "category", "Modtagelse": None, "Sortnummer i silo": None
+         ,"Kilo": "float64"})
+def get_roaster_input(since=None) -> pd.DataFrame():
     """
     Returns the input of green coffee used for roasting orders identified as used in a finished product.
+    If since is given, only roasting orders used in finished products graded on or after this date are included.
     """
-    # Get dataframe, list and concatenated string for sql with relevant order numbers
-    df_orders = get_order_relationships()
+    # Get dataframe and list with relevant order numbers
+    df_orders = get_order_relationships(since)
     orders_list = df_orders["Relateret ordre"].unique().tolist()
-    orders_sql = string_to_sql(orders_list)
     # Query Probat for records
-    query = f""" SELECT	[RECORDING_DATE] AS [Dato] ,[DESTINATION] AS [Rister]
-                ,[PRODUCTION_ORDER_ID] AS [Produktionsordre id]
-                ,[BATCH_ID] AS [Batch id],[SOURCE] AS [Kilde silo]
-                ,[S_CONTRACT_NO] AS [Kontraktnummer],[S_DELIVERY_NAME] AS [Modtagelse]
-                ,[S_TYPE_CELL] AS [Sortnummer i silo] ,[WEIGHT] / 1000.0 AS [Kilo]
-                FROM [dbo].[PRO_EXP_ORDER_LOAD_R]
-                WHERE [ORDER_NAME] IN ({orders_sql}) """
-    df = pd.read_sql(query, bsi.con_probat)
-    df["Kontraktnummer"] = df["Kontraktnummer"].str.upper() # Upper case to prevent join issues
+    query = """ SELECT	LR.[RECORDING_DATE] AS [Dato] ,LR.[DESTINATION] AS [Rister]
+                ,LR.[PRODUCTION_ORDER_ID] AS [Produktionsordre id]
+                ,LR.[BATCH_ID] AS [Batch id],LR.[SOURCE] AS [Kilde silo]
+                ,LR.[S_CONTRACT_NO] AS [Kontraktnummer],LR.[S_DELIVERY_NAME] AS [Modtagelse]
+                ,LR.[S_TYPE_CELL] AS [Sortnummer i silo] ,LR.[WEIGHT] / 1000.0 AS [Kilo]
+                FROM [dbo].[PRO_EXP_ORDER_LOAD_R] AS LR
+                INNER JOIN #Keys AS K
+                    ON LR.[ORDER_NAME] = K.[Key] """
+    df = set_column_types(read_sql_with_keys(query, bsi.con_probat, orders_list, "INT"), ["Produktionsordre id","Batch id"])
     return df
 
 
 # Get input coffees used for roasting orders identified
-def get_roaster_output() -> pd.DataFrame():
+@reader({"Produktionsordre id": "Int64", "Batch id": "Int64", "Ordrenummer": "Int64", "Receptnummer": None
+         ,"Kilo": "float64", "Silo": None})
+def get_roaster_output(since=None) -> pd.DataFrame():
     """
     Returns the output of roasting orders identified as used in a finished product.
+    If since is given, only roasting orders used in finished products graded on or after this date are included.
     """
-    # Get dataframe, list and concatenated string for sql with relevant order numbers
-    df_orders = get_order_relationships()
+    # Get dataframe and list with relevant order numbers
+    df_orders = get_order_relationships(since)
     orders_list = df_orders["Relateret ordre"].unique().tolist()
-    orders_sql = string_to_sql(orders_list)
     # Query Probat for records
-    query = f""" WITH G AS (
+    query = """ WITH G AS (
                 SELECT LG.[S_PRODUCT_ID] ,MAX(ULG.[DEST_NAME]) AS [Silo]
                 FROM [dbo].[PRO_EXP_ORDER_LOAD_G] AS LG
                 INNER JOIN [dbo].[PRO_EXP_ORDER_UNLOAD_G] AS ULG
@@ -401,10 +943,12 @@ def get_roaster_output() -> pd.DataFrame():
                 ,ULR.[Ordrenummer] ,ULR.[Receptnummer] ,ULR.[Kilo]
                 ,COALESCE(G.[Silo],ULR.[Silo]) AS [Silo]
                 FROM ULR
+                INNER JOIN #Keys AS K
+                    ON ULR.[Ordrenummer] = K.[Key]
                 LEFT JOIN G
-                	ON ULR.[S_PRODUCT_ID] = G.[S_PRODUCT_ID]
-                WHERE ULR.[Ordrenummer] IN ({orders_sql}) """
-    df = pd.read_sql(query, bsi.con_probat)
+                	ON ULR.[S_PRODUCT_ID] = G.[S_PRODUCT_ID] """
+    df = set_column_types(read_sql_with_keys(query, bsi.con_probat, orders_list, "INT")
+                          ,["Produktionsordre id","Batch id","Ordrenummer"])
     return df
 
 
@@ -417,23 +961,63 @@ def get_roaster_output() -> pd.DataFrame():
 # =============================================================================
 
 
+# Columns of the readers of blend requests from cof.Receptforslag_log. Dato is text in some databases.
+blend_request_columns = {"Id": "int64", "Dato": None, "Bruger_email": None, "Syre": "float64", "Aroma": "float64"
+                         ,"Krop": "float64", "Eftersmag": "float64", "Robusta": None, "Farve": None, "Receptnummer": None
+                         ,"Aggreger_til_sortniveau": "int64", "Låst_komponent": None, "Låst_komponent_proportion": None
+                         ,"Sammensætning": None, "Inkluder_konventionel": "int64", "Inkluder_fairtrade": "int64"
+                         ,"Inkluder_økologi": "int64", "Inkluder_rainforest": "int64", "Lager_siloer": "int64"
+                         ,"Lager_warehouse": "int64", "Lager_havn": "int64", "Lager_spot": "int64", "Lager_afloat": "int64"
+                         ,"Lager_udland": "int64", "Minimum_lager": None, "Status": "int64", "Filsti": None, "Filnavn": None}
+# Columns of the readers of available coffee, from Navision and with deliveries from Probat
+available_quantity_columns = {"Kontraktnummer": "category", "Lokation": "category", "Beholdning": "float64"}
+delivery_quantity_columns = {"Lokation": "category", "Kontraktnummer": "category", "Modtagelse": None, "Beholdning": "float64"}
+
 # Read top 1 record of blend request log
-def get_ds_blend_request() -> pd.DataFrame():
+@reader(blend_request_columns)
+def get_ds_blend_request(exit_if_empty: bool = True) -> pd.DataFrame():
     """
     Returns a pandas dataframe with the top 1 record from BKI_Datastore which has not been started or completed.
     Returns columns from database with same names as they exist in source table.
-    If no non-started or non-completed records exists, sys.exit() is called to terminate script.
+    If no non-started or non-completed records exists, sys.exit() is called to terminate script,
+    unless exit_if_empty is False in which case an empty dataframe is returned.
     """
     query = "SELECT TOP 1 * FROM [cof].[Receptforslag_log] WHERE [Status] = 0"
     df = pd.read_sql(query, bsi.con_ds)
     # Call function to exit script if no data exists from query
-    get_exit_check(len(df))
+    if exit_if_empty:
+        get_exit_check(len(df))
     # If script has not been terminated, return dataframe with data
     return df
 
-def get_spot_available_quantities() -> pd.DataFrame():
-    """Returns a dataframe with all available coffee from SPOT."""
-    query = """ SELECT PL.[Document No_] AS [Kontraktnummer],PL.[Location Code] AS [Lokation]
+@reader(blend_request_columns)
+def claim_ds_blend_requests(number_of_requests: int = 1) -> pd.DataFrame():
+    """
+    Claims up to number_of_requests records from BKI_Datastore which have not been started, oldest first.
+    The records are set to status 1 and returned in the same statement, so concurrent processes never claim the same record.
+    Records locked by another process are skipped. Returns an empty dataframe if no records could be claimed.
+    Parameters
+    ----------
+    number_of_requests : int, optional
+        The maximum number of records to claim. The default is 1.
+    """
+    query = f"""WITH [Requests] AS (
+                    SELECT TOP ({int(number_of_requests)}) *
+                    FROM [cof].[Receptforslag_log] WITH (ROWLOCK, READPAST, UPDLOCK)
+                    WHERE [Status] = 0
+                    ORDER BY [Id])
+                UPDATE [Requests]
+                SET [Status] = 1
+                OUTPUT inserted.* """
+    with bsi.con_ds.begin() as con:
+        result = con.execute(query)
+        df = pd.DataFrame(result.fetchall(), columns=result.keys())
+    return df.sort_values("Id").reset_index(drop=True)
+
+@reader(available_quantity_columns)
+def get_spot_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from SPOT, optionally only rows with at least min_quantity."""
+    query = f""" SELECT PL.[Document No_] AS [Kontraktnummer],PL.[Location Code] AS [Lokation]
                     ,PL.[Outstanding Quantity] AS [Beholdning]
             FROM [dbo].[BKI foods a_s$Purchase Line] AS PL
             INNER JOIN [dbo].[BKI foods a_s$Purchase Header] AS PH
@@ -443,6 +1027,7 @@ def get_spot_available_quantities() -> pd.DataFrame():
             WHERE PL.[Type] = 2	AND PL.[Location Code] = 'SPOT'
             	AND PL.[Outstanding Quantity] > 0 AND PH.[Kontrakt] = 1
             	AND I.[Item Category Code] = 'RÅKAFFE'
+                {sql_minimum_filter("PL.[Outstanding Quantity]", min_quantity)}
             UNION ALL
             SELECT ILE.[Coffee Batch No_] ,ILE.[Location Code]
                 ,SUM(ILE.[Remaining Quantity]) AS [Qty]
@@ -451,26 +1036,30 @@ def get_spot_available_quantities() -> pd.DataFrame():
             	ON ILE.[Item No_]= I.[No_]
             WHERE ILE.[Remaining Quantity] > 0 AND ILE.[Location Code] = 'SPOT'
             	AND I.[Item Category Code] = 'RÅKAFFE'
-            GROUP BY ILE.[Coffee Batch No_] ,ILE.[Location Code] """
-    df = pd.read_sql(query, bsi.con_nav)
+            GROUP BY ILE.[Coffee Batch No_] ,ILE.[Location Code]
+            {sql_minimum_filter("SUM(ILE.[Remaining Quantity])", min_quantity, "HAVING")} """
+    df = set_column_types(pd.read_sql(query, bsi.con_nav))
     return df
 
-def get_havn_available_quantities() -> pd.DataFrame():
-    """Returns a dataframe with all available coffee from AARHUSHAVN & EKSLAGER2."""
-    query = """ SELECT ILE.[Coffee Batch No_] AS [Kontraktnummer]
+@reader(available_quantity_columns)
+def get_havn_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from AARHUSHAVN & EKSLAGER2, optionally only rows with at least min_quantity."""
+    query = f""" SELECT ILE.[Coffee Batch No_] AS [Kontraktnummer]
                 ,'AARHUSHAVN' AS [Lokation] ,SUM(ILE.[Remaining Quantity]) AS [Beholdning]
             FROM [dbo].[BKI foods a_s$Item Ledger Entry] AS ILE
             INNER JOIN [dbo].[BKI foods a_s$Item] AS I
             	ON ILE.[Item No_]= I.[No_]
             WHERE ILE.[Remaining Quantity] > 0 AND ILE.[Location Code] IN ('AARHUSHAVN','EKSLAGER2')
             	AND I.[Item Category Code] = 'RÅKAFFE'
-            GROUP BY ILE.[Coffee Batch No_] """
-    df = pd.read_sql(query, bsi.con_nav)
+            GROUP BY ILE.[Coffee Batch No_]
+            {sql_minimum_filter("SUM(ILE.[Remaining Quantity])", min_quantity, "HAVING")} """
+    df = set_column_types(pd.read_sql(query, bsi.con_nav))
     return df
 
-def get_udland_available_quantities() -> pd.DataFrame():
-    """ Returns a dataframe with all available coffee from Udland."""
-    query = """ SELECT PL.[Document No_] AS [Kontraktnummer],PL.[Location Code] AS [Lokation]
+@reader(available_quantity_columns)
+def get_udland_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """ Returns a dataframe with all available coffee from Udland, optionally only rows with at least min_quantity."""
+    query = f""" SELECT PL.[Document No_] AS [Kontraktnummer],PL.[Location Code] AS [Lokation]
                     ,PL.[Outstanding Quantity] AS [Beholdning]
             FROM [dbo].[BKI foods a_s$Purchase Line] AS PL
             INNER JOIN [dbo].[BKI foods a_s$Purchase Header] AS PH
@@ -479,46 +1068,56 @@ def get_udland_available_quantities() -> pd.DataFrame():
             	ON PL.[No_] = I.[No_]
             WHERE PL.[Type] = 2	AND PL.[Location Code] = 'UDLAND'
             	AND PL.[Outstanding Quantity] > 0 AND PH.[Kontrakt] = 1
-            	AND I.[Item Category Code] = 'RÅKAFFE' """
-    df = pd.read_sql(query, bsi.con_nav)
+            	AND I.[Item Category Code] = 'RÅKAFFE'
+                {sql_minimum_filter("PL.[Outstanding Quantity]", min_quantity)} """
+    df = set_column_types(pd.read_sql(query, bsi.con_nav))
     return df
 
-def get_afloat_available_quantities() -> pd.DataFrame():
-    """Returns a dataframe with all available coffee from AARHUSHAVN & EKSLAGER2."""
-    query = """ SELECT ILE.[Coffee Batch No_] AS [Kontraktnummer]
+@reader(available_quantity_columns)
+def get_afloat_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from AFLOAT, optionally only rows with at least min_quantity."""
+    query = f""" SELECT ILE.[Coffee Batch No_] AS [Kontraktnummer]
                 ,ILE.[Location Code] AS [Lokation] ,SUM(ILE.[Remaining Quantity]) AS [Beholdning]
             FROM [dbo].[BKI foods a_s$Item Ledger Entry] AS ILE
             INNER JOIN [dbo].[BKI foods a_s$Item] AS I
             	ON ILE.[Item No_]= I.[No_]
             WHERE ILE.[Remaining Quantity] > 0 AND ILE.[Location Code] = 'AFLOAT'
             	AND I.[Item Category Code] = 'RÅKAFFE'
-            GROUP BY ILE.[Coffee Batch No_] ,ILE.[Location Code] """
-    df = pd.read_sql(query, bsi.con_nav)
+            GROUP BY ILE.[Coffee Batch No_] ,ILE.[Location Code]
+            {sql_minimum_filter("SUM(ILE.[Remaining Quantity])", min_quantity, "HAVING")} """
+    df = set_column_types(pd.read_sql(query, bsi.con_nav))
     return df
 
 
-def get_silos_available_quantities() -> pd.DataFrame():
-    """Returns a dataframe with all available coffee from 000 and 200-silos from Probat."""
-    query = """ SELECT  'SILOER' AS [Lokation] ,[Kontrakt] AS [Kontraktnummer]
+@reader(delivery_quantity_columns)
+def get_silos_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from 000 and 200-silos from Probat, optionally only rows with at least min_quantity."""
+    query = f""" SELECT  'SILOER' AS [Lokation] ,[Kontrakt] AS [Kontraktnummer]
             ,[Modtagelse] ,SUM([Kilo]) AS [Beholdning]
             FROM [dbo].[Newest total inventory]
             WHERE [Placering] = '0000' OR [Placering] LIKE '2__'
             AND [Varenummer] NOT IN ('10204401','10204403','10204440','10204450','10204970','10204460','10209999')
-            GROUP BY [Kontrakt],[Modtagelse] """
-    df = pd.read_sql(query, bsi.con_probat)
+            GROUP BY [Kontrakt],[Modtagelse]
+            {sql_minimum_filter("SUM([Kilo])", min_quantity, "HAVING")} """
+    df = set_column_types(pd.read_sql(query, bsi.con_probat))
     return df
 
-def get_warehouse_available_quantities() -> pd.DataFrame():
-    """Returns a dataframe with all available coffee from Warehouse from Probat."""
-    query = """ SELECT  'WAREHOUSE' AS [Lokation] ,[Kontrakt] AS [Kontraktnummer]
+@reader(delivery_quantity_columns)
+def get_warehouse_available_quantities(min_quantity: float = None) -> pd.DataFrame():
+    """Returns a dataframe with all available coffee from Warehouse from Probat, optionally only rows with at least min_quantity."""
+    query = f""" SELECT  'WAREHOUSE' AS [Lokation] ,[Kontrakt] AS [Kontraktnummer]
             ,[Modtagelse] ,SUM([Kilo]) AS [Beholdning]
             FROM [dbo].[Newest total inventory]
             WHERE [Placering] = 'Warehouse'
             AND [Varenummer] NOT IN ('10204401','10204403','10204440','10204450','10204970','10204460','10209999')
-            GROUP BY [Kontrakt],[Modtagelse] """
-    df = pd.read_sql(query, bsi.con_probat)
+            GROUP BY [Kontrakt],[Modtagelse]
+            {sql_minimum_filter("SUM([Kilo])", min_quantity, "HAVING")} """
+    df = set_column_types(pd.read_sql(query, bsi.con_probat))
     return df
 
+@reader({"Kontraktnummer": None, "Syre": "float64", "Aroma": "float64", "Krop": "float64", "Eftersmag": "float64"
+         ,"Robusta": "float64"})
+@snapshot(600, functools.partial(get_nav_tables_version, "Coffee Taste Profile", "Purchase Header", "Purchase Line"))
 def get_target_cupping_profiles() -> pd.DataFrame():
     """Returns a dataframe containing all target cupping profiles from Navision.
        Table id 27 = Item, 39 = purchase header."""
@@ -557,12 +1156,13 @@ def get_all_available_quantities(location_filter: dict, min_quantity: float, cer
     ----------
     location_filter : dict
         A dictionary with keys == SPOT,AARHUSHAVN,UDLAND,AFLOAT,SILOER,WAREHOUSE. 0/1 whether to include or not.
-        This criteria is used for filtering before any aggregation is done to the data.
+        Only locations with the value 1 are queried.
     min_quantity : float
         The minimum quantity that must be available for a contract to be considered for use.
-        This criteria is used for filtering before any aggregation is done to the data.
+        This criteria is used in the query of each location, before any aggregation is done to the data.
     certifications : dict
         A dctionary with keys == Fairtrade,Konventionel,Rainforest,Sammensætning,Økologi 0/1 whether to include or not
+        This criteria is used in the query of the contracts.
     aggregate : bool
         Boolean indicating whether or not to aggregate data before it is returned.
         If aggregated, several columns that are contract specific will be changed to 'n/a'.
@@ -574,26 +1174,37 @@ def get_all_available_quantities(location_filter: dict, min_quantity: float, cer
         Cupping profiles are found in the following order:
         Mean grades per kontrakt/modtagelse --> Mean grades per Kontrakt --> Target values from Navision.
     """
+    location_queries = {
+        "SPOT": get_spot_available_quantities
+        ,"AARHUSHAVN": get_havn_available_quantities
+        ,"UDLAND": get_udland_available_quantities
+        ,"AFLOAT": get_afloat_available_quantities
+        ,"SILOER": get_silos_available_quantities
+        ,"WAREHOUSE": get_warehouse_available_quantities}
+    # Only query the enabled locations, and only contracts with the requested certifications
+    locations = [location for location in location_queries if location_filter.get(location) == 1]
+    certification_conditions = get_contract_certification_conditions(certifications)
+    queries = {location: functools.partial(location_queries[location], min_quantity) for location in locations}
+    queries["Grades"] = get_gc_grades
+    queries["Target profiles"] = get_target_cupping_profiles
+    queries["Contracts"] = functools.partial(get_coffee_contracts, certifications)
+    # Query inventory locations, grades, target profiles and contracts at the same time
+    query_results = read_concurrently(queries)
     # Create dataframe with all available coffees
-    df = pd.concat([
-        get_spot_available_quantities()
-        ,get_havn_available_quantities()
-        ,get_udland_available_quantities()
-        ,get_afloat_available_quantities()
-        ,get_silos_available_quantities()
-        ,get_warehouse_available_quantities()
-        ])
+    inventory_columns = ["Kontraktnummer","Lokation","Beholdning","Modtagelse"]
+    if locations:
+        df = pd.concat([query_results[location] for location in locations]).reindex(columns=inventory_columns)
+    else:
+        df = pd.DataFrame(columns=inventory_columns, dtype=object)
     df["Modtagelse"].fillna(value="", inplace=True)
-    df["Kontraktnummer"] = df["Kontraktnummer"].str.upper() # Upper case to prevent join issues
-    # Map dictionary to dataframe and filter dataframe on locations and min. available amounts
-    df["Lokation_filter"] = df["Lokation"].map(location_filter)
-    df = df.loc[(df["Lokation_filter"] == 1) & (df["Beholdning"] >= min_quantity)]
+    # Categories differ between locations, so the concatenated columns are converted again
+    df = set_column_types(df)
 
     # Read green coffee grades into dataframe and calculate mean values
-    df_grades = get_gc_grades()
+    df_grades = query_results["Grades"]
     df_grades["Modtagelse"].fillna(value="", inplace=True)
     # Calculate mean value grouped by kontrakt and modtagelse, merge with original dataframe
-    df_grades_del = df_grades.groupby(["Kontraktnummer","Modtagelse"], dropna=False).agg(
+    df_grades_del = df_grades.groupby(["Kontraktnummer","Modtagelse"], dropna=False, observed=True).agg(
         {"Syre": "mean"
         ,"Krop": "mean"
         ,"Aroma": "mean"
@@ -607,7 +1218,7 @@ def get_all_available_quantities(location_filter: dict, min_quantity: float, cer
         ,on= ["Kontraktnummer","Modtagelse"]
         )
     # Calculate mean value grouped by kontrakt, merge with original dataframe
-    df_grades_con = df_grades.groupby(["Kontraktnummer"], dropna=False).agg(
+    df_grades_con = df_grades.groupby(["Kontraktnummer"], dropna=False, observed=True).agg(
         {"Syre": "mean"
         ,"Krop": "mean"
         ,"Aroma": "mean"
@@ -621,7 +1232,7 @@ def get_all_available_quantities(location_filter: dict, min_quantity: float, cer
         ,on= "Kontraktnummer"
         )
     # Get target values from Navision and add to dataframe
-    df_grades_targets = get_target_cupping_profiles()
+    df_grades_targets = query_results["Target profiles"]
     df = pd.merge(
         left = df
         ,right = df_grades_targets
@@ -637,27 +1248,16 @@ def get_all_available_quantities(location_filter: dict, min_quantity: float, cer
     df.dropna(subset=["Syre","Aroma","Krop","Eftersmag"],inplace=True)
     df["Robusta"].fillna(10, inplace=True)
     df.reset_index(drop=True, inplace=True)
-    # Add information regarding certifications of each contract
-    df_contract_info = get_coffee_contracts()
+    # Add information regarding certifications of each contract. If contracts are filtered on certifications,
+    # coffees without a contract fulfilling the criteria are removed.
+    df_contract_info = query_results["Contracts"]
     df = pd.merge(
         left = df
         ,right = df_contract_info
         ,how = "left"
         ,on= "Kontraktnummer")
-    # Filter dataframe down to relevant rows for certifications. If include == False, only then filter
-    if certifications["Fairtrade"] == 0:
-        df = df.loc[(df["Fairtrade"] == 0)]
-    if certifications["Økologi"] == 0:
-        df = df.loc[(df["Økologi"] == 0)]
-    if certifications["Rainforest"] == 0:
-        df = df.loc[(df["Rainforest"] == 0)]
-    if certifications["Konventionel"] == 0:
-        df = df.loc[(df["Konventionel"] == 0)]
-    # Remove or add Arabica/Robusta if chosen
-    if certifications["Sammensætning"] == "Ren Arabica":
-        df = df.loc[(df["Kaffetype"] == "A")]
-    if certifications["Sammensætning"] == "Ren Robusta":
-        df = df.loc[(df["Kaffetype"] == "R")]
+    if certification_conditions:
+        df = df.loc[df["Kontraktnummer"].isin(df_contract_info["Kontraktnummer"])]
     # Remove specific items that should never be included, defined by item numbers.
     customer_item_numbers = ["10104210","10104211","10104212","10104213"    # Sofiero
                              ,"10104310","10104311","10104312"              # Wilson
@@ -669,7 +1269,7 @@ def get_all_available_quantities(location_filter: dict, min_quantity: float, cer
     # Remove any unnecesary columns from dataframe | Sofiero, SLOW, Wilson
     df.drop(["Syre_x","Aroma_x","Krop_x","Eftersmag_x","Robusta_x"
              ,"Syre_y","Aroma_y","Krop_y","Eftersmag_y","Robusta_y"
-             ,"Lokation_filter","Metode"
+             ,"Metode"
              ,"Fairtrade","Økologi","Rainforest","Konventionel","Kaffetype"]
             ,inplace=True, axis=1)
     # If the available amounts are requested as aggregated values, do this
@@ -680,7 +1280,7 @@ def get_all_available_quantities(location_filter: dict, min_quantity: float, cer
         # Calculate the flavor profiles as a weighted value
         df = df.groupby(["Kontraktnummer","Modtagelse","Lokation","Differentiale","Kostpris","Standard Cost"
                          ,"Forecast Unit Cost +1M","Forecast Unit Cost +2M","Forecast Unit Cost +3M","Sort","Varenavn"
-                         ,"Screensize","Oprindelsesland","Mærkningsordning"], dropna=False).agg(
+                         ,"Screensize","Oprindelsesland","Mærkningsordning"], dropna=False, observed=True).agg(
                              {"Beholdning": "sum"
                               ,"Syre": "sum"
                               ,"Aroma": "sum"
@@ -694,8 +1294,27 @@ def get_all_available_quantities(location_filter: dict, min_quantity: float, cer
 # Get identical recipes
 def get_identical_recipes(syre: int, aroma: int, krop: int, eftersmag: int) -> pd.DataFrame():
     """Returns a pandas dataframe with identical recipes when compared to input parameters.
-    Also returns similar recipes where ABS(diff) for each parameter is allowed to be 1."""
-    query = f"""WITH CP AS (
+    Also returns similar recipes where ABS(diff) for each parameter is allowed to be 1.
+    The recipes are filtered from the snapshot of get_recipe_cupping_profiles."""
+    df = get_recipe_cupping_profiles()
+    differences = (df[["Aroma","Syre","Eftersmag","Krop"]] - [aroma, syre, eftersmag, krop]).abs()
+    identical = (differences == 0).all(axis=1)
+    similar = (differences <= 1).all(axis=1) & (differences.sum(axis=1) > 0)
+    df = pd.concat([
+        df.loc[identical].assign(Sammenligning="Identisk")
+        ,df.loc[similar].assign(Sammenligning="Lignende")
+        ], ignore_index=True)
+    return df
+
+# Get cupping profiles for all recipes
+@reader({"Receptnummer": None, "Beskrivelse": None, "Mærkningsordning": None, "Kostpris": "float64"
+         ,"Kost uden tillæg, gas mm.": "float64", "Farve": None, "Syre": "float64", "Krop": "float64"
+         ,"Aroma": "float64", "Eftersmag": "float64", "Robusta": "float64"})
+@snapshot(600, functools.partial(get_nav_tables_version, "Coffee Taste Profile", "PROBAT Item", "Item"
+                                  ,"Production BOM Version", "Production BOM Line"))
+def get_recipe_cupping_profiles() -> pd.DataFrame():
+    """Returns a pandas dataframe with the target cupping profile, color and costs of all recipes."""
+    query = """WITH CP AS (
             SELECT [Table ID] ,[No_] ,[0] AS [Syre] ,[1] AS [Aroma]
             	,[2] AS [Krop] ,[3] AS [Eftersmag],[4] AS [Robusta]
             FROM (
@@ -737,22 +1356,7 @@ def get_identical_recipes(syre: int, aroma: int, krop: int, eftersmag: int) -> p
             	,I.[Mærkningsordning] ,I.[Standard Cost] AS [Kostpris]
 				,I.[Standard Cost] - T.[Cost of not coffee] AS [Kost uden tillæg, gas mm.]
             	,PRI.[COLOR] AS [Farve] ,CP.[Syre] ,CP.[Aroma] ,CP.[Krop]
-            	,CP.[Eftersmag] ,CP.[Robusta] ,'Identisk' AS [Sammenligning]
-            FROM CP
-            INNER JOIN [dbo].[BKI foods a_s$PROBAT Item] AS PRI
-            	ON CP.[No_] = PRI.[CUSTOMER_CODE]
-            INNER JOIN [dbo].[BKI foods a_s$Item] AS I
-            	ON CP.[No_] = I.[No_]
-			LEFT JOIN TILLÆG AS T
-				ON I.[Production BOM No_] = T.[Production BOM No_]
-            WHERE PRI.[ZONE] = 2 AND CP.[Aroma] = {aroma} AND CP.[Syre] = {syre}
-            	AND CP.[Eftersmag] = {eftersmag} AND CP.[Krop] = {krop}
-            UNION ALL
-            SELECT I.[No_] AS [Receptnummer] ,I.[Description] AS [Beskrivelse]
-            	,I.[Mærkningsordning] ,I.[Standard Cost] AS [Kostpris]
-				,I.[Standard Cost] - T.[Cost of not coffee] AS [Kost uden tillæg, gas mm.]
-            	,PRI.[COLOR] AS [Farve] ,CP.[Syre] ,CP.[Aroma] ,CP.[Krop]
-            	,CP.[Eftersmag] ,CP.[Robusta],'Lignende'
+            	,CP.[Eftersmag] ,CP.[Robusta]
             FROM CP
             INNER JOIN [dbo].[BKI foods a_s$PROBAT Item] AS PRI
             	ON CP.[No_] = PRI.[CUSTOMER_CODE]
@@ -760,45 +1364,17 @@ def get_identical_recipes(syre: int, aroma: int, krop: int, eftersmag: int) -> p
             	ON CP.[No_] = I.[No_]
 			LEFT JOIN TILLÆG AS T
 				ON I.[Production BOM No_] = T.[Production BOM No_]
-            WHERE PRI.[ZONE] = 2
-            	AND ABS(CP.[Aroma] - {aroma} ) <= 1
-            	AND ABS(CP.[Syre] - {syre} ) <= 1
-            	AND ABS(CP.[Eftersmag] - {eftersmag} ) <= 1
-            	AND ABS(CP.[Krop] - {krop} ) <= 1
-            	AND ( ABS(CP.[Aroma] - {aroma} ) + ABS(CP.[Syre] - {syre} ) + 
-                      ABS(CP.[Eftersmag] - {eftersmag} ) + ABS(CP.[Krop] - {krop} ) ) > 0"""
+            WHERE PRI.[ZONE] = 2 """
     df = pd.read_sql(query, bsi.con_nav)
     return df
 
-def get_blends_with_proportions(required_item:int, min_proportion:int, available_items:list, number_of_components:int) -> list:
+def get_locked_component_proportions(min_proportion:int, number_of_components:int) -> np.ndarray:
     """
-    Creates all possible combinations of available components and the required item with their respective proportions.
+    Returns all the proportion combinations for blends with a required item and the input number of components.
+    The proportion of the required item is the last proportion of each combination, followed by padding with 0.
     Proportions are created in increments of 5, and the input min_proportion will be rounded to nearest multiple of 5.
-    The following cases will yield and empty list due to lack of data or to prevent excessive amounts of data.
-    - If more components are requested than coffee is avalable
-    - If >6 components and >8 available items
-    - If >5 components and >10 available items
-    - If >4 components and >15 available items
-    Parameters
-    ----------
-    required_item : int
-        The item which is required to be part of all the created blends.
-    min_proportion : int
-        The min proportion which the required item must have.
-        The required item will be in blends with proportions between this value are the theoretical max value.
-        If this value is not input as an increment of 5, it will be rounded
-    available_items : list
-        A list of all the possible components to be included in the blends.
-        The required item must be part of this list as well.
-    number_of_components : int
-        The number of components which the blend must have.
-        Must be a value between 2 and 7.
-
-    Returns
-    -------
-    A list of all possible blends that can be created with the input items and their respective proportions
+    Returns a float32 array of shape (n, 7).
     """
-    
     if min_proportion < 5:
         min_proportion = 5
     elif min_proportion > 95:
@@ -806,22 +1382,8 @@ def get_blends_with_proportions(required_item:int, min_proportion:int, available
     elif min_proportion % 5:
         min_proportion = round(min_proportion / 5 ,0) * 5
 
-    
-    # Create padding for component index and their proportions to ensure all blends have the required dimensions
-    padding_placeholder = (7 - number_of_components) * [-1]
-    padding_proportions = (7 - number_of_components) * [0] 
-
-    number_of_available_items = len(available_items)
-    # If a blend recommendation is requested with more components than components are available, terminate.
-    # Terminate if the theoretical amount of records to calculate across exceeds ~3 milion
-    if number_of_components > number_of_available_items or number_of_components < 2:
-        return []
-    if number_of_components > 6 and number_of_available_items > 8:
-        return []
-    if number_of_components > 5 and number_of_available_items > 10:
-        return []
-    if number_of_components > 4 and number_of_available_items > 15:
-        return []
+    # Create padding for proportions to ensure all blends have the required dimensions
+    padding_proportions = (7 - number_of_components) * [0]
 
     # Dictionary with lists of possible percentages for components that are not that main component - hardcoded increments
     # Min proportion of a component is 5, and all component proportions are incremented by 5.
@@ -832,43 +1394,310 @@ def get_blends_with_proportions(required_item:int, min_proportion:int, available
         ,5: [i / 100.0 for i in range(5, 86 - min_proportion, 5)]
         ,6: [i / 100.0 for i in range(5, 81 - min_proportion, 5)]
         ,7: [i / 100.0 for i in range(5, 76 - min_proportion, 5)]}
-  
-    # Remove the requested contract from the list of possible contracts
-    available_items = [item for item in available_items if item != required_item]  
-    
+
     # Proportion for the requested component will always be the last element in the list of proportions
     # Get all possible proportion combinations
     proportions = [list(comb) for comb in itertools.combinations_with_replacement(ranges_proportions_remaining_items[number_of_components], number_of_components -1)]
-    
+
     # Create a list of missing proportions such that each blend will sum to 100
     missing_proportions = [round(1.0 - sum(props),2) for props in proportions]
     proportions = list(zip(missing_proportions, proportions))
     # Append the requested component proportion to the list of proportions.
     [props[1].append(props[0]) for props in proportions]
     # Only keep the proportion combinations which sum to 100 and prop >= requested proportion
-    proportions = [props[1] for props in proportions if sum(props[1]) == 1.0 and props[1][-1] >= min_proportion / 100.0]   
-    proportions = [props + padding_proportions for props in proportions]
-    # Get all possible blend combinations
-    blends = [list(contract) for contract in itertools.permutations(available_items, number_of_components -1)]
-    # Add requested blend item as last value in blends to correspond with proportions
-    blends = [blend + [required_item] for blend in blends]
-    blends = [blend + padding_placeholder for blend in blends]
-    
-    # Combine proportions and contracts into final list
-    blends_prop = list(itertools.product(blends, proportions))
-    blends_prop = [list(zip(blends_prop[i][0],blends_prop[i][1])) for i in range(len(blends_prop))]
-    blends_prop = [blend for blend in blends_prop]  
-    
-    return blends_prop
+    proportions = [props[1] for props in proportions if sum(props[1]) == 1.0 and props[1][-1] >= min_proportion / 100.0]
+    proportions = np.array([props + padding_proportions for props in proportions], dtype=np.float32).reshape(-1, 7)
+
+    return proportions
+
+
+def count_blends_with_proportions(required_item:int, min_proportion:int, available_items:list, number_of_components:int) -> int:
+    """
+    Returns the number of blends iter_blends_with_proportions yields for the same input, without creating any blends.
+    """
+    number_of_other_items = len([item for item in available_items if item != required_item])
+    if number_of_components > len(available_items) or number_of_components < 2:
+        return 0
+    number_of_proportions = len(get_locked_component_proportions(min_proportion, number_of_components))
+    return math.perm(number_of_other_items, number_of_components -1) * number_of_proportions
+
+
+def iter_blends_with_proportions(required_item:int, min_proportion:int, available_items:list, number_of_components:int
+                                 ,chunk_size:int = 100000):
+    """
+    Generator which yields all possible combinations of available components and the required item with their
+    respective proportions in chunks of BlendArrays. The blends are yielded in the same order as they are returned
+    by get_blends_with_proportions, but only one chunk of blends is held in memory at a time.
+    Proportions are created in increments of 5, and the input min_proportion will be rounded to nearest multiple of 5.
+    Nothing is yielded if more components are requested than coffee is available.
+    Parameters
+    ----------
+    required_item : int
+        The item which is required to be part of all the created blends.
+    min_proportion : int
+        The min proportion which the required item must have.
+    available_items : list
+        A list of all the possible components to be included in the blends.
+        The required item must be part of this list as well.
+    number_of_components : int
+        The number of components which the blend must have.
+        Must be a value between 2 and 7.
+    chunk_size : int, optional
+        The approximate number of blends in each yielded chunk. All proportion combinations for a combination
+        of contracts are always kept in the same chunk.
+        The default is 100000.
 
+    Yields
+    -------
+    BlendArrays with the next chunk of blends.
+    """
+    if number_of_components > len(available_items) or number_of_components < 2:
+        return
 
-def get_fitting_blends(blends, prices, flavor_model, flavors_components, target_flavor, target_color:int, cut_off_value:float = 0.75)->list:
+    proportions = get_locked_component_proportions(min_proportion, number_of_components)
+    if len(proportions) == 0:
+        return
+    # Remove the requested contract from the list of possible contracts
+    available_items = [item for item in available_items if item != required_item]
+
+    # Get possible blend combinations lazily, a chunk of contract combinations at a time
+    contract_permutations = itertools.permutations(available_items, number_of_components -1)
+    permutations_per_chunk = max(1, chunk_size // len(proportions))
+    while True:
+        blends = np.array(list(itertools.islice(contract_permutations, permutations_per_chunk)), dtype=np.int16) \
+            .reshape(-1, number_of_components -1)
+        if len(blends) == 0:
+            return
+        # Add requested blend item as last value in blends to correspond with proportions, and add padding
+        blends = np.hstack((blends
+                            ,np.full((len(blends), 1), required_item, dtype=np.int16)
+                            ,np.full((len(blends), 7 - number_of_components), -1, dtype=np.int16)))
+        # Combine proportions and contracts, all proportions are repeated for each combination of contracts
+        yield tpo.BlendArrays(
+            np.repeat(blends, len(proportions), axis=0)
+            ,np.tile(proportions, (len(blends), 1)))
+
+
+def get_flavor_proxy_margin(required_item:int, min_proportion:int, available_items:list
+                            ,fitness_context:tpo.FitnessContext, sample_size:int = 3000, safety_factor:float = 1.5
+                            ,seed:int = 0, surrogate:tfs.FlavorSurrogate = None) -> float:
+    """
+    Returns the margin used with a flavor surrogate as a proxy for the flavor model in
+    iter_pruned_blends_with_proportions. A random sample of the blends which can be created for the input is
+    predicted by the flavor model, and the margin is the largest difference between a predicted flavor and the
+    surrogate flavor of the blend, multiplied by safety_factor as the sample does not contain every blend.
+    If no surrogate is given, the weighted average flavor of the blend is used.
+    """
+    rng = np.random.default_rng(seed)
+    other_items = np.array([item for item in available_items if item != required_item], dtype=np.int64)
+    flavors = np.asarray(fitness_context.candidates, dtype=np.float64)
+    if surrogate is None:
+        surrogate = tfs.FlavorSurrogate.weighted_average(flavors.shape[1])
+    numbers_of_components = [i for i in range(2, 8) if count_blends_with_proportions(required_item, min_proportion, available_items, i)]
+    if not numbers_of_components:
+        return 0.0
+    indices, proportions = [], []
+    for number_of_components in numbers_of_components:
+        component_proportions = get_locked_component_proportions(min_proportion, number_of_components)
+        n = sample_size // len(numbers_of_components)
+        blend_indices = np.full((n, 7), -1, dtype=np.int64)
+        blend_indices[:, :number_of_components - 1] = [rng.choice(other_items, number_of_components - 1, replace=False) for _ in range(n)]
+        blend_indices[:, number_of_components - 1] = required_item
+        indices.append(blend_indices)
+        proportions.append(component_proportions[rng.integers(len(component_proportions), size=n)])
+    blends = tpo.BlendArrays(np.concatenate(indices), np.concatenate(proportions))
+    predicted_flavors = fitness_context.flavor_model.predict(tpo.blends_model_input(blends, flavors, fitness_context.color))
+    surrogate_flavors = surrogate.predict_blends(blends, flavors, fitness_context.color)
+    return float(np.abs(predicted_flavors - surrogate_flavors).max() * safety_factor)
+
+
+def iter_pruned_blends_with_proportions(required_item:int, min_proportion:int, available_items:list, number_of_components:int
+                                        ,fitness_context:tpo.FitnessContext, cut_off_value:float, proxy_margin:float = 1.0
+                                        ,min_fitness = None, chunk_size:int = 100000, deadline:float = None
+                                        ,statistics:dict = None, surrogate:tfs.FlavorSurrogate = None):
+    """
+    Generator which yields the same blends as iter_blends_with_proportions, in the same order, except blends which
+    cheap bounds show cannot be fitting. The contracts are chosen one position at a time, and all proportion
+    combinations are tracked for each partial blend, so a partial blend is given up as soon as none of its
+    proportion combinations can lead to a fitting blend.
+    A proportion combination is given up when
+    - the surrogate flavor of the blend, used as a linear proxy for the flavor model, can not get within
+      cut_off_value + proxy_margin of the target for every flavor, whichever contracts fill the remaining positions.
+      Each contract adds its proportion times its surrogate contribution, see tfs.FlavorSurrogate, so the bound
+      only needs the smallest and largest contribution of the remaining contracts.
+    - the fitness can not reach min_fitness, even if the flavor matches perfectly and the remaining positions get
+      the cheapest contract. The fitness is at most 1 minus the cost part, see tpo.blend_fitness_batch.
+    Only the remaining blends need to be predicted by the flavor model.
+    Parameters
+    ----------
+    required_item, min_proportion, available_items, number_of_components :
+        Same as for iter_blends_with_proportions.
+    fitness_context : tpo.FitnessContext
+        Context with the flavors, scaled prices and target flavor used for the bounds.
+    cut_off_value : float
+        The max difference allowed between the predicted flavor and the target for each flavor.
+    proxy_margin : float, optional
+        How much the surrogate flavor may differ more from the target than cut_off_value, as the flavor
+        model does not predict the surrogate exactly. The default is 1.0.
+    min_fitness : callable, optional
+        Function returning the lowest fitness still of interest, called while searching so the bound can tighten
+        as fitting blends are found. The default is None, which does not bound the cost.
+    chunk_size : int, optional
+        The approximate number of blends in each yielded chunk. The default is 100000.
+    deadline : float, optional
+        time.time() value after which the search stops. The default is None, which never stops.
+    statistics : dict, optional
+        Dictionary updated with the number of 'Possible' blends, the number of 'Candidates' yielded and whether
+        the search was 'Stopped' by the deadline.
+    surrogate : tfs.FlavorSurrogate, optional
+        The surrogate of the flavor model. The default is None, which uses the weighted average flavor of the blend.
+
+    Yields
+    -------
+    BlendArrays with the next chunk of blends.
+    """
+    statistics = {} if statistics is None else statistics
+    statistics.update({"Possible": count_blends_with_proportions(required_item, min_proportion, available_items, number_of_components)
+                       ,"Candidates": 0
+                       ,"Stopped": False})
+    if statistics["Possible"] == 0:
+        return
+    proportions = get_locked_component_proportions(min_proportion, number_of_components).astype(np.float64)
+    other_items = np.array([item for item in available_items if item != required_item], dtype=np.int64)
+    if surrogate is None:
+        surrogate = tfs.FlavorSurrogate.weighted_average(np.shape(fitness_context.candidates)[1])
+    # The surrogate flavor of a blend is the sum of the proportion weighted contributions plus the intercept
+    flavors = surrogate.contributions(fitness_context.candidates)
+    prices = np.asarray(fitness_context.scaled_prices, dtype=np.float64).reshape(-1)
+    target = np.asarray(fitness_context.target, dtype=np.float64) - surrogate.intercept(fitness_context.color)
+    tolerance = cut_off_value + proxy_margin
+    # The remaining positions are filled with other contracts, so their contributions and prices are within these limits
+    flavor_min, flavor_max = flavors[other_items].min(axis=0), flavors[other_items].max(axis=0)
+    price_min = prices[other_items].min()
+    last_position = number_of_components - 2
+    # Proportion still to be filled after each position, per proportion combination
+    remaining = proportions[:, :last_position + 1][:, ::-1].cumsum(axis=1)[:, ::-1] - proportions[:, :last_position + 1]
+
+    chunk_indices, chunk_proportions = [], []
+    chunk_length = 0
+    padding = np.full(7 - number_of_components, -1, dtype=np.int64)
+
+    def within_bounds(flavor_sums, costs, remaining_proportion):
+        # Bounds for proportion combinations, with remaining_proportion still to be filled
+        remaining_proportion = remaining_proportion[..., None]
+        possible = ((flavor_sums + remaining_proportion * flavor_min <= target + tolerance)
+                    & (flavor_sums + remaining_proportion * flavor_max >= target - tolerance)).all(axis=-1)
+        if min_fitness is not None:
+            possible &= 1 - (costs + remaining_proportion[..., 0] * price_min) * 0.005 >= min_fitness() - 1e-9
+        return possible
+
+    def search(position, used, rows, flavor_sums, costs):
+        # Yields the candidate blends for a partial blend with the contracts in used at the first positions
+        nonlocal chunk_length
+        if deadline is not None and time.time() > deadline:
+            statistics["Stopped"] = True
+            return
+        items = other_items[~np.isin(other_items, used)]
+        row_proportions = proportions[rows, position]
+        new_flavor_sums = flavor_sums[None] + row_proportions[None, :, None] * flavors[items][:, None, :]
+        new_costs = costs[None] + row_proportions[None] * prices[items][:, None]
+        possible = within_bounds(new_flavor_sums, new_costs, np.broadcast_to(remaining[rows, position], new_costs.shape))
+        if position == last_position:
+            # Full blends, in the order of the contracts at the last position and then of the proportions
+            item_numbers, row_numbers = np.nonzero(possible)
+            if len(item_numbers):
+                blend_indices = np.empty((len(item_numbers), 7), dtype=np.int64)
+                blend_indices[:, :position] = used
+                blend_indices[:, position] = items[item_numbers]
+                blend_indices[:, position + 1] = required_item
+                blend_indices[:, position + 2:] = padding
+                chunk_indices.append(blend_indices)
+                chunk_proportions.append(proportions[rows[row_numbers]])
+                chunk_length += len(item_numbers)
+            if chunk_length >= chunk_size:
+                yield flush_chunk()
+            return
+        for item_number in np.flatnonzero(possible.any(axis=1)):
+            row_numbers = np.flatnonzero(possible[item_number])
+            yield from search(position + 1
+                              ,used + [items[item_number]]
+                              ,rows[row_numbers]
+                              ,new_flavor_sums[item_number, row_numbers]
+                              ,new_costs[item_number, row_numbers])
+            if statistics["Stopped"]:
+                return
+
+    def flush_chunk():
+        nonlocal chunk_indices, chunk_proportions, chunk_length
+        blends = tpo.BlendArrays(np.concatenate(chunk_indices), np.concatenate(chunk_proportions))
+        statistics["Candidates"] += chunk_length
+        chunk_indices, chunk_proportions, chunk_length = [], [], 0
+        return blends
+
+    # The required item is always the last component, so its part of flavor and cost is known from the start
+    rows = np.arange(len(proportions))
+    required_proportions = proportions[:, number_of_components - 1]
+    yield from search(0
+                      ,[]
+                      ,rows
+                      ,required_proportions[:, None] * flavors[required_item]
+                      ,required_proportions * prices[required_item])
+    if chunk_length:
+        yield flush_chunk()
+
+
+def get_blends_with_proportions(required_item:int, min_proportion:int, available_items:list, number_of_components:int
+                                ,max_blends:int = 3000000) -> tpo.BlendArrays:
+    """
+    Creates all possible combinations of available components and the required item with their respective proportions.
+    Proportions are created in increments of 5, and the input min_proportion will be rounded to nearest multiple of 5.
+    No blends are returned if more components are requested than coffee is avalable.
+    To prevent excessive amounts of data at most max_blends blends are returned, a message is printed if the
+    blends are truncated. Use iter_blends_with_proportions to process all blends without holding them in memory.
+    Parameters
+    ----------
+    required_item : int
+        The item which is required to be part of all the created blends.
+    min_proportion : int
+        The min proportion which the required item must have.
+        The required item will be in blends with proportions between this value are the theoretical max value.
+        If this value is not input as an increment of 5, it will be rounded
+    available_items : list
+        A list of all the possible components to be included in the blends.
+        The required item must be part of this list as well.
+    number_of_components : int
+        The number of components which the blend must have.
+        Must be a value between 2 and 7.
+    max_blends : int, optional
+        The maximum number of blends returned.
+        The default is 3000000.
+
+    Returns
+    -------
+    A BlendArrays with all possible blends that can be created with the input items and their respective proportions
+    """
+    blends = []
+    number_of_blends = 0
+    for blends_chunk in iter_blends_with_proportions(required_item, min_proportion, available_items, number_of_components):
+        blends.append(blends_chunk[:max_blends - number_of_blends])
+        number_of_blends += len(blends[-1])
+        if number_of_blends >= max_blends:
+            print(f"Blends with {number_of_components} components truncated to {max_blends} of " \
+                  f"{count_blends_with_proportions(required_item, min_proportion, available_items, number_of_components)} possible blends.")
+            break
+
+    return tpo.concatenate_blend_arrays(blends)
+
+
+def get_fitting_blends(blends, prices, flavor_model, flavors_components, target_flavor, target_color:int, cut_off_value:float = 0.75
+                       ,chunk_size:int = 10000, fitness_context:tpo.FitnessContext = None
+                       ,surrogate:tfs.FlavorSurrogate = None, surrogate_margin:float = None)->list:
     """
     Create a list of blends that have no differences to the target flavor profile greater than the cuf_off_value
     Parameters
     ----------
     blends :
-        A list containing all the blends to be evaluated containing index no of component and its proportion.
+        A BlendArrays, or a list, containing all the blends to be evaluated containing index no of component and its proportion.
         Each blend must be 7 components long. Use -1 as placeholder for NULL components with a proportion of 0.
     prices :
         A list of prices for all possible components.
@@ -881,37 +1710,72 @@ def get_fitting_blends(blends, prices, flavor_model, flavors_components, target_
     target_color : int
         The color which the blends are expected to be roasted to
     cut_off_value : float
+    chunk_size : int, optional
+        The number of blends which are predicted with a single call to the flavor model.
+        The default is 10000.
+    fitness_context : FitnessContext, optional
+        A FitnessContext created from the prices, flavor model, flavors, target flavor and color.
+        Pass this when calling the function several times for the same request to only scale the prices once.
+        The context must be created from the prices, flavor_model, flavors_components, target_flavor and target_color
+        given to the function, otherwise a ValueError is raised.
+        The default is None, which creates a new context.
+    surrogate : tfs.FlavorSurrogate, optional
+        A surrogate of the flavor model. Blends whose surrogate flavor differs more than cut_off_value + surrogate_margin
+        from the target for any flavor are discarded before the remaining blends are predicted by the flavor model.
+        The default is None, which predicts all blends with the flavor model.
+    surrogate_margin : float, optional
+        The margin used with the surrogate. The default is None, which uses the margin the surrogate was calibrated with.
 
     Returns
     -------
-    A list with the blends that have no differences to the target flavor profile greater than the cuf_off_value
+    A BlendArrays with the blends that have no differences to the target flavor profile greater than the cuf_off_value
+    and a list with the fitness value of each of these blends
     """
-    # Create a list of calculated diffs in predicted flavor profile when compared to the target
-    blends_flavor_diffs = [tpo.taste_diff(blend, flavor_model, flavors_components, target_flavor, target_color).tolist() for blend in blends]
-    # Get the largest diff for each blend
-    blends_flavor_diffs = [max(blend[0]) for blend in blends_flavor_diffs]
-    
-    # Get the index values for all blends whose largest flavor diff does not exceed the cuf off value, create a list with actual blends
-    blends_with_close_enough_flavor = [i for i,val in enumerate(blends_flavor_diffs) if not val > cut_off_value]
-    interesting_blends = [blends[i] for i in blends_with_close_enough_flavor]
-
-    # Create a list of fitness values for each of the  input blends
-    predicted_fitness = [tpo.blend_fitness(
-         blend
-         ,prices
-         ,flavor_model
-         ,flavors_components
-         ,target_flavor
-         ,target_color).tolist() for blend in interesting_blends]
-    predicted_fitness = [val[0] for val in predicted_fitness]
-    
-    return interesting_blends,predicted_fitness
+    blends = tpo.blends_to_arrays(blends)
+    if fitness_context is None:
+        fitness_context = tpo.FitnessContext(prices, flavor_model, flavors_components, target_flavor, target_color)
+    if not fitness_context.matches(prices, flavor_model, flavors_components, target_flavor, target_color):
+        raise ValueError("fitness_context was not created from the prices, flavor model, flavors, target flavor and color")
+    interesting_blends = []
+    predicted_fitness = []
+    if surrogate is not None:
+        surrogate_margin = surrogate.margin if surrogate_margin is None else surrogate_margin
+        surrogate_contributions = surrogate.contributions(fitness_context.candidates)
+
+    # Evaluate the blends in chunks, each chunk is predicted by the flavor model in one go
+    for chunk_start in range(0, len(blends), chunk_size):
+        blends_chunk = blends[chunk_start:chunk_start + chunk_size]
+        if surrogate is not None:
+            # Discard blends the surrogate shows can not be close enough before using the flavor model
+            surrogate_diffs = np.abs(fitness_context.target - surrogate.predict_blends(
+                blends_chunk
+                ,fitness_context.candidates
+                ,fitness_context.color
+                ,surrogate_contributions))
+            blends_chunk = blends_chunk[np.flatnonzero(~(surrogate_diffs.max(axis=1) > cut_off_value + surrogate_margin))]
+        # Calculate diffs in predicted flavor profile when compared to the target
+        blends_flavor_diffs = fitness_context.taste_diff_batch(blends_chunk)
+        # Keep all blends whose largest flavor diff does not exceed the cut off value
+        blends_with_close_enough_flavor = np.flatnonzero(~(blends_flavor_diffs.max(axis=1) > cut_off_value))
+        close_blends = blends_chunk[blends_with_close_enough_flavor]
+        # Calculate fitness values for the remaining blends, reusing the predicted flavor diffs
+        close_fitness = tpo.blend_fitness_batch(
+             close_blends
+             ,fitness_context
+             ,blends_flavor_diffs[blends_with_close_enough_flavor])
+        interesting_blends.append(close_blends)
+        predicted_fitness.extend(close_fitness.tolist())
+
+    return tpo.concatenate_blend_arrays(interesting_blends),predicted_fitness
 
 
 
 def get_fitting_blends_complete_list(required_item:int, min_proportion:int, available_items:list, prices
                                      ,flavor_model, flavors_components, target_flavor:list
-                                     ,target_color:int, cut_off_value:float = 0.5) ->list:
+                                     ,target_color:int, cut_off_value:float = 0.5, time_budget:float = 900
+                                     ,max_blends:int = 3000000, chunk_size:int = 100000
+                                     ,prune:bool = False, proxy_margin:float = None, keep_best:int = None
+                                     ,surrogate:tfs.FlavorSurrogate = None) ->list:
     """
     Creates a list of all possible blends which fall within the input criteria.
     The list consists of blends of 2-7 components, unless no suitable candidates are found within these constraints.
@@ -938,53 +1802,158 @@ def get_fitting_blends_complete_list(required_item:int, min_proportion:int, avai
         The max value any difference for each of the flavor profile values may have.
         If any of the values are greater than this value the blend will be discarded.
         The default is 0.75.
+    time_budget : float, optional
+        The max number of seconds spent evaluating blends. The budget is split evenly between the numbers of
+        components, any time not spent on one number of components is available for the following.
+        The default is 900.
+    max_blends : int, optional
+        The max number of blends evaluated per number of components.
+        The default is 3000000.
+    chunk_size : int, optional
+        The number of blends created and evaluated at a time, which limits the memory used.
+        The default is 100000.
+    prune : bool, optional
+        If True, blends are searched with iter_pruned_blends_with_proportions, which skips blends that can not be
+        fitting, so only promising blends are predicted by the flavor model. If False, every possible blend is
+        created and, if a surrogate is given, prefiltered by the surrogate before it is predicted.
+        The margin of the surrogate is estimated from a sample of blends and is not a guaranteed bound, so pruning
+        can skip blends the flavor model finds fitting, and the result can differ from the search of every blend.
+        The default is False.
+    proxy_margin : float, optional
+        How much the surrogate flavor of a blend may differ more from the target than cut_off_value.
+        The default is None, which uses the margin found by get_flavor_proxy_margin for the surrogate, or for the
+        weighted average flavor if no surrogate is given. With a surrogate, the margin is at least the margin the
+        surrogate was calibrated with.
+    surrogate : tfs.FlavorSurrogate, optional
+        The surrogate of the flavor model, saved next to the flavor model when it is trained.
+        The surrogate does not prefilter blends if the margin is at least cut_off_value, as it would discard few blends.
+        The default is None, which prunes with the weighted average flavor of the blends and does not prefilter.
+    keep_best : int, optional
+        Once this number of fitting blends have been found, blends which can not get a higher fitness than the
+        lowest of the best keep_best blends due to their cost are skipped when pruning.
+        The default is None, which keeps all fitting blends.
 
     Returns
     -------
-    A list of all the blends that fall within the input criteria.
+    A BlendArrays with all the blends that fall within the input criteria and a list with their fitness values.
 
     """
 
     best_fitting_blends = []
     best_fitting_fitness = []
-    
-    # Use the number of components as iterator    
-    for i in [2,3,4,5,6,7]:
-        all_blends_incl_proportions = get_blends_with_proportions(
+    components_range = [2,3,4,5,6,7]
+    # Prices are scaled once for all the blends evaluated for the request
+    fitness_context = tpo.FitnessContext(prices, flavor_model, flavors_components, target_flavor, target_color)
+    # The best fitness values found, the lowest of these is the fitness a blend must be able to reach to be searched
+    best_fitness = []
+    def min_fitness():
+        return best_fitness[0] if len(best_fitness) >= keep_best else -np.inf
+    # The margin is checked against a sample of the blends of this request, and never set below the margin
+    # the surrogate was calibrated with on held-out data when it was trained
+    if proxy_margin is None and (prune or surrogate is not None):
+        proxy_margin = get_flavor_proxy_margin(required_item, min_proportion, available_items, fitness_context
+                                               ,surrogate=surrogate)
+        if surrogate is not None:
+            proxy_margin = max(proxy_margin, surrogate.margin)
+    # A surrogate with a margin of at least the cut-off value discards too few blends to be worth predicting
+    if surrogate is not None and not prune and proxy_margin >= cut_off_value:
+        log_insert("get_fitting_blends_complete_list"
+                   ,f"Flavor surrogate margin {proxy_margin:.3f} is not below the cut-off {cut_off_value}, the surrogate is not used.")
+        surrogate = None
+    if prune or surrogate is not None:
+        print(f"Flavor proxy margin: {proxy_margin:.2f}")
+    # Grab Currrent Time Before Running the Code for keeping track of the time budget
+    start_time_total = time.time()
+
+    # Use the number of components as iterator
+    for i in components_range:
+        number_of_blends = count_blends_with_proportions(
             required_item
             ,min_proportion
             ,available_items
             ,i)
-        
-        print("Components: " + str(i) + "\n" "Possible blends: " + str(len(all_blends_incl_proportions)))
+        print("Components: " + str(i) + "\n" "Possible blends: " + str(number_of_blends))
 
+        # The remaining time budget is split evenly between the remaining numbers of components
+        components_remaining = len(components_range) - components_range.index(i)
+        time_budget_components = (time_budget - (time.time() - start_time_total)) / components_remaining
         # Grab Currrent Time Before Running the Code for logging of total execution time
-        start_time = time.time()        
-        # If data exists, get all blends that are within cut-off criteria
-        if len(all_blends_incl_proportions) > 0:
+        start_time = time.time()
+        number_of_evaluated_blends = 0
+        number_of_fitting_blends = 0
+        # Get all blends that are within cut-off criteria, a chunk of blends at a time
+        if not prune:
+            blends_chunks = iter_blends_with_proportions(
+                required_item
+                ,min_proportion
+                ,available_items
+                ,i
+                ,chunk_size)
+        else:
+            search_statistics = {}
+            blends_chunks = iter_pruned_blends_with_proportions(
+                required_item
+                ,min_proportion
+                ,available_items
+                ,i
+                ,fitness_context
+                ,cut_off_value
+                ,proxy_margin
+                ,min_fitness if keep_best else None
+                ,chunk_size
+                ,start_time + time_budget_components
+                ,search_statistics
+                ,surrogate)
+        for blends_chunk in blends_chunks:
+            if number_of_evaluated_blends >= max_blends or time.time() - start_time > time_budget_components:
+                break
+            blends_chunk = blends_chunk[:max_blends - number_of_evaluated_blends]
             new_blends, new_fitness = get_fitting_blends(
-                all_blends_incl_proportions
+                blends_chunk
                 ,prices
                 ,flavor_model
                 ,flavors_components
                 ,target_flavor
                 ,target_color
-                ,cut_off_value)
+                ,cut_off_value
+                ,chunk_size
+                ,fitness_context
+                ,None if prune else surrogate
+                ,proxy_margin)
+            number_of_evaluated_blends += len(blends_chunk)
+            number_of_fitting_blends += len(new_blends)
             if len(new_blends):
                 #Extend lists with blends and fitness values if any new exists
-                best_fitting_blends.extend([blend for blend in new_blends])
-                best_fitting_fitness.extend([fitness for fitness in new_fitness])
-    
-    
-        print("No. of fitting blends after run: " + str(len(new_blends)))
+                best_fitting_blends.append(new_blends)
+                best_fitting_fitness.extend(new_fitness)
+                for fitness in new_fitness if keep_best else []:
+                    if len(best_fitness) < keep_best:
+                        heapq.heappush(best_fitness, fitness)
+                    elif fitness > best_fitness[0]:
+                        heapq.heapreplace(best_fitness, fitness)
+
+        # Make it known if not all possible blends could be evaluated within the budgets
+        if prune:
+            print(f"Blends evaluated by the flavor model after pruning: {number_of_evaluated_blends}")
+            # Pruned blends have been ruled out, only blends that were never searched count against the budgets
+            if search_statistics.get("Stopped") or number_of_evaluated_blends < search_statistics.get("Candidates", 0):
+                budget_note = f"Search for blends with {i} components stopped after {number_of_evaluated_blends} evaluated blends of {number_of_blends} possible blends due to time or size budget."
+                print(budget_note)
+                log_insert("get_fitting_blends_complete_list", budget_note)
+        elif number_of_evaluated_blends < number_of_blends:
+            budget_note = f"Blends with {i} components stopped after {number_of_evaluated_blends} of {number_of_blends} possible blends due to time or size budget."
+            print(budget_note)
+            log_insert("get_fitting_blends_complete_list", budget_note)
+
+        print("No. of fitting blends after run: " + str(number_of_fitting_blends))
         print("Runtime seconds: " + str(int(time.time() - start_time)))
         print("---------------------------------------------------------")
 
 
-    return best_fitting_blends,best_fitting_fitness
+    return tpo.concatenate_blend_arrays(best_fitting_blends),best_fitting_fitness
 
 
-def get_blends_hof(blends:list, blends_eval_value:list, hof_size:int = 50) -> list:
+def get_blends_hof(blends, blends_eval_value:list, hof_size:int = 50) -> list:
     """
     Create a hall-of-fame of a list of blends that are not-too-similar.
     The hall-of-fame has the following logic flow, run per blend.
@@ -1002,9 +1971,9 @@ def get_blends_hof(blends:list, blends_eval_value:list, hof_size:int = 50) -> li
  
     Parameters
     ----------
-    blends : list
-        A list with any number of blends of len 7, which contains tuples of components and proportions.
-        Expected format: [[(),(),()],[(),(),()],[(),(),()]]
+    blends : BlendArrays or list
+        A BlendArrays, or a list with any number of blends of len 7, which contains tuples of components and proportions.
+        Expected list format: [[(),(),()],[(),(),()],[(),(),()]]
     blends_eval_value : list
         A list containing a value per blend, which is used to see which blend is to be prioritized over another.
         List must have the same length as the number of blends.
@@ -1016,7 +1985,9 @@ def get_blends_hof(blends:list, blends_eval_value:list, hof_size:int = 50) -> li
     Returns
     -------
     A list with hof_size length of blends, which are the final result of the hof.
+    Each blend is a list of 7 tuples of component and proportion, also if the blends are given as a BlendArrays.
     """
+    blends = tpo.blends_to_arrays(blends)
 
     # Create a list of blend indexes to iterate over
     blend_numbers = list(range(len(blends_eval_value)))
@@ -1034,7 +2005,7 @@ def get_blends_hof(blends:list, blends_eval_value:list, hof_size:int = 50) -> li
         if not best_fitting_hof:
             best_fitting_hof.append(blend_no)
         # Check if any of the blends in the hof are too similar to the current blend
-        blend_similar_to_hof = [tpo.blends_too_similar(blends[blend_no], blends[hof_blend]) for hof_blend in best_fitting_hof]
+        blend_similar_to_hof = tpo.blends_too_similar_batch(blends[blend_no], blends[best_fitting_hof]).tolist()
         # Get all fitness values of hof
         hof_fitness_total = [blends_eval_value[blend] for blend in best_fitting_hof]
         if not any(blend_similar_to_hof):
@@ -1061,20 +2032,21 @@ def get_blends_hof(blends:list, blends_eval_value:list, hof_size:int = 50) -> li
                 # Replace worst fitness with current blend
                 best_fitting_hof[ix_worst_fitness_similar] = blend_no
         
-    hof_blends = [blends[i] for i in best_fitting_hof]
+    # The similarity check uses BlendArrays, the hof is returned as lists like the blends of the recommendations
+    hof_blends = blends[best_fitting_hof].to_blends()
 
     return hof_blends
 
 
 
-def convert_blends_lists_to_dataframe(blends:list, blend_no_start:int=0)-> pd.DataFrame():
+def convert_blends_lists_to_dataframe(blends, blend_no_start:int=0)-> pd.DataFrame():
     """
-    Converts a list of blends with components and proportions to a pandas DataFrame.
+    Converts a list or BlendArrays of blends with components and proportions to a pandas DataFrame.
 
     Parameters
     ----------
     blends :
-        A list containing all the blends to be evaluated containing index no of component and its proportion.
+        A BlendArrays, or a list containing all the blends to be evaluated containing index no of component and its proportion.
         Use -1 as placeholder for NULL components with a proportion of 0.
         Expected format: [[(),(),()],[(),(),()],[(),(),()]]
     blend_no_start :
@@ -1086,24 +2058,32 @@ def convert_blends_lists_to_dataframe(blends:list, blend_no_start:int=0)-> pd.Da
     A pandas DataFrame with all blends
 
     """
-        
-    df = pd.DataFrame(columns=["Blend_nr","Kontraktnummer_index","Proportion"])
-
-    for blend in blends:
-        blend_no_start +=1
-        for component_line in blend:
-            if not component_line[0] == -1: # -1 indicates a NULL placeholder value, these are ignored
-            # Extract data for each component line for each blend suggestion and append to dataframe
-                data = pd.DataFrame.from_dict(
-                    {"Blend_nr": [blend_no_start]
-                    ,"Kontraktnummer_index": [component_line[0]]
-                    ,"Proportion": [component_line[1]]})
-                df = pd.concat([df,data], ignore_index=True) # df.append(data, ignore_index = True)
-
-    return df
-
-
-def get_test_roastings(robusta:bool, start_tasting_id:int=0) -> pd.DataFrame():
+    if isinstance(blends, tpo.BlendArrays):
+        # Number each blend and keep the component lines in the order they are in the blends
+        indices, proportions = blends.indices.astype(np.int64), np.round(blends.proportions.astype(np.float64), 2)
+        blend_numbers = np.repeat(np.arange(blend_no_start + 1, blend_no_start + 1 + len(blends)), indices.shape[1])
+        components = indices.ravel() != -1 # -1 indicates a NULL placeholder value, these are ignored
+        df = pd.DataFrame({"Blend_nr": blend_numbers[components]
+                           ,"Kontraktnummer_index": indices.ravel()[components]
+                           ,"Proportion": proportions.ravel()[components]})
+    else:
+        df = pd.DataFrame([(blend_no, component_line[0], component_line[1])
+                           for blend_no, blend in enumerate(blends, blend_no_start + 1)
+                           for component_line in blend
+                           if not component_line[0] == -1]
+                          ,columns=["Blend_nr","Kontraktnummer_index","Proportion"])
+    return df.astype({"Blend_nr": np.int64, "Kontraktnummer_index": np.int64, "Proportion": np.float64})
+
+
+@reader({"Dato_r": "datetime64[ns]", "Kontraktnummer": None, "Modtagelse": None, "Sort": "category"
+         ,"Dato_rist": "datetime64[ns]", "Produktionsordre id": "Int64", "Batch id": "Int64", "Kilo_rist_input": "float64"
+         ,"Ordre_rist": "Int64", "Receptnummer": None, "Kilo_rist_output": "float64", "Farve": "float64"
+         ,"Dato_p": "datetime64[ns]", "Ordre_p": "Int64", "Syre_p": "float64", "Krop_p": "float64", "Aroma_p": "float64"
+         ,"Eftersmag_p": "float64", "Robusta_p": "float64", "Smagningsid": "int64", "Faktorfelt": "int64"
+         ,"Komponent id": "int64", "Syre_r": "float64", "Krop_r": "float64", "Aroma_r": "float64"
+         ,"Eftersmag_r": "float64", "Robusta_r": "float64"}
+        ,optional_columns=("Robusta_p","Robusta_r"))
+def get_test_roastings(robusta:bool, start_tasting_id:int=0, since=None) -> pd.DataFrame():
     """
     Returns a pandas dataframe containing all test roastings which have been graded.
     The data is returned with the same columns as are used in ti_data_preprocessing, assuming no changes
@@ -1114,9 +2094,11 @@ def get_test_roastings(robusta:bool, start_tasting_id:int=0) -> pd.DataFrame():
     
     start_tasting_id indicates which number the tasting id sequence for data should start.
     Defaults to 0
+    
+    If since is given, only test roastings graded on or after this date are returned.
     """
 
-    query = """ SELECT
+    query = f""" SELECT
             	CAST(LEFT(BFK.[Registreringstidspunkt],11) AS DATETIME) AS [Dato_r]
             	,RRP.[Kontraktnummer]
             	,RRP.[Delivery] AS [Modtagelse]
@@ -1147,10 +2129,22 @@ def get_test_roastings(robusta:bool, start_tasting_id:int=0) -> pd.DataFrame():
             INNER JOIN [cof].[Risteri_råkaffe_planlægning] AS RRP
             	ON BFK.[Modtagelses_id] = RRP.[Id]
             WHERE S.[Id_org_kildenummer] = 10
-            	AND S.[Smag_Syre] + S.[Smag_Krop] + S.[Smag_Aroma] + S.[Smag_Eftersmag] IS NOT NULL """
+            	AND S.[Smag_Syre] + S.[Smag_Krop] + S.[Smag_Aroma] + S.[Smag_Eftersmag] IS NOT NULL
+                {sql_since_filter("S.[Dato]", since)} """
     
     # Get data for finished products and grades for green coffees
-    df = pd.read_sql(query, bsi.con_ds)
+    df = set_column_types(pd.read_sql(query, bsi.con_ds)
+                          ,["Produktionsordre id","Batch id","Ordre_rist","Ordre_p"]
+                          ,["Syre_p","Krop_p","Aroma_p","Eftersmag_p","Robusta_p"])
+    return add_test_roasting_grades(df, robusta, start_tasting_id)
+
+# Add tasting ids and the grades of the green coffees to test roastings
+def add_test_roasting_grades(df: pd.DataFrame(), robusta: bool, start_tasting_id: int = 0) -> pd.DataFrame():
+    """
+    Numbers the test roastings returned by the query in get_test_roastings from start_tasting_id + 100000,
+    and merges the grades of the green coffees used onto the test roastings.
+    The robusta columns are removed unless robusta is True, in which case missing values are filled with 10.
+    """
     tasting_ids = [i + start_tasting_id + 100000 for i in list(range(len(df)))]
     df["Smagningsid"] = tasting_ids
     
@@ -1177,3 +2171,7 @@ def get_test_roastings(robusta:bool, start_tasting_id:int=0) -> pd.DataFrame():
     
     return df
 
+# Use the fixture database instead of the servers if one is set in the environment, see bki_fixture_data
+if bsi.fixture_database:
+    import bki_fixture_data
+    bki_fixture_data.use_fixture_database(bsi.fixture_database)
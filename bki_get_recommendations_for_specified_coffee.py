@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import itertools
-import joblib
+import ti_flavor_inference as tfi
 import bki_functions as bf
 import ti_price_opt as tpo
 import time
@@ -402,7 +402,7 @@ df_available_coffee["Kontrakt_id"] = df_available_coffee.index
 contracts_list = df_available_coffee["Kontraktnummer"].to_list()
 # model for flavor predictor
 model_name = "flavor_predictor_no_robusta.sav"
-flavor_predictor = joblib.load(model_name)
+flavor_predictor = tfi.load_flavor_model(model_name)
 flavor_columns = ["Syre","Aroma","Krop","Eftersmag"]
 flavors_list = df_available_coffee[flavor_columns].to_numpy()
 target_flavor_list = [6,6,7,6]
@@ -490,8 +490,8 @@ end_time = time.time()
 total_time = end_time - start_time
 #Subtract Start Time from The End Time
 total_time_seconds = int(total_time) % 60
-total_time_minutes = total_time // 60
-total_time_hours = total_time // 60 // 60
+total_time_minutes = total_time // 60 % 60
+total_time_hours = total_time // 3600
 execution_time = str("%d:%02d:%02d" % (total_time_hours, total_time_minutes, total_time_seconds))
 
 print(execution_time)
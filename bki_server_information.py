@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import urllib
-from sqlalchemy import create_engine
+import threading
+from sqlalchemy import create_engine, event
 
 
 # =============================================================================
@@ -11,17 +13,88 @@ from sqlalchemy import create_engine
 server_04 = "sqlsrv04"
 db_ds = "BKI_Datastore"
 params_ds = f"DRIVER={{SQL Server Native Client 11.0}};SERVER={server_04};DATABASE={db_ds};trusted_connection=yes"
-con_ds = create_engine('mssql+pyodbc:///?odbc_connect=%s' % urllib.parse.quote_plus(params_ds))
 
 server_nav = r"SQLSRV03\NAVISION"
 db_nav = "NAV100-DRIFT"
 params_nav = f"DRIVER={{SQL Server Native Client 11.0}};SERVER={server_nav};DATABASE={db_nav};trusted_connection=yes"
-con_nav = create_engine('mssql+pyodbc:///?odbc_connect=%s' % urllib.parse.quote_plus(params_nav))
 
 server_probat = "192.168.125.161"
 db_probat = "BKI_IMP_EXP"
 params_probat = f"DRIVER={{SQL Server Native Client 11.0}};SERVER={server_probat};DATABASE={db_probat};uid=bki_read;pwd=Probat2016"
-con_probat = create_engine('mssql+pyodbc:///?odbc_connect=%s' % urllib.parse.quote_plus(params_probat))
+
+# =============================================================================
+# Engines
+# =============================================================================
+# Connection strings of the engines available as con_ds, con_nav and con_probat
+engine_connection_strings = {
+    "con_ds": params_ds
+    ,"con_nav": params_nav
+    ,"con_probat": params_probat}
+
+# Pool settings used when an engine is created. Change before the first query to use other values.
+pool_size = 5
+max_overflow = 10
+pool_recycle = 3600
+
+engines = {}
+engines_lock = threading.Lock()
+
+# Environment variable with the path of a SQLite fixture database created with bki_fixture_data. When it is set,
+# all engines connect to the fixture database instead of the servers, see bki_fixture_data.use_fixture_database.
+fixture_database_variable = "BKI_FIXTURE_DATABASE"
+fixture_database = os.environ.get(fixture_database_variable) or None
+# Schemas of the tables written by the scripts, attached to the fixture database so the same table names work
+fixture_schemas = ["dbo","cof"]
+
+def create_fixture_engine(path: str):
+    """
+    Returns an engine for the SQLite fixture database in path. The database is attached to each connection
+    under the names in fixture_schemas, so e.g. [cof].[Receptforslag_log] refers to a table in the database.
+    """
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+
+    @event.listens_for(engine, "connect")
+    def attach_schemas(dbapi_connection, connection_record):
+        for schema in fixture_schemas:
+            dbapi_connection.execute(f"ATTACH DATABASE ? AS [{schema}]", (path,))
+
+    return engine
+
+def get_engine(name: str):
+    """
+    Returns the engine with the input name, e.g. 'con_ds'. The engine is created the first time it is used,
+    so importing this module does not touch the ODBC configuration, and servers that are never queried are never connected to.
+    Connections are pooled and pinged before they are handed out, so connections dropped by the server are replaced.
+    If a fixture database is set, all engines connect to it instead, see create_fixture_engine.
+    """
+    with engines_lock:
+        if name not in engines:
+            if fixture_database:
+                engines[name] = create_fixture_engine(fixture_database)
+            else:
+                engines[name] = create_engine('mssql+pyodbc:///?odbc_connect=%s' % urllib.parse.quote_plus(engine_connection_strings[name])
+                                              ,pool_size=pool_size
+                                              ,max_overflow=max_overflow
+                                              ,pool_recycle=pool_recycle
+                                              ,pool_pre_ping=True
+                                              ,fast_executemany=True)
+        return engines[name]
+
+def dispose_engines(close: bool = True):
+    """
+    Disposes all created engines, they are created again when used next time.
+    Use close=False in a forked process, to discard the inherited connections without closing them for the parent process.
+    """
+    with engines_lock:
+        for engine in engines.values():
+            engine.dispose(close=close)
+        engines.clear()
+
+def __getattr__(name: str):
+    # Engines are attributes of the module, created when they are first accessed
+    if name in engine_connection_strings:
+        return get_engine(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # =============================================================================
 # Filepaths
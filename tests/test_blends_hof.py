@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import ti_price_opt as tpo
+import bki_functions as bf
+
+
+def test_blends_hof_returns_lists_for_lists_and_blend_arrays():
+    blends = bf.get_blends_with_proportions(0, 20, list(range(6)), 3)
+    fitness = [(i % 7) / 10 for i in range(len(blends))]
+    hof = bf.get_blends_hof(blends, fitness, 5)
+    hof_from_lists = bf.get_blends_hof(tpo.arrays_to_blends(blends.indices, blends.proportions), fitness, 5)
+    assert isinstance(hof, list)
+    assert hof == hof_from_lists
+    assert all(isinstance(blend, list) and len(blend) == 7 for blend in hof)
+    assert all(isinstance(component, int) and isinstance(proportion, (int, float))
+               for blend in hof for component, proportion in blend)
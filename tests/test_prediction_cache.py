@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from sklearn.neural_network import MLPRegressor
+import ti_price_opt as tpo
+
+
+def flavor_model_and_candidates(seed=0):
+    """Returns a small flavor model fitted on random inputs, and the flavors of 10 candidates."""
+    rng = np.random.default_rng(seed)
+    candidates = rng.uniform(5, 9, size=(10, 5))
+    X = rng.uniform(0, 10, size=(200, 7 * 6 + 1))
+    Y = rng.uniform(5, 9, size=(200, 5))
+    flavor_model = MLPRegressor(hidden_layer_sizes=(8,), max_iter=20, random_state=seed).fit(X, Y)
+    return flavor_model, candidates
+
+
+def test_taste_pred_is_the_same_with_and_without_cache():
+    flavor_model, candidates = flavor_model_and_candidates()
+    prediction_cache = tpo.PredictionCache(flavor_model, candidates)
+    blends = [[(3, 0.25), (1, 0.75)] + [(-1, 0)] * 5
+              ,[(1, 0.75), (3, 0.25)] + [(-1, 0)] * 5
+              ,[(2, 0.123), (7, 0.3), (5, 0.577)] + [(-1, 0)] * 4
+              ,[(5, 0.577), (2, 0.123), (7, 0.3)] + [(-1, 0)] * 4
+              ,[(2, 0.123), (-1, 0), (7, 0.3), (5, 0.577)] + [(-1, 0)] * 3]
+    # Each blend twice, so the second prediction is read from the cache
+    for blend in blends + blends:
+        np.testing.assert_array_equal(tpo.taste_pred(blend, flavor_model, candidates, 60)
+                                      ,tpo.taste_pred(blend, flavor_model, candidates, 60, prediction_cache))
+    # The placeholder in the last blend is removed in the model input, which is the input of the third blend
+    assert prediction_cache.hits == len(blends) + 1
+
+
+def test_fitness_is_the_same_with_and_without_cache():
+    flavor_model, candidates = flavor_model_and_candidates(1)
+    target = np.array([7.0, 7.5, 6.5, 7.0, 8.0])
+    blends = [[(0, 0.4), (9, 0.6)] + [(-1, 0)] * 5
+              ,[(9, 0.6), (0, 0.4)] + [(-1, 0)] * 5
+              ,[(4, 0.2), (6, 0.3), (8, 0.5)] + [(-1, 0)] * 4]
+    uncached = tpo.FitnessContext(np.ones((10, 1)), flavor_model, candidates, target, 60)
+    cached = tpo.FitnessContext(np.ones((10, 1)), flavor_model, candidates, target, 60
+                                ,tpo.PredictionCache(flavor_model, candidates))
+    np.testing.assert_allclose(uncached.taste_diff_batch(blends), cached.taste_diff_batch(blends), atol=1e-6)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import bki_functions as bf
+
+
+class WeightedAverageModel:
+    """A flavor model predicting the proportion weighted average flavor, which the pruning bounds hold for exactly."""
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        components = X[:, :-1].reshape(len(X), 7, -1)
+        return (components[:, :, -1:] * components[:, :, :-1]).sum(axis=1)
+
+
+def search(prune, keep_best=None, proxy_margin=None):
+    rng = np.random.default_rng(0)
+    flavors = rng.uniform(5, 9, size=(6, 5))
+    prices = rng.uniform(20, 40, size=(6, 1))
+    blends, fitness = bf.get_fitting_blends_complete_list(
+        0
+        ,20
+        ,list(range(6))
+        ,prices
+        ,WeightedAverageModel()
+        ,flavors
+        ,flavors.mean(axis=0)
+        ,60
+        ,cut_off_value=0.5
+        ,prune=prune
+        ,proxy_margin=proxy_margin
+        ,keep_best=keep_best)
+    hof = bf.get_blends_hof(blends, fitness)
+    return sorted(fitness), sorted(tuple(hof[i]) for i in range(len(hof)))
+
+
+def test_pruned_search_finds_the_blends_of_the_search_of_every_blend():
+    all_fitness, all_hof = search(prune=False)
+    pruned_fitness, pruned_hof = search(prune=True, proxy_margin=0.0)
+    assert len(all_fitness) > 0
+    assert pruned_fitness == all_fitness
+    assert pruned_hof == all_hof
+
+
+def test_pruned_search_with_keep_best_finds_the_best_blends():
+    all_fitness, _ = search(prune=False)
+    pruned_fitness, _ = search(prune=True, keep_best=20, proxy_margin=0.0)
+    assert pruned_fitness[-20:] == all_fitness[-20:]
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import random
+import json
+import time
+import argparse
+import platform
+import contextlib
+import subprocess
+import statistics
+import tempfile
+import shutil
+import functools
+import importlib.util
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.neural_network import MLPRegressor
+import bki_functions as bf
+import bki_server_information as bsi
+import ti_price_opt as tpo
+import ti_data_preprocessing as tdp
+
+
+# Offline benchmarks of the hot paths of the blend optimisation. All data is synthetic and created from a fixed seed,
+# and the flavor model is a small MLPRegressor trained on the synthetic data, so results can be compared between commits.
+# Run with: python ti_benchmark.py --output benchmark.json --compare benchmark_before.json
+# The benchmarks only call functions with the signatures of the baseline commit, so the results before the
+# optimisations are created by copying this file into a checkout of the baseline commit and running it there.
+# get_blend_grade_data reads a fixture database created with bki_fixture_data, and is skipped on commits without it.
+
+# Date of the newest data in the fixture database, fixed so every run creates the same database
+fixture_end_date = "2021-12-31"
+
+
+def create_synthetic_contracts(number_of_contracts=40, number_of_flavors=4, seed=0):
+    """
+    Creates synthetic contracts with flavors on the 3-9 scale of the grades and prices.
+    :return contracts, flavors, prices: A list of contract numbers, an array with the flavors of each contract and an
+        array with the price of each contract with one row per contract.
+    """
+    rng = np.random.default_rng(seed)
+    contracts = [f"K{i:04d}" for i in range(number_of_contracts)]
+    flavors = rng.integers(3, 10, (number_of_contracts, number_of_flavors)).astype(np.float64)
+    prices = rng.uniform(20, 60, (number_of_contracts, 1))
+    return contracts, flavors, prices
+
+
+def synthetic_blend_flavors(X, number_of_flavors):
+    """Returns the flavors of blends in the synthetic data for rows of model input, a smooth function of the weighted average."""
+    components = X[:, :-1].reshape(len(X), 7, number_of_flavors + 1)
+    average = (components[:, :, :number_of_flavors] * components[:, :, number_of_flavors:]).sum(axis=1)
+    return average + 0.3 * np.sin(average) + (X[:, -1:] - 110) * 0.01
+
+
+def create_benchmark_model(flavors, number_of_samples=5000, seed=0):
+    """
+    Trains a small MLPRegressor flavor model on random blends of the synthetic contracts.
+    The training data and the model only depend on the seed, so the same model is trained in every run.
+    """
+    rng = np.random.default_rng(seed)
+    X = np.empty((number_of_samples, 7 * (flavors.shape[1] + 1) + 1))
+    for i in range(number_of_samples):
+        number_of_components = rng.integers(1, 8)
+        components = rng.choice(len(flavors), number_of_components, replace=False)
+        # The layout of the model input is [flavors_1, p_1, ..., flavors_7, p_7, color], see tpo.encode_model_input
+        X[i] = 0
+        X[i, :-1].reshape(7, -1)[:number_of_components] = np.column_stack(
+            [flavors[components], rng.dirichlet(np.ones(number_of_components))])
+        X[i, -1] = rng.uniform(100, 120)
+    return MLPRegressor(hidden_layer_sizes=(64, 64), activation="tanh", max_iter=200, random_state=seed) \
+        .fit(X, synthetic_blend_flavors(X, flavors.shape[1]))
+
+
+def time_function(function, repeat=3) -> dict:
+    """
+    Calls function repeat times and returns the wall-clock timings in seconds. Anything printed by function is
+    discarded so it does not add to the timings.
+    """
+    timings = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start_time = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start_time)
+    return {"min": min(timings), "median": statistics.median(timings), "mean": statistics.mean(timings)
+            ,"repeat": repeat}
+
+
+def run_benchmarks(names=None, repeat=3, number_of_contracts=40, seed=0) -> dict:
+    """
+    Runs the benchmarks of the hot paths and returns the timings together with information about the environment.
+    The input of a benchmark is only created if the benchmark is selected.
+    :param names: A list with the names of the benchmarks to run. Defaults to None, which runs all benchmarks.
+    :param repeat: The number of times each benchmark is run. Defaults to 3.
+    :param number_of_contracts: The number of synthetic contracts to create blends from. Defaults to 40.
+    :param seed: The seed of the synthetic data and model. Defaults to 0.
+    :return: A dictionary which can be saved as JSON.
+    """
+    contracts, flavors, prices = create_synthetic_contracts(number_of_contracts, seed=seed)
+    target_flavor = flavors.mean(axis=0).round(1)
+    color = 110
+    fixture_directory = None
+
+    # The input of each benchmark is created the first time a selected benchmark needs it
+    @functools.lru_cache(maxsize=None)
+    def flavor_model():
+        return create_benchmark_model(flavors, seed=seed)
+
+    @functools.lru_cache(maxsize=None)
+    def blends():
+        return bf.get_blends_with_proportions(0, 20, list(range(number_of_contracts)), 3)
+
+    @functools.lru_cache(maxsize=None)
+    def fitting_blends():
+        return bf.get_fitting_blends(blends(), prices, flavor_model(), flavors, target_flavor, color, 1.0)
+
+    @functools.lru_cache(maxsize=None)
+    def hof():
+        return bf.get_blends_hof(*fitting_blends())
+
+    @functools.lru_cache(maxsize=None)
+    def fixture_counts():
+        # The preprocessing reads a small fixture database, see bki_fixture_data
+        nonlocal fixture_directory
+        import bki_fixture_data
+        fixture_directory = tempfile.mkdtemp(prefix="bki_benchmark_")
+        fixture_path = os.path.join(fixture_directory, "bki_fixture.db")
+        counts = bki_fixture_data.generate_fixture_database(fixture_path, 10 * number_of_contracts, years=1
+                                                            ,orders_per_day=1, end_date=fixture_end_date, seed=seed)
+        bki_fixture_data.use_fixture_database(fixture_path)
+        return counts
+
+    def ga_cheapest_blend():
+        # The genetic algorithm draws from the random module, seed it so every run evolves the same blends
+        random.seed(seed)
+        return tpo.ga_cheapest_blend(contracts, flavors, prices, flavor_model(), target_flavor, color)
+
+    # Each benchmark is the function timed and a function returning the size of its input
+    # get_blends_with_proportions is timed with three components of 150 items, 1389276 blends, which is below
+    # the truncation added after the baseline, so the same blends are enumerated on the baseline commit
+    benchmarks = {
+        "ga_cheapest_blend": (ga_cheapest_blend
+                              ,lambda: {"contracts": number_of_contracts})
+        ,"get_blends_with_proportions": (lambda: bf.get_blends_with_proportions(0, 20, list(range(150)), 3)
+                                         ,lambda: {"blends": 1389276})
+        ,"get_fitting_blends": (lambda: bf.get_fitting_blends(blends(), prices, flavor_model(), flavors, target_flavor, color, 1.0)
+                                ,lambda: {"blends": len(blends())})
+        ,"get_blends_hof": (lambda: bf.get_blends_hof(*fitting_blends())
+                            ,lambda: {"blends": len(fitting_blends()[0])})
+        ,"convert_blends_lists_to_dataframe": (lambda: bf.convert_blends_lists_to_dataframe(fitting_blends()[0])
+                                               ,lambda: {"blends": len(fitting_blends()[0])})
+        ,"convert_blends_lists_to_dataframe_hof": (lambda: bf.convert_blends_lists_to_dataframe(hof())
+                                                   ,lambda: {"blends": len(hof())})
+        ,"get_blend_grade_data": (tdp.get_blend_grade_data
+                                  ,lambda: {"orders": fixture_counts()["finished_goods_grades"]})}
+    unknown_names = set(names or []) - set(benchmarks)
+    if unknown_names:
+        raise ValueError(f"Unknown benchmarks: {', '.join(sorted(unknown_names))}")
+
+    results = {}
+    try:
+        for name, (function, size) in benchmarks.items():
+            if names and name not in names:
+                continue
+            if name == "get_blend_grade_data" and importlib.util.find_spec("bki_fixture_data") is None:
+                print(f"{name}: skipped, bki_fixture_data is not available on this commit")
+                continue
+            # The size is found first, so creating the input is not timed
+            size = size()
+            results[name] = {**time_function(function, repeat), "size": size}
+            print(f"{name}: {results[name]['median']:.4f} seconds (median of {repeat})")
+    finally:
+        if fixture_directory is not None:
+            bsi.dispose_engines()
+            shutil.rmtree(fixture_directory, ignore_errors=True)
+
+    return {"commit": get_git_commit()
+            ,"created": pd.Timestamp.now().isoformat(timespec="seconds")
+            ,"environment": {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__
+                             ,"sklearn": sklearn.__version__, "machine": platform.machine(), "processor": platform.processor()}
+            ,"parameters": {"repeat": repeat, "contracts": number_of_contracts, "seed": seed}
+            ,"results": results}
+
+
+def get_git_commit() -> str:
+    """Returns the hash of the checked out git commit, or an empty string if it can not be found."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare_results(baseline: dict, results: dict) -> pd.DataFrame():
+    """
+    Returns a dataframe comparing the median timings of two benchmark runs, with the ratio of each timing to the
+    baseline. Ratios below 1 are improvements.
+    """
+    rows = []
+    for name, result in results["results"].items():
+        baseline_result = baseline["results"].get(name)
+        rows.append({"Benchmark": name
+                     ,"Baseline": baseline_result["median"] if baseline_result else np.nan
+                     ,"Current": result["median"]
+                     ,"Ratio": result["median"] / baseline_result["median"] if baseline_result else np.nan
+                     ,"Same size": baseline_result is not None and baseline_result["size"] == result["size"]})
+    return pd.DataFrame(rows)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the blend optimisation on synthetic data.")
+    parser.add_argument("--output", default=None,
+                        help="JSON file the results are saved in. Default is benchmark_<commit>.json.")
+    parser.add_argument("--compare", default=None,
+                        help="JSON file with results of an earlier run to compare the results with.")
+    parser.add_argument("--only", nargs="+", default=None,
+                        help="Names of the benchmarks to run. Default is all benchmarks.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times each benchmark is run. Default 3.")
+    parser.add_argument("--contracts", type=int, default=40,
+                        help="Number of synthetic contracts. Default 40.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic data and model. Default 0.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.only, args.repeat, args.contracts, args.seed)
+    output = args.output or f"benchmark_{results['commit'][:7] or 'local'}.json"
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved in {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            print(compare_results(json.load(file), results).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import bki_functions as bf
+import ti_price_opt as tpo
 import pandas as pd
 import numpy as np
 
@@ -15,6 +17,78 @@ def get_blend_grade_data(robusta=True):
     :return X_list, Y_list: A dataset of all the input flavors (X) for every blend produced in the database coupled with
         the flavor of the corresponding output product (Y).
     """
+    X, Y, _, _ = get_blend_grade_samples(robusta)
+    return X, Y
+
+
+def get_blend_grade_data_incremental(robusta=True, path=None, lookback_days=14):
+    """
+    Get the same dataset as get_blend_grade_data, but only process products graded since the last run.
+    The samples are stored in a .npz file together with a key identifying each sample and the date of the grade.
+    The newest stored grade date is the watermark, only grades from lookback_days before the watermark and later
+    are fetched and processed. The lookback includes samples whose roasting data was not yet available in the last run.
+    Fetched samples replace stored samples with the same key. Delete the file to rebuild the dataset from scratch.
+    :param robusta: Boolean for whether or not to consider robusta flavor.
+    :param path: The .npz file with the stored samples. Defaults to blend_grade_data_robusta.npz or
+        blend_grade_data_no_robusta.npz in the working directory.
+    :param lookback_days: The number of days before the watermark to fetch again. Defaults to 14.
+    :return X_list, Y_list: The stored and the new samples, in the same format as get_blend_grade_data.
+    """
+    if path is None:
+        path = "blend_grade_data_robusta.npz" if robusta else "blend_grade_data_no_robusta.npz"
+
+    since = None
+    X_stored, Y_stored, keys_stored, dates_stored = None, None, np.array([], dtype=str), np.array([], dtype="datetime64[ns]")
+    if os.path.exists(path):
+        with np.load(path, allow_pickle=False) as store:
+            X_stored, Y_stored, keys_stored, dates_stored = store["X"], store["Y"], store["keys"], store["dates"]
+        if len(dates_stored) > 0:
+            since = pd.Timestamp(dates_stored.max()) - pd.Timedelta(days=lookback_days)
+
+    X_new, Y_new, keys_new, dates_new = get_blend_grade_samples(robusta, since)
+
+    if len(X_new) == 0:
+        X, Y, keys, dates = X_stored, Y_stored, keys_stored, dates_stored
+    elif X_stored is None:
+        X, Y, keys, dates = X_new, Y_new, keys_new, dates_new
+    else:
+        # Keep the stored samples which have not been fetched again
+        keep = ~np.isin(keys_stored, keys_new)
+        X = np.concatenate([X_stored[keep], X_new])
+        Y = np.concatenate([Y_stored[keep], Y_new])
+        keys = np.concatenate([keys_stored[keep], keys_new])
+        dates = np.concatenate([dates_stored[keep], dates_new])
+
+    if X is None:
+        return np.array([]), np.array([])
+    np.savez(path, X=X, Y=Y, keys=keys, dates=dates)
+    bf.log_insert("ti_data_preprocessing.py", f"{len(X_new)} samples processed since {since}, {len(X)} samples stored in {path}.")
+
+    return X, Y
+
+
+def blend_grade_sample_key(ordre_p, dato_p, level, group_id, contracts) -> str:
+    """
+    Returns a key identifying a sample across runs, which does not depend on the tasting ids of the run.
+    The key consists of the graded order, the date of the grade, the batch (B) or production order (P) id and
+    the contracts and deliveries used, given as a list of "contract/delivery".
+    """
+    return "|".join([str(int(ordre_p))
+                     ,str(pd.Timestamp(dato_p))
+                     ,f"{level}{int(group_id)}"
+                     ,";".join(contracts)])
+
+
+# Each source query runs once per call, also when several of the queries depend on it
+@bf.query_cache()
+def get_blend_grade_samples(robusta=True, since=None):
+    """
+    Get the dataset of get_blend_grade_data together with a key and the grade date of each sample.
+    :param robusta: Boolean for whether or not to consider robusta flavor.
+    :param since: If given, only products and test roastings graded on or after this date are processed.
+    :return X_list, Y_list, keys, dates: The input flavors (X) and output flavors (Y), a key identifying each sample
+        (see blend_grade_sample_key) and the date each output product was graded.
+    """
     # Define bar_recipes for later use to determine whether to proces on batch or production order level
     bar_recipes = ('10401005','10401207')
     # Get data for coffee contracts
@@ -22,13 +96,13 @@ def get_blend_grade_data(robusta=True):
     # Get data about recipes
     recipes = bf.get_recipe_information()[["Receptnummer", "Farve sætpunkt"]].rename(columns={"Farve sætpunkt": "Farve"})
     # Get all potentially relevant roaster input (green coffee consumption)
-    roaster_input = bf.get_roaster_input() \
+    roaster_input = bf.get_roaster_input(since) \
         [["Dato", "Produktionsordre id", "Batch id", "Kontraktnummer", "Modtagelse", "Kilo"]] \
         .rename(columns={"Dato": "Dato_rist",
                          "Kilo": "Kilo_rist_input"}) \
         .dropna()
     # Get all potentially relevant roaster output
-    roaster_output = bf.get_roaster_output().dropna(subset=["Ordrenummer"]).astype({"Ordrenummer": np.int64}) \
+    roaster_output = bf.get_roaster_output(since).dropna(subset=["Ordrenummer"]).astype({"Ordrenummer": np.int64}) \
         [["Produktionsordre id", "Batch id", "Ordrenummer", "Receptnummer", "Kilo"]] \
         .rename(columns={"Kilo": "Kilo_rist_output",
                          "Ordrenummer": "Ordre_rist"}) \
@@ -47,7 +121,7 @@ def get_blend_grade_data(robusta=True):
                                            "Eftersmag_r"])
     
     # Get grades for the finished products
-    product_grades = bf.get_finished_goods_grades() \
+    product_grades = bf.get_finished_goods_grades(since) \
         [["Dato", "Ordrenummer", "Syre", "Krop", "Aroma", "Eftersmag", "Robusta"]] \
         .rename(columns={"Dato": "Dato_p",
                          "Ordrenummer": "Ordre_p",
@@ -69,7 +143,7 @@ def get_blend_grade_data(robusta=True):
     product_grades["Smagningsid"] = list(range(len(product_grades)))
     
     # Get data for the relationships between orders
-    orders = bf.get_order_relationships() \
+    orders = bf.get_order_relationships(since) \
         .rename(columns={"Ordre": "Ordre_p",
                          "Relateret ordre": "Ordre_rist"}) \
         .dropna().astype({'Ordre_p': np.int64,'Ordre_rist': np.int64})
@@ -100,7 +174,7 @@ def get_blend_grade_data(robusta=True):
         .drop_duplicates(subset=["Kontraktnummer", "Modtagelse", "Produktionsordre id", "Batch id",
                                  "Ordre_rist", "Ordre_p", "Kilo_rist_input"])
     
-    max_tasting_id = max(list(set(filtered_data["Smagningsid"]))) + 1
+    max_tasting_id = max(list(set(filtered_data["Smagningsid"])), default=-1) + 1
     
     
     
@@ -129,7 +203,7 @@ def get_blend_grade_data(robusta=True):
     filtered_data["Kilo_rist_input"] = filtered_data["Kilo_rist_input"] * filtered_data["Faktorfelt"].fillna(1)
     
     # Add testing data to dataset
-    df_testing_data = bf.get_test_roastings(robusta,max_tasting_id)
+    df_testing_data = bf.get_test_roastings(robusta,max_tasting_id,since)
     filtered_data = pd.concat([filtered_data,df_testing_data],ignore_index=True).reset_index()
     filtered_data.drop(columns=["index","Faktorfelt"],inplace = True)
     # Remove duplicates from tastings and add to roaster input
@@ -137,81 +211,130 @@ def get_blend_grade_data(robusta=True):
     roaster_input = pd.concat([roaster_input,df_testing_data], ignore_index = True)[roaster_input.columns].reset_index()
     
     
-    tasting_ids = list(set(filtered_data["Smagningsid"]))
-    X_list = []
-    Y_list = []
-    
-    for t_id in tasting_ids:
-        
-        tasting_data = filtered_data[filtered_data["Smagningsid"] == t_id]
-        batch_ids = list(set(tasting_data["Batch id"]))
-        prod_ids = list(set(tasting_data["Produktionsordre id"]))
-    
-        # If the produced recipes are used for BAR blends, do the analysis on "Produktionsordre"-level
-        if not set(tasting_data['Receptnummer']).isdisjoint(bar_recipes):
-            for p_id in prod_ids:
-                prod_data = tasting_data[tasting_data["Produktionsordre id"] == p_id]
-                full_prod = roaster_input[roaster_input["Produktionsordre id"] == p_id]
-                weight_tasted_prod = sum(prod_data["Kilo_rist_input"])
-                weight_full_prod = sum(full_prod["Kilo_rist_input"])
-    
-                if 1.0 - weight_tasted_prod / weight_full_prod < 0.1: #Use data if we have data for 90% of the production order
-                    weight_per_contract = prod_data[["Kontraktnummer", "Modtagelse", "Kilo_rist_input"]] \
-                        .groupby(["Kontraktnummer", "Modtagelse"]).sum()
-                    unique_contracts = prod_data.groupby(["Kontraktnummer", "Modtagelse"]).mean()
-    
-                    if 0 < len(unique_contracts) <= 7: # Only use data if we have 7 or fewer unique contracts used in the order, to ensure same dimensions as our input in the model
-                        unique_contracts["Proportion"] = weight_per_contract["Kilo_rist_input"] / \
-                                                         sum(weight_per_contract["Kilo_rist_input"])
-    
-                        if robusta:
-                            x_data = unique_contracts[
-                                ["Syre_r", "Krop_r", "Aroma_r", "Eftersmag_r", "Robusta_r", "Proportion"]]
-                            y_data = unique_contracts[["Syre_p", "Krop_p", "Aroma_p", "Eftersmag_p", "Robusta_p"]][0:1]
-                        else:
-                            x_data = unique_contracts[["Syre_r", "Krop_r", "Aroma_r", "Eftersmag_r", "Proportion"]]
-                            y_data = unique_contracts[["Syre_p", "Krop_p", "Aroma_p", "Eftersmag_p"]][0:1]
-    
-                        x_np = x_data.to_numpy()
-                        y_np = y_data.to_numpy()
-                        if len(unique_contracts) < 7:
-                            x_np = np.pad(x_np, constant_values=0, pad_width=[[0, 7 - len(unique_contracts)], [0, 0]])
-    
-                        farve = unique_contracts[["Farve"]][0:1].to_numpy()
-                        X_list.append(np.append(x_np.flatten(), farve))
-                        Y_list.append(y_np.flatten())
-        # Else we can do the processing on "Batch"-level
-        else:
-            for b_id in batch_ids:
-                batch_data = tasting_data[tasting_data["Batch id"] == b_id]
-                full_batch = roaster_input[roaster_input["Batch id"] == b_id]
-                weight_tasted_batch = sum(batch_data["Kilo_rist_input"])
-                weight_full_batch = sum(full_batch["Kilo_rist_input"])
-                if 1.0 - weight_tasted_batch / weight_full_batch < 0.1:
-                    weight_per_contract = batch_data[["Kontraktnummer", "Modtagelse", "Kilo_rist_input"]] \
-                        .groupby(["Kontraktnummer", "Modtagelse"]).sum()
-                    unique_contracts = batch_data.groupby(["Kontraktnummer", "Modtagelse"]).mean()
-    
-                    if 0 < len(unique_contracts) <= 7:
-                        unique_contracts["Proportion"] = weight_per_contract["Kilo_rist_input"] / \
-                                                         sum(weight_per_contract["Kilo_rist_input"])
-    
-                        if robusta:
-                            x_data = unique_contracts[
-                                ["Syre_r", "Krop_r", "Aroma_r", "Eftersmag_r", "Robusta_r", "Proportion"]]
-                            y_data = unique_contracts[["Syre_p", "Krop_p", "Aroma_p", "Eftersmag_p", "Robusta_p"]][0:1]
-                        else:
-                            x_data = unique_contracts[["Syre_r", "Krop_r", "Aroma_r", "Eftersmag_r", "Proportion"]]
-                            y_data = unique_contracts[["Syre_p", "Krop_p", "Aroma_p", "Eftersmag_p"]][0:1]
-    
-                        x_np = x_data.to_numpy()
-                        y_np = y_data.to_numpy()
-                        if len(unique_contracts) < 7:
-                            x_np = np.pad(x_np, constant_values=0, pad_width=[[0, 7 - len(unique_contracts)], [0, 0]])
-    
-                        farve = unique_contracts[["Farve"]][0:1].to_numpy()
-                        X_list.append(np.append(x_np.flatten(), farve))
-                        Y_list.append(y_np.flatten())
-
-    return np.array(X_list), np.array(Y_list)
+    # Flavor columns of the green coffees used as model input and of the finished products used as target
+    flavor_columns_r = ["Syre_r", "Krop_r", "Aroma_r", "Eftersmag_r"]
+    flavor_columns_p = ["Syre_p", "Krop_p", "Aroma_p", "Eftersmag_p"]
+    if robusta:
+        flavor_columns_r.append("Robusta_r")
+        flavor_columns_p.append("Robusta_p")
+
+    return build_blend_grade_samples(filtered_data, roaster_input, flavor_columns_r, flavor_columns_p, bar_recipes)
+
+
+def build_blend_grade_samples(filtered_data, roaster_input, flavor_columns_r, flavor_columns_p, bar_recipes):
+    """
+    Create a sample for each batch of each tasting, or for each production order if the tasting includes BAR recipes.
+    A sample is only created if the tasted weight is at least 90% of the weight of the batch or production order in
+    the roaster input, and the batch or production order consists of 1 to 7 unique contracts and deliveries.
+    All tastings are processed at once with grouped operations. The samples are returned in the order of the set of
+    tasting ids and the set of batch or production order ids within each tasting, and all sums are added in the same
+    order as when the tastings were processed one at a time, so the result is identical.
+    Batches and production orders missing in the roaster input are skipped.
+    :param filtered_data: The green coffees used for each tasting, with grades for the green coffees and the product.
+    :param roaster_input: All green coffee used for the roasting orders.
+    :param flavor_columns_r: The columns with the grades of the green coffees.
+    :param flavor_columns_p: The columns with the grades of the finished products.
+    :param bar_recipes: The recipes used for BAR blends.
+    :return X_list, Y_list, keys, dates: See get_blend_grade_samples.
+    """
+    if len(filtered_data) == 0:
+        return np.array([]), np.array([]), np.array([], dtype=str), np.array([], dtype="datetime64[ns]")
+    # Grades are averaged and returned as float64 like the stored samples
+    data = filtered_data.reset_index(drop=True).astype(dict.fromkeys(flavor_columns_r + flavor_columns_p, np.float64))
+
+    # If the produced recipes are used for BAR blends, do the analysis on "Produktionsordre"-level, else on "Batch"-level
+    bar_tasting = data["Receptnummer"].isin(bar_recipes).groupby(data["Smagningsid"]).transform("any").to_numpy()
+    data["Gruppe id"] = np.where(bar_tasting, data["Produktionsordre id"], data["Batch id"])
+
+    # Number each combination of tasting and batch or production order, and get the first row of each
+    pairs = data.groupby(["Smagningsid", "Gruppe id"], sort=False).ngroup().to_numpy()
+    n_pairs = pairs.max() + 1
+    _, first_rows = np.unique(pairs, return_index=True)
+    pair_tastings = data["Smagningsid"].to_numpy()[first_rows]
+    pair_groups = data["Gruppe id"].to_numpy()[first_rows]
+    pair_bar = bar_tasting[first_rows]
+
+    # Use data if we have data for 90% of the batch or production order
+    weight_tasted = sequential_group_sum(pairs, data["Kilo_rist_input"].to_numpy(dtype=float), n_pairs)
+    weight_full = np.where(pair_bar
+                           ,group_weights(roaster_input, "Produktionsordre id").reindex(pair_groups).to_numpy()
+                           ,group_weights(roaster_input, "Batch id").reindex(pair_groups).to_numpy())
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covered = (weight_full != 0) & (1.0 - weight_tasted / weight_full < 0.1)
+
+    # Weight and mean grades per contract and delivery, sorted by contract and delivery within each pair
+    contract_groups = data.assign(Par=pairs).groupby(["Par", "Kontraktnummer", "Modtagelse"], observed=True)
+    weight_per_contract = contract_groups["Kilo_rist_input"].sum()
+    unique_contracts = contract_groups[flavor_columns_r + flavor_columns_p + ["Farve"]].mean()
+    contract_pairs = weight_per_contract.index.get_level_values("Par").to_numpy()
+    contracts_per_pair = np.bincount(contract_pairs, minlength=n_pairs)
+    proportions = weight_per_contract.to_numpy() / sequential_group_sum(contract_pairs, weight_per_contract.to_numpy()
+                                                                        ,n_pairs)[contract_pairs]
 
+    # Only use data if we have 7 or fewer unique contracts, to ensure same dimensions as our input in the model
+    valid_pairs = np.flatnonzero(covered & (contracts_per_pair > 0) & (contracts_per_pair <= 7))
+    # Order samples by the set of tasting ids and the set of batch or production order ids within each tasting
+    tasting_order = {t_id: i for i, t_id in enumerate(list(set(data["Smagningsid"])))}
+    group_order = {}
+    for t_id, group_ids in data.groupby("Smagningsid", sort=False)["Gruppe id"].unique().items():
+        for i, g_id in enumerate(list(set(group_ids))):
+            group_order[(t_id, g_id)] = i
+    sample_order = sorted(valid_pairs, key=lambda pair: (tasting_order[pair_tastings[pair]]
+                                                         ,group_order[(pair_tastings[pair], pair_groups[pair])]))
+    sample_pairs = np.array(sample_order, dtype=np.int64)
+
+    # Write flavors, proportions, padding and color in the same layout as used for predictions
+    first_contracts = np.searchsorted(contract_pairs, sample_pairs)
+    sample_sizes = contracts_per_pair[sample_pairs]
+    positions = np.arange(7)
+    indices = np.where(positions < sample_sizes[:, None], first_contracts[:, None] + positions, -1)
+    X = tpo.encode_blends_model_input(indices
+                                      ,np.where(indices != -1, proportions[np.maximum(indices, 0)], 0)
+                                      ,unique_contracts[flavor_columns_r].to_numpy()
+                                      ,unique_contracts["Farve"].to_numpy()[first_contracts])
+    Y = unique_contracts[flavor_columns_p].to_numpy()[first_contracts]
+
+    # Keys and grade dates of the samples, using the first row of each tasting
+    first_tasting_rows = data.drop_duplicates(subset=["Smagningsid"]).set_index("Smagningsid")
+    contract_names = (weight_per_contract.index.get_level_values("Kontraktnummer").astype(str) + "/"
+                      + weight_per_contract.index.get_level_values("Modtagelse").astype(str))
+    contract_lists = pd.Series(contract_names).groupby(contract_pairs).agg(list)
+    ordre_p = first_tasting_rows["Ordre_p"].reindex(pair_tastings[sample_pairs]).to_numpy()
+    dates = first_tasting_rows["Dato_p"].reindex(pair_tastings[sample_pairs]).to_numpy()
+    keys = [blend_grade_sample_key(ordre, dato, "P" if pair_bar[pair] else "B", pair_groups[pair], contract_lists[pair])
+            for ordre, dato, pair in zip(ordre_p, dates, sample_pairs)]
+
+    if len(sample_pairs) == 0:
+        return np.array([]), np.array([]), np.array([], dtype=str), np.array([], dtype="datetime64[ns]")
+    return X, Y, np.array(keys, dtype=str), np.array(dates, dtype="datetime64[ns]")
+
+
+def group_weights(roaster_input, id_column):
+    """Returns the total roasted weight for each id in id_column of the roaster input, added in row order."""
+    codes, ids = pd.factorize(roaster_input[id_column])
+    weights = sequential_group_sum(codes, roaster_input["Kilo_rist_input"].to_numpy(dtype=float), len(ids))
+    return pd.Series(weights, index=ids)
+
+
+def sequential_group_sum(codes, values, n_groups):
+    """
+    Returns the sum of the values for each group code from 0 to n_groups - 1. The values of each group are added one
+    at a time in the order they appear, which gives the same result as the built-in sum of the values of each group.
+    Rows with a negative code are ignored.
+    """
+    codes = np.asarray(codes)
+    values = np.asarray(values, dtype=float)
+    sums = np.zeros(n_groups)
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0]
+    sorted_codes = codes[order]
+    # Position of each value within its group. Adding the n'th value of all groups at once keeps the order per group.
+    positions = np.arange(len(order)) - np.searchsorted(sorted_codes, sorted_codes)
+    by_position = np.argsort(positions, kind="stable")
+    bounds = np.cumsum(np.bincount(positions)) if len(positions) else []
+    start = 0
+    for end in bounds:
+        rows = order[by_position[start:end]]
+        sums[codes[rows]] += values[rows]
+        start = end
+    return sums
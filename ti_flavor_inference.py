@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import joblib
+
+
+# Largest absolute difference to the predictions of the sklearn model the float32 predictions are expected to have.
+# The float32 rounding gives differences of the order 1e-5 for the 300-200-100-100 tanh flavor models on the 0-10 scale.
+tolerance = 1e-3
+
+
+def apply_activation(name, x):
+    """Applies the activation function of an sklearn MLP with the input name to the array x in place."""
+    if name == "tanh":
+        np.tanh(x, out=x)
+    elif name == "relu":
+        np.maximum(x, 0, out=x)
+    elif name == "logistic":
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        x += 1
+        np.reciprocal(x, out=x)
+    elif name != "identity":
+        raise ValueError(f"Unknown activation function: {name}")
+
+
+class FlavorPredictor:
+    """
+    A lightweight replacement for the predict method of a trained sklearn MLPRegressor flavor model.
+    The weights are stored as float32, and the activations of each layer are written into buffers which are reused
+    between calls, so a prediction is only the matrix products and activation functions without the input validation
+    of sklearn. Predictions match the sklearn model within the module tolerance.
+    The buffers make an instance unsafe to use from several threads at the same time, use one instance per thread.
+    :param weights: A list with the weight matrix of each layer, as coefs_ of the MLPRegressor.
+    :param biases: A list with the bias vector of each layer, as intercepts_ of the MLPRegressor.
+    :param activation: The activation function of the hidden layers.
+    :param out_activation: The activation function of the output layer.
+    :param max_rows: The max number of rows predicted at a time, larger inputs are predicted in parts so the buffers
+        stay small. Defaults to 100000.
+    :param threads: The max number of threads used by BLAS for the matrix products. Defaults to None, which does not
+        limit the threads. Limiting the threads adds an overhead to each call, so only use it for large inputs or when
+        several processes predict at the same time.
+    """
+
+    def __init__(self, weights, biases, activation="tanh", out_activation="identity", max_rows=100000, threads=None):
+        self.weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.ascontiguousarray(b, dtype=np.float32) for b in biases]
+        self.activation = activation
+        self.out_activation = out_activation
+        self.max_rows = max_rows
+        self.threads = threads
+        self._buffers = []
+
+    @classmethod
+    def from_mlp(cls, mlp, **kwargs):
+        """Returns a FlavorPredictor with the weights of a trained sklearn MLPRegressor."""
+        return cls(mlp.coefs_, mlp.intercepts_, mlp.activation, mlp.out_activation_, **kwargs)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Returns the FlavorPredictor saved in the input .npz file with save."""
+        with np.load(path) as data:
+            number_of_layers = sum(1 for name in data.files if name.startswith("weights_"))
+            return cls([data[f"weights_{i}"] for i in range(number_of_layers)]
+                       ,[data[f"biases_{i}"] for i in range(number_of_layers)]
+                       ,*[str(activation) for activation in data["activations"]]
+                       ,**kwargs)
+
+    def save(self, path):
+        """Saves the weights and activation functions in an uncompressed .npz file, which loads faster than a pickle."""
+        np.savez(path
+                 ,activations=np.array([self.activation, self.out_activation])
+                 ,**{f"weights_{i}": w for i, w in enumerate(self.weights)}
+                 ,**{f"biases_{i}": b for i, b in enumerate(self.biases)})
+
+    def __getstate__(self):
+        # The buffers are not sent along when the predictor is pickled, e.g. to another process
+        state = self.__dict__.copy()
+        state["_buffers"] = []
+        return state
+
+    @property
+    def n_features_in_(self) -> int:
+        return self.weights[0].shape[0]
+
+    def layer_buffers(self, rows):
+        """Returns the activation buffers of the input and each layer, with room for at least the input number of rows."""
+        if not self._buffers or len(self._buffers[0]) < rows:
+            self._buffers = [np.empty((rows, self.n_features_in_), dtype=np.float32)] \
+                          + [np.empty((rows, len(b)), dtype=np.float32) for b in self.biases]
+        return self._buffers
+
+    def predict_rows(self, X) -> np.ndarray:
+        """Returns the predictions of at most max_rows rows of model input."""
+        buffers = self.layer_buffers(len(X))
+        activations = buffers[0][:len(X)]
+        activations[...] = X
+        for layer, (w, b) in enumerate(zip(self.weights, self.biases)):
+            output = buffers[layer + 1][:len(X)]
+            np.dot(activations, w, out=output)
+            output += b
+            apply_activation(self.activation if layer < len(self.weights) - 1 else self.out_activation, output)
+            activations = output
+        return activations.astype(np.float64)
+
+    def predict(self, X) -> np.ndarray:
+        """
+        Returns the predicted flavors for rows of model input, with the layout described in tpo.encode_model_input,
+        as an array of float64 with one row per input row like the predict method of the sklearn model.
+        """
+        X = np.asarray(X)
+        if self.threads is None:
+            return self.predict_parts(X)
+        from threadpoolctl import threadpool_limits
+        with threadpool_limits(limits=self.threads, user_api="blas"):
+            return self.predict_parts(X)
+
+    def predict_parts(self, X) -> np.ndarray:
+        """Returns the predictions of rows of model input, predicted max_rows rows at a time."""
+        if len(X) <= self.max_rows:
+            return self.predict_rows(X)
+        return np.concatenate([self.predict_rows(X[start:start + self.max_rows])
+                               for start in range(0, len(X), self.max_rows)])
+
+
+def inference_file_name(model_name):
+    """Returns the name of the .npz file with the FlavorPredictor exported from the flavor model saved in model_name."""
+    return os.path.splitext(model_name)[0] + ".npz"
+
+
+def export_flavor_model(mlp, model_name):
+    """
+    Saves the weights of a trained MLPRegressor for use with FlavorPredictor next to the model saved in model_name.
+    :return: The exported FlavorPredictor.
+    """
+    flavor_predictor = FlavorPredictor.from_mlp(mlp)
+    flavor_predictor.save(inference_file_name(model_name))
+    return flavor_predictor
+
+
+def load_flavor_model(model_name, **kwargs):
+    """
+    Returns the flavor model saved in model_name. If the weights have been exported for a FlavorPredictor after the
+    model was saved, the FlavorPredictor is returned instead of unpickling the sklearn model.
+    Keyword arguments are passed to the FlavorPredictor.
+    """
+    inference_name = inference_file_name(model_name)
+    if os.path.exists(inference_name) and (not os.path.exists(model_name)
+                                           or os.path.getmtime(inference_name) >= os.path.getmtime(model_name)):
+        return FlavorPredictor.load(inference_name, **kwargs)
+    return joblib.load(model_name)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import ti_price_opt as tpo
+
+
+class FlavorSurrogate:
+    """
+    A linear model of the flavor model, used to discard blends that can not be fitting before they are predicted by
+    the flavor model. The predicted flavors of a blend are a linear function of the proportion weighted flavors and
+    squared flavors of its components and the roast color:
+        flavors = sum(p_i * f_i) @ W1 + sum(p_i * f_i ** 2) @ W2 + color * w_color + b
+    so the surrogate of many blends is found with a single matrix multiplication, and each component adds
+    p_i * contribution_i to the prediction, with contribution_i = f_i @ W1 + f_i ** 2 @ W2.
+    margin is a difference between the surrogate and the flavor model which is rarely exceeded, a blend is only
+    discarded if its surrogate differs more than cut-off value + margin from the target.
+    model_file and model_modified identify the saved flavor model the surrogate was fitted to, see set_flavor_model.
+    """
+
+    def __init__(self, coefficients=None, margin=0.0):
+        self.coefficients = coefficients
+        self.margin = margin
+        self.model_file = None
+        self.model_modified = None
+
+    @classmethod
+    def weighted_average(cls, number_of_flavors):
+        """
+        Returns a surrogate which predicts the proportion weighted average of the component flavors, for use when no
+        surrogate has been fitted for a flavor model.
+        """
+        D = number_of_flavors
+        coefficients = np.zeros((2 * D + 2, D))
+        coefficients[:D] = np.eye(D)
+        return cls(coefficients)
+
+    @staticmethod
+    def model_input_features(X):
+        """
+        Returns the features of the surrogate for rows of flavor model input, with the layout described in
+        tpo.encode_model_input. Placeholder components have the proportion 0 and do not add to the features.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        components = X[:, :-1].reshape(len(X), 7, -1)
+        flavors, proportions = components[:, :, :-1], components[:, :, -1:]
+        return np.hstack([(proportions * flavors).sum(axis=1)
+                          ,(proportions * flavors ** 2).sum(axis=1)
+                          ,X[:, -1:]
+                          ,np.ones((len(X), 1))])
+
+    def fit(self, X, Y):
+        """
+        Fits the coefficients by least squares to rows of flavor model input X and flavors Y.
+        Use the predictions of the flavor model as Y to fit a surrogate of the flavor model.
+        :return: The fitted surrogate.
+        """
+        self.coefficients = np.linalg.lstsq(self.model_input_features(X), np.asarray(Y, dtype=np.float64), rcond=None)[0]
+        return self
+
+    def predict(self, X):
+        """Returns the surrogate flavors of rows of flavor model input."""
+        return self.model_input_features(X) @ self.coefficients
+
+    def contributions(self, candidates):
+        """
+        Returns an array with one row per candidate with the flavors a candidate adds to the surrogate of a blend
+        per unit of its proportion.
+        """
+        candidates = np.asarray(candidates, dtype=np.float64)
+        D = candidates.shape[1]
+        return candidates @ self.coefficients[:D] + candidates ** 2 @ self.coefficients[D:2 * D]
+
+    def intercept(self, color):
+        """Returns the part of the surrogate flavors which does not depend on the components of a blend."""
+        return color * self.coefficients[-2] + self.coefficients[-1]
+
+    def predict_blends(self, blends, candidates, color, contributions=None):
+        """
+        Returns the surrogate flavors of a number of blends, given as a BlendArrays or a list of blends, with one row
+        per blend. Pass the contributions of the candidates when predicting several chunks of blends for one request.
+        """
+        if contributions is None:
+            contributions = self.contributions(candidates)
+        blends = tpo.blends_to_arrays(blends)
+        indices = blends.indices.astype(np.int64)
+        proportions = np.where(indices != -1, blends.proportions, 0).astype(np.float64)
+        return np.einsum("nc,ncd->nd", proportions, contributions[np.maximum(indices, 0)]) + self.intercept(color)
+
+    def calibrate(self, X, model_predictions, quantile=0.999, safety_factor=1.2):
+        """
+        Sets the margin from the largest difference between the surrogate and the flavor model predictions for each
+        row of flavor model input X. The margin is the quantile of these differences multiplied by safety_factor, a
+        quantile below 1 accepts that a few blends the flavor model would accept are discarded, in return for a
+        margin which is not set by the few blends the surrogate predicts worst.
+        :return: The margin.
+        """
+        residuals = np.abs(self.predict(X) - model_predictions).max(axis=1)
+        self.margin = float(np.quantile(residuals, quantile) * safety_factor)
+        return self.margin
+
+    def set_flavor_model(self, model_name):
+        """
+        Records the file name and modification time of the saved flavor model the surrogate was fitted to.
+        :return: The surrogate.
+        """
+        self.model_file = os.path.basename(model_name)
+        self.model_modified = os.path.getmtime(model_name)
+        return self
+
+    def matches_flavor_model(self, model_name) -> bool:
+        """
+        Returns True if the flavor model saved in model_name is the model the surrogate was fitted to, by its file
+        name and modification time. A surrogate saved without its flavor model never matches.
+        """
+        return (getattr(self, "model_file", None) == os.path.basename(model_name)
+                and getattr(self, "model_modified", None) == os.path.getmtime(model_name))
+
+    def false_reject_rate(self, X, model_predictions, targets, cut_off_value, margin=None):
+        """
+        Returns the share of the rows of flavor model input X accepted by the flavor model, which are discarded by
+        the surrogate. A row is accepted if no predicted flavor differs more than cut_off_value from its target and
+        discarded if a surrogate flavor differs more than cut_off_value + margin from its target.
+        Use a validation set which was not used to fit or calibrate the surrogate, with the grades as targets.
+        """
+        margin = self.margin if margin is None else margin
+        accepted = ~(np.abs(model_predictions - targets).max(axis=1) > cut_off_value)
+        discarded = np.abs(self.predict(X) - targets).max(axis=1) > cut_off_value + margin
+        return float((accepted & discarded).sum() / accepted.sum()) if accepted.any() else 0.0
+
+    def statistics(self, X, model_predictions, targets, cut_off_value) -> str:
+        """Returns a text with the accuracy and the false-reject rate of the surrogate on a validation set."""
+        residuals = np.abs(self.predict(X) - model_predictions).max(axis=1)
+        return f"Flavor surrogate: margin {self.margin:.3f}, " \
+               f"median max difference to the flavor model {np.median(residuals):.3f}, " \
+               f"{(residuals > self.margin).mean():.2%} of validation blends outside margin, " \
+               f"false-reject rate {self.false_reject_rate(X, model_predictions, targets, cut_off_value):.2%} at cut-off {cut_off_value}."
+
+
+def surrogate_file_name(model_name):
+    """Returns the name of the file with the surrogate of the flavor model saved in model_name."""
+    return model_name.replace("flavor_predictor", "flavor_surrogate")
@@ -3,13 +3,15 @@
 
 import random
 import statistics
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from deap import base, creator, tools, algorithms
 from sklearn import preprocessing
 
 
 def ga_cheapest_blend(contracts, flavors, prices, flavor_model, target_flavor, roast_color, MIN_C=1, MAX_C=7,
-                      MIN_P=0.06, MAX_P=1.00):
+                      MIN_P=0.06, MAX_P=1.00, prediction_cache=None, islands=1, migration_interval=10, migration_size=5):
     """
     This function finds the cheapest coffee blend that is within a tolerance of +/- 1 of each dimension of the
     target taste.
@@ -22,7 +24,8 @@ def ga_cheapest_blend(contracts, flavors, prices, flavor_model, target_flavor, r
     :param flavor_model: A model that takes as input a (MAX_C + 1) * d + 1 size input, which is the result of concatenating the flavor
         vectors and proportions of the given components, padding with 0 and finally tacking the roast color on the end
         of the vector. The model returns a prediction of the flavor vector of the given blend. These models are
-        typically loaded from a .sav file with joblib.load()
+        typically loaded from a .sav file with ti_flavor_inference.load_flavor_model(), which returns the lighter
+        FlavorPredictor when its weights have been exported.
     :param target_flavor: A numpy array of length d which corresponds to the targeted flavor for the blend.
     :param roast_color: The roast color of the blend
     :param MIN_C: The minimum number of components in a blend. Defaults to 1 and should probably not be changed.
@@ -31,6 +34,14 @@ def ga_cheapest_blend(contracts, flavors, prices, flavor_model, target_flavor, r
     :param MIN_P: The minimum proportion of a single component. Default to 0.06, but can be changed to allow even smaller
         proportions or require larger ones.
     :param MAX_P: The maximum proportion of a single component. Defaults to 1.00 and should probably not be changed.
+    :param prediction_cache: A PredictionCache for the flavor model and flavors. Pass a cache to reuse the predictions
+        of the optimization afterwards, e.g. with taste_pred. Defaults to None, which creates a new cache for the run.
+        The cache is not used when islands is above 1, each island process has its own cache.
+    :param islands: The number of sub-populations evolved in parallel, each in its own process. Defaults to 1, which
+        evolves a single population in the current process. The population of 1000 blends is split between the islands.
+    :param migration_interval: The number of generations between migrations when islands is above 1. Defaults to 10.
+    :param migration_size: The number of best blends from each island that replace the worst blends of the next
+        island at each migration. Defaults to 5.
     :return pop, logbook, hof: The final population of optimized blends, the logbook containing statistics of the
         optimization run, and the hall of fame containing best individuals seen.
     """
@@ -40,13 +51,48 @@ def ga_cheapest_blend(contracts, flavors, prices, flavor_model, target_flavor, r
     assert (len(contracts) == len(prices))
 
     N = len(contracts)
-    
     # Prevent error if number of available components is less than max components allowed
     MAX_C = N if MAX_C > N else MAX_C
 
+    if islands > 1:
+        return ga_cheapest_blend_islands(flavors, prices, flavor_model, target_flavor, roast_color, MIN_C, MAX_C, MIN_P,
+                                         MAX_P, islands, migration_interval, migration_size)
+
+    # Everything needed to evaluate blends for this request, prices are normalized once here.
+    # Blends seen before in the run are not predicted again by the flavor model.
+    if prediction_cache is None:
+        prediction_cache = PredictionCache(flavor_model, flavors)
+    context = FitnessContext(prices, flavor_model, flavors, target_flavor, roast_color, prediction_cache)
+    toolbox = ga_toolbox(N, context, MIN_C, MAX_C, MIN_P, MAX_P)
+
+    # Initialize a hall of fame, a population of 1000 blends, and some relevant statistics
+    pop = toolbox.population(n=1000)
+    hof = tools.HallOfFame(50, blends_too_similar)
+    mstats = ga_statistics()
+
+    # Run a simple evolutionary algorithm for 50 generations
+    pop, logbook = ea_simple_batched(pop, toolbox, cxpb=0.3, mutpb=0.6, ngen=50, halloffame=hof, stats=mstats,
+                                     verbose=True)
+
+    # Return the final population, the logbook with stats and information about the run, and the hall of fame.
+    return pop, logbook, hof
+
+
+def create_deap_types():
+    """Creates the fitness and individual types of the optimization problem, unless they have been created already."""
     # Start initializing the optimization problem as a maximization problem
-    creator.create("FitnessMax", base.Fitness, weights=(1.0,))
-    creator.create("Individual", list, fitness=creator.FitnessMax)
+    if not hasattr(creator, "FitnessMax"):
+        creator.create("FitnessMax", base.Fitness, weights=(1.0,))
+    if not hasattr(creator, "Individual"):
+        creator.create("Individual", list, fitness=creator.FitnessMax)
+
+
+def ga_toolbox(N, context, MIN_C=1, MAX_C=7, MIN_P=0.06, MAX_P=1.00):
+    """
+    Returns a toolbox with the functions used by the evolutionary algorithm for N available components, evaluating
+    blends with the input FitnessContext.
+    """
+    create_deap_types()
 
     # Register the functions for the evolutionary algorithm
     toolbox = base.Toolbox()
@@ -58,33 +104,217 @@ def ga_cheapest_blend(contracts, flavors, prices, flavor_model, target_flavor, r
     toolbox.register("mutate", mutate_blend, p_drop=0.5, p_mutp=0.5, p_mutc=0.5, N=N, MIN_C=MIN_C, MAX_C=MAX_C,
                      MIN_P=MIN_P, MAX_P=MAX_P)
     toolbox.register("select", tools.selTournament, tournsize=3)
-    toolbox.register("evaluate", blend_fitness, prices=prices, flavor_model=flavor_model, candidates=flavors, target=target_flavor,
-                     color=roast_color, MAX_C=MAX_C)
+    toolbox.register("evaluate", blend_fitness, prices=context.prices, flavor_model=context.flavor_model,
+                     candidates=context.candidates, target=context.target, color=context.color, MAX_C=MAX_C,
+                     scaled_prices=context.scaled_prices)
+    toolbox.register("evaluate_population", evaluate_population, context=context)
 
     # Add the normalize_p function to mate and mutate to make sure, that the blends are still valid after changes
     toolbox.decorate("mate", normalize_p(N=N, MIN_C=MIN_C, MIN_P=MIN_P, MAX_P=MAX_P))
     toolbox.decorate("mutate", normalize_p(N=N, MIN_C=MIN_C, MIN_P=MIN_P, MAX_P=MAX_P))
 
-    # Initialize a hall of fame, a population of 1000 blends, and some relevant statistics
-    pop = toolbox.population(n=1000)
-    hof = tools.HallOfFame(50, blends_too_similar)
+    return toolbox
+
+
+def ga_statistics():
+    """Returns the statistics recorded for each generation of the evolutionary algorithm."""
     stats_fit = tools.Statistics(key=lambda ind: ind.fitness.values)
-    stats_flavor = tools.Statistics(key=lambda ind: sum(taste_diff(ind, flavor_model, candidates=flavors,
-                                                                   target=target_flavor, color=roast_color,
-                                                                   MAX_C=MAX_C)))
+    # The flavor differences are stored on each individual when it is evaluated, so they are not predicted again
+    stats_flavor = tools.Statistics(key=lambda ind: ind.flavor_diff)
     mstats = tools.MultiStatistics(fitness=stats_fit, flavor_diff=stats_flavor)
     mstats.register("avg", np.mean)
     mstats.register("std", np.std)
     mstats.register("max", np.max)
+    return mstats
 
-    # Run a simple evolutionary algorithm for 50 generations
-    pop, logbook = algorithms.eaSimple(pop, toolbox, cxpb=0.3, mutpb=0.6, ngen=50, halloffame=hof, stats=mstats,
-                                       verbose=True)
 
-    # Return the final population, the logbook with stats and information about the run, and the hall of fame.
+def ga_cheapest_blend_islands(flavors, prices, flavor_model, target_flavor, roast_color, MIN_C, MAX_C, MIN_P, MAX_P,
+                              islands, migration_interval=10, migration_size=5):
+    """
+    The island version of ga_cheapest_blend. The population of 1000 blends is split into a number of islands that
+    evolve in parallel in a pool of processes. After every migration_interval generations the best blends of each
+    island replace the worst blends of the next island, and the islands continue evolving.
+    The hall of fame of each island is merged into a single hall of fame with blends_too_similar.
+    Blends are sent between processes as plain lists, so the islands also work where processes are spawned.
+    :return pop, logbook, hof: The final populations of all islands combined, a logbook with the statistics of each
+        island per generation, and the merged hall of fame.
+    """
+    ngen = 50
+    population_size = 1000 // islands
+    populations = [None] * islands
+    hof = tools.HallOfFame(50, blends_too_similar)
+    logbook = tools.Logbook()
+    logbook.header = ["gen", "island", "nevals"] + list(ga_statistics().keys())
+    create_deap_types()
+
+    with ProcessPoolExecutor(max_workers=islands, initializer=init_island_process,
+                             initargs=(prices, flavor_model, flavors, target_flavor, roast_color, MIN_C, MAX_C, MIN_P,
+                                       MAX_P)) as executor:
+        completed_gens = 0
+        while completed_gens < ngen:
+            epoch_gens = min(migration_interval, ngen - completed_gens)
+            # Each island gets its own seed, so a seeded run gives the same result every time
+            futures = [executor.submit(evolve_island, populations[i], population_size, epoch_gens,
+                                       random.randrange(2 ** 32)) for i in range(islands)]
+            results = [future.result() for future in futures]
+
+            hits, misses = 0, 0
+            for i, (population, island_hof, island_logbook, island_hits, island_misses) in enumerate(results):
+                populations[i] = population
+                hof.update([individual_from_plain(ind) for ind in island_hof])
+                record_island_logbook(logbook, island_logbook, i, completed_gens)
+                hits += island_hits
+                misses += island_misses
+            completed_gens += epoch_gens
+            print(f"Generation {completed_gens}: best fitness {hof[0].fitness.values[0]:.4f}, "
+                  f"island prediction caches {hits} hits, {misses} misses.")
+
+            if completed_gens < ngen:
+                migrate_islands(populations, migration_size)
+
+    pop = [individual_from_plain(ind) for population in populations for ind in population]
+
     return pop, logbook, hof
 
 
+# Set up in each process of an island pool by init_island_process
+island_setup = {}
+
+
+def init_island_process(prices, flavor_model, flavors, target_flavor, roast_color, MIN_C, MAX_C, MIN_P, MAX_P):
+    """Creates the toolbox and fitness context used by the islands evolved in this process."""
+    context = FitnessContext(prices, flavor_model, flavors, target_flavor, roast_color,
+                             PredictionCache(flavor_model, flavors))
+    island_setup["context"] = context
+    island_setup["toolbox"] = ga_toolbox(len(flavors), context, MIN_C, MAX_C, MIN_P, MAX_P)
+
+
+def evolve_island(population, population_size, ngen, seed):
+    """
+    Evolves an island for ngen generations in a process set up by init_island_process.
+    If population is None, a new population of population_size blends is created.
+    :return population, hof, logbook, hits, misses: The evolved population and the hall of fame of the island as plain
+        lists, the logbook, and the number of prediction cache hits and misses during the evolution.
+    """
+    random.seed(seed)
+    toolbox = island_setup["toolbox"]
+    prediction_cache = island_setup["context"].prediction_cache
+    hits, misses = prediction_cache.hits, prediction_cache.misses
+
+    if population is None:
+        pop = toolbox.population(n=population_size)
+    else:
+        pop = [individual_from_plain(ind) for ind in population]
+    hof = tools.HallOfFame(50, blends_too_similar)
+    pop, logbook = ea_simple_batched(pop, toolbox, cxpb=0.3, mutpb=0.6, ngen=ngen, halloffame=hof,
+                                     stats=ga_statistics())
+
+    return ([individual_to_plain(ind) for ind in pop], [individual_to_plain(ind) for ind in hof], logbook,
+            prediction_cache.hits - hits, prediction_cache.misses - misses)
+
+
+def individual_to_plain(individual) -> tuple:
+    """Returns an evaluated individual as a tuple of its blend, fitness values and flavor differences."""
+    return [tuple(component) for component in individual], individual.fitness.values, individual.flavor_diff
+
+
+def individual_from_plain(plain):
+    """Returns an evaluated individual from a tuple created by individual_to_plain."""
+    blend, fitness_values, flavor_diff = plain
+    individual = creator.Individual(blend)
+    individual.fitness.values = fitness_values
+    individual.flavor_diff = flavor_diff
+    return individual
+
+
+def migrate_islands(populations, migration_size):
+    """
+    Migrates blends between islands in a ring. The migration_size best blends of each island replace the worst blends
+    of the next island. The populations are lists of plain individuals and are changed in place.
+    """
+    migrants = [sorted(population, key=lambda ind: ind[1][0], reverse=True)[:migration_size]
+                for population in populations]
+    for i, population in enumerate(populations):
+        worst = np.argsort([ind[1][0] for ind in population], kind="stable")[:migration_size]
+        for position, migrant in zip(worst, migrants[i - 1]):
+            population[position] = migrant
+
+
+def record_island_logbook(logbook, island_logbook, island, completed_gens):
+    """
+    Adds the records of an island logbook to the combined logbook, numbering generations from the start of the run.
+    The initial record of a population that was already evaluated in an earlier epoch is skipped.
+    """
+    for i, entry in enumerate(island_logbook):
+        if entry["gen"] == 0 and completed_gens > 0:
+            continue
+        chapters = {name: {key: chapter[i][key] for key in ("avg", "std", "max")}
+                    for name, chapter in island_logbook.chapters.items()}
+        logbook.record(gen=completed_gens + entry["gen"], island=island, nevals=entry["nevals"], **chapters)
+
+
+def ea_simple_batched(population, toolbox, cxpb, mutpb, ngen, stats=None, halloffame=None, verbose=False):
+    """
+    The same evolutionary algorithm as deap.algorithms.eaSimple, but all individuals with an invalid fitness in a
+    generation are evaluated together with toolbox.evaluate_population instead of one at a time with toolbox.evaluate.
+    :return population, logbook: The final population and the logbook with statistics of the evolution.
+    """
+    logbook = tools.Logbook()
+    logbook.header = ["gen", "nevals"] + (stats.fields if stats else [])
+
+    # Evaluate the individuals with an invalid fitness
+    invalid_ind = [ind for ind in population if not ind.fitness.valid]
+    toolbox.evaluate_population(invalid_ind)
+
+    if halloffame is not None:
+        halloffame.update(population)
+
+    record = stats.compile(population) if stats else {}
+    logbook.record(gen=0, nevals=len(invalid_ind), **record)
+    if verbose:
+        print(logbook.stream)
+
+    # Begin the generational process
+    for gen in range(1, ngen + 1):
+        # Select the next generation individuals and vary the pool of individuals
+        offspring = toolbox.select(population, len(population))
+        offspring = algorithms.varAnd(offspring, toolbox, cxpb, mutpb)
+
+        # Evaluate the individuals with an invalid fitness
+        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+        toolbox.evaluate_population(invalid_ind)
+
+        if halloffame is not None:
+            halloffame.update(offspring)
+
+        # Replace the current population by the offspring
+        population[:] = offspring
+
+        record = stats.compile(population) if stats else {}
+        logbook.record(gen=gen, nevals=len(invalid_ind), **record)
+        if verbose:
+            print(logbook.stream)
+
+    return population, logbook
+
+
+def evaluate_population(individuals, context):
+    """
+    Evaluates the fitness of a list of individuals with a single prediction of the flavor model, using the
+    flavor model, prices and target of the input FitnessContext.
+    The fitness values are set directly on the individuals, and the predicted flavor differences are stored on each
+    individual as flavor_diff so they can be reused for statistics.
+    """
+    if len(individuals) == 0:
+        return
+    diffs = context.taste_diff_batch(individuals)
+    fitness = blend_fitness_batch(individuals, context, diffs)
+
+    for ind, ind_fitness, ind_diff in zip(individuals, fitness, diffs):
+        ind.fitness.values = (ind_fitness,)
+        ind.flavor_diff = ind_diff
+
+
 def initial_blend(N, MIN_C=1, MAX_C=7, MIN_P=0.06, MAX_P=1.00):
     """
     Create the initial blend consisting of components between MIN_C and MAX_C with proportions
@@ -256,21 +486,14 @@ def taste_diff(individual, flavor_model, candidates, target, color, MAX_C=7):
     Calculates the aboslut difference between the calculated taste profile of a blend and the target values.
     """
 
-    D = len(candidates[0, :])
     size = len(individual)
     components = [individual[i][0] for i in range(size) if individual[i][0] != -1]
     proportions = [individual[i][1] for i in range(size) if individual[i][0] != -1]
-    num_components = len(components)
 
-    model_input = np.array([])
-    for c, p in zip(components, proportions):
-        model_input = np.concatenate((model_input, candidates[c, :]))
-        model_input = np.concatenate((model_input, [p]))
-    model_input = np.concatenate((model_input, [0] * ((D + 1) * (size - num_components))))
-    model_input = np.concatenate((model_input, [color]))
+    model_input = encode_model_input(candidates[components, :], proportions, color)
 
     # Do no rounding of the predicted flavor to ensure that the tolerances of deviation from target values are not unintentionally inflated.
-    model_output = flavor_model.predict(np.array(model_input).reshape(1, -1))
+    model_output = flavor_model.predict(model_input.reshape(1, -1))
     
     return np.abs(target - model_output)
 
@@ -287,13 +510,22 @@ def blend_cost(individual, prices):
     return sum(costs)
 
 
-def blend_fitness(individual, prices, flavor_model, candidates, target, color, MAX_C=7):
+def scale_prices(prices):
+    """
+    Scales the prices to the range 0-1 with a MinMaxScaler, which is the scale used for the cost part of the fitness.
+    """
+    min_max_scaler = preprocessing.MinMaxScaler()
+    return min_max_scaler.fit_transform(prices)
+
+
+def blend_fitness(individual, prices, flavor_model, candidates, target, color, MAX_C=7, scaled_prices=None):
     """
     Returns a value of a scale 0-1 which indicates the proposed blends overall fitness as a candidate.
     The closer the value is to 1 the better fitness.
+    If the prices have already been scaled with scale_prices they can be passed as scaled_prices, so they are not
+    scaled again for every blend.
     """
-    min_max_scaler = preprocessing.MinMaxScaler()
-    prices = min_max_scaler.fit_transform(prices)
+    prices = scale_prices(prices) if scaled_prices is None else scaled_prices
     diff = taste_diff(individual, flavor_model, candidates, target, color, MAX_C)
     cost = blend_cost(individual, prices)
     flavor_bound = 1 / (2 ** np.mean(diff ** 3))
@@ -303,6 +535,282 @@ def blend_fitness(individual, prices, flavor_model, candidates, target, color, M
     return bki_blend_fitness
 
 
+class FitnessContext:
+    """
+    Holds everything needed to evaluate the fitness of blends for a single request.
+    The prices are scaled once when the context is created, instead of once for every evaluated blend.
+    If a PredictionCache is given, predictions are looked up in the cache before the flavor model is used.
+    """
+
+    def __init__(self, prices, flavor_model, candidates, target, color, prediction_cache=None):
+        self.prices = prices
+        self.scaled_prices = scale_prices(prices)
+        self.flavor_model = flavor_model
+        self.candidates = candidates
+        self.target = target
+        self.color = color
+        self.prediction_cache = prediction_cache
+
+    def matches(self, prices, flavor_model, candidates, target, color):
+        """Returns True if the context was created from the input prices, flavor model, candidates, target and color."""
+        return (flavor_model is self.flavor_model and color == self.color
+                and all(np.array_equal(np.asarray(value), np.asarray(context_value)) for value, context_value
+                        in [(prices, self.prices), (candidates, self.candidates), (target, self.target)]))
+
+    def taste_diff_batch(self, blends):
+        """Returns the absolute differences between the predicted flavors of the blends and the target."""
+        if self.prediction_cache is not None:
+            if len(blends) == 0:
+                return np.empty((0, len(self.target)))
+            return np.abs(self.target - self.prediction_cache.predict(blends, self.color))
+        return taste_diff_batch(blends, self.flavor_model, self.candidates, self.target, self.color)
+
+
+class PredictionCache:
+    """
+    A bounded LRU cache of flavor model predictions for a flavor model and the flavors of the available components.
+    Predictions are keyed by the components of a blend in the order they appear in the blend, with their exact
+    proportions, together with the roast color. The flavor model has a fixed slot for each component, so the same
+    components in another order are a different blend, and a prediction from the cache is always the prediction
+    the flavor model gives for the blend itself.
+    """
+
+    def __init__(self, flavor_model, candidates, maxsize=100000):
+        self.flavor_model = flavor_model
+        self.candidates = candidates
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._predictions = OrderedDict()
+
+    def __len__(self):
+        return len(self._predictions)
+
+    @staticmethod
+    def blend_key(blend) -> tuple:
+        """Returns the components of a blend in the order they appear as (index, proportion) tuples, without placeholders."""
+        return tuple((int(c), float(p)) for c, p in blend if c != -1)
+
+    def predict(self, blends, color) -> np.ndarray:
+        """
+        Returns the predicted flavors of a number of blends with one row per blend.
+        All blends missing in the cache are predicted with a single call to the flavor model.
+        """
+        keys = [(self.blend_key(blend), float(color)) for blend in blends]
+        missing_keys = [key for key in dict.fromkeys(keys) if key not in self._predictions]
+        if missing_keys:
+            indices = np.full((len(missing_keys), 7), -1, dtype=np.int64)
+            proportions = np.zeros((len(missing_keys), 7))
+            for row, (components, _) in enumerate(missing_keys):
+                indices[row, :len(components)] = [c for c, _ in components]
+                proportions[row, :len(components)] = [p for _, p in components]
+            predictions = self.flavor_model.predict(encode_blends_model_input(indices, proportions
+                                                                              ,np.asarray(self.candidates), color))
+            for key, prediction in zip(missing_keys, predictions):
+                self._predictions[key] = prediction
+
+        predicted_flavors = []
+        for key in keys:
+            self._predictions.move_to_end(key)
+            predicted_flavors.append(self._predictions[key])
+        self.misses += len(missing_keys)
+        self.hits += len(keys) - len(missing_keys)
+        # Remove the least recently used predictions when the cache is full
+        while len(self._predictions) > self.maxsize:
+            self._predictions.popitem(last=False)
+
+        return np.array(predicted_flavors)
+
+    @property
+    def hit_rate(self) -> float:
+        """The share of the blends looked up in the cache that were found in the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def statistics(self) -> str:
+        """Returns a text with the hit-rate statistics of the cache."""
+        return f"Prediction cache: {self.hits} hits, {self.misses} misses, hit rate {self.hit_rate:.1%}, {len(self)} cached blends."
+
+
+class BlendArrays:
+    """
+    A compact store for any number of blends of 7 components.
+    indices is an int16 array of shape (n, 7) with the index of each component, using -1 as placeholder for NULL
+    components, and proportions is a float32 array of shape (n, 7) with the proportion of each component.
+    Indexing with an integer returns the blend as a list of (index, proportion) tuples, indexing with a slice,
+    mask or list of integers returns a new BlendArrays with the selected blends.
+    """
+
+    def __init__(self, indices, proportions):
+        self.indices = np.asarray(indices, dtype=np.int16).reshape(-1, 7)
+        self.proportions = np.asarray(proportions, dtype=np.float32).reshape(-1, 7)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return arrays_to_blends(self.indices[key:key + 1 or None], self.proportions[key:key + 1 or None])[0]
+        return BlendArrays(self.indices[key], self.proportions[key])
+
+    def __iter__(self):
+        return iter(self.to_blends())
+
+    def to_blends(self) -> list:
+        """Returns the blends as a list of lists of (index, proportion) tuples."""
+        return arrays_to_blends(self.indices, self.proportions)
+
+    def packed_arrays(self):
+        """
+        Returns the component indices and proportions with the placeholder values moved to the end of each blend,
+        keeping the order of the actual components. Proportions are returned as float64 rounded to 2 decimals, which
+        is the precision used for all blends, to remove the float32 rounding errors.
+        """
+        order = np.argsort(self.indices == -1, axis=1, kind="stable")
+        indices = np.take_along_axis(self.indices, order, axis=1).astype(np.int64)
+        proportions = np.round(np.take_along_axis(self.proportions, order, axis=1).astype(np.float64), 2)
+        return indices, proportions
+
+
+def blends_to_arrays(blends) -> BlendArrays:
+    """
+    Converts a list of blends with 7 (index, proportion) tuples each into a BlendArrays.
+    A BlendArrays is returned unchanged.
+    """
+    if isinstance(blends, BlendArrays):
+        return blends
+    indices = np.array([[component[0] for component in blend] for blend in blends], dtype=np.int16)
+    proportions = np.array([[component[1] for component in blend] for blend in blends], dtype=np.float32)
+    return BlendArrays(indices, proportions)
+
+
+def arrays_to_blends(indices, proportions) -> list:
+    """
+    Converts arrays of component indices and proportions into a list of blends with (index, proportion) tuples.
+    Proportions are rounded to 2 decimals and placeholder components get the proportion 0.
+    """
+    indices = np.asarray(indices).tolist()
+    proportions = np.round(np.asarray(proportions, dtype=np.float64), 2).tolist()
+    return [[(c, p if c != -1 else 0) for c, p in zip(blend_indices, blend_proportions)]
+            for blend_indices, blend_proportions in zip(indices, proportions)]
+
+
+def concatenate_blend_arrays(blend_arrays: list) -> BlendArrays:
+    """Concatenates a list of BlendArrays into a single BlendArrays."""
+    if not blend_arrays:
+        return BlendArrays(np.empty((0, 7)), np.empty((0, 7)))
+    return BlendArrays(np.concatenate([blends.indices for blends in blend_arrays])
+                       ,np.concatenate([blends.proportions for blends in blend_arrays]))
+
+
+def encode_model_input(component_flavors, proportions, color, out=None):
+    """
+    Writes the model input for a single blend into a preallocated array, which is created if out is None.
+    The layout of the input is the flavors and proportion of each component in the order they appear in the blend,
+    zero padding up to 7 components and finally the roast color: [flavors_1, p_1, ..., flavors_7, p_7, color].
+    This is the only place the layout is defined, it is used for predictions as well as for the training data.
+    component_flavors is an array of shape (k, D) with the flavors of the k components, proportions has length k.
+    """
+    component_flavors = np.asarray(component_flavors)
+    D = component_flavors.shape[1]
+    if out is None:
+        out = np.empty(7 * (D + 1) + 1)
+    components = out[:-1].reshape(7, D + 1)
+    num_components = len(proportions)
+    components[:num_components, :D] = component_flavors
+    components[:num_components, D] = proportions
+    components[num_components:, :] = 0
+    out[-1] = color
+
+    return out
+
+
+def encode_blends_model_input(indices, proportions, candidates, color, out=None):
+    """
+    Writes the model input for a number of blends into a preallocated matrix with one row per blend, which is
+    created if out is None. Each row has the layout described in encode_model_input.
+    indices and proportions are arrays of shape (n, 7), where the placeholder values -1 must be placed after the
+    actual components of each blend. color is either a single roast color or one per blend.
+    """
+    D = len(candidates[0, :])
+    if out is None:
+        out = np.empty((len(indices), 7 * (D + 1) + 1))
+    components = out[:, :-1].reshape(len(indices), 7, D + 1)
+    valid = indices != -1
+    components[:, :, :D] = candidates[np.where(valid, indices, 0)]
+    components[:, :, D] = proportions
+    components[~valid] = 0
+    out[:, -1] = color
+
+    return out
+
+
+def blends_model_input(blends, candidates, color, out=None):
+    """
+    Creates the model input for a number of blends as a single matrix with one row per blend.
+    Each row is identical to the input taste_diff creates for the same blend, so all blends can be predicted
+    with a single call to the flavor model. Blends can be given as a BlendArrays or a list of blends.
+    """
+    indices, proportions = blends_to_arrays(blends).packed_arrays()
+
+    return encode_blends_model_input(indices, proportions, candidates, color, out)
+
+
+def taste_diff_batch(blends, flavor_model, candidates, target, color):
+    """
+    Calculates the absolute difference between the calculated taste profiles of a number of blends and the target values.
+    Returns an array with one row per blend, using one prediction for all the blends.
+    """
+    if len(blends) == 0:
+        return np.empty((0, len(target)))
+    model_output = flavor_model.predict(blends_model_input(blends, candidates, color))
+
+    return np.abs(target - model_output)
+
+
+def blend_cost_batch(blends, prices):
+    """
+    Calculates the cost of each of a number of blends using the prices as input.
+    """
+    prices = np.asarray(prices, dtype=float).reshape(-1)
+    indices, proportions = blends_to_arrays(blends).packed_arrays()
+    costs = np.where(indices != -1, prices[indices] * proportions, 0)
+
+    return costs.sum(axis=1)
+
+
+def blend_fitness_batch(blends, context, diffs=None):
+    """
+    Returns the fitness of each of a number of blends, calculated the same way as blend_fitness, using the
+    flavor model, scaled prices and target of the input FitnessContext.
+    If the flavor differences of the blends have already been predicted with taste_diff_batch they can be passed
+    as diffs to prevent the flavor model from being called again.
+    """
+    if diffs is None:
+        diffs = context.taste_diff_batch(blends)
+    cost = blend_cost_batch(blends, context.scaled_prices)
+    flavor_bound = 1 / (2 ** np.mean(diffs ** 3, axis=1))
+
+    return flavor_bound - (cost * 0.005)
+
+
+def blends_too_similar_batch(blend, blends) -> np.ndarray:
+    """
+    Compares a single blend, given as a list of (index, proportion) tuples, with a number of blends, using the same
+    rules as blends_too_similar.
+    Returns a bool array with one value per blend in blends | True if the blends are too equal
+    """
+    blends = blends_to_arrays(blends)
+    blend_indices = blends_to_arrays([blend]).indices
+    # Blends must contain the exact same components to be too similar, only these need their proportions compared
+    same_components = (np.sort(blends.indices, axis=1) == np.sort(blend_indices, axis=1)).all(axis=1)
+    too_similar = np.zeros(len(blends), dtype=bool)
+    for i in np.flatnonzero(same_components):
+        too_similar[i] = blends_too_similar(blend, blends[i])
+
+    return too_similar
+
+
 def blends_too_similar(blend1, blend2) -> bool:
     """
     Compares two proposed blends of coffees. If they do not contain exactly the same components,
@@ -329,7 +837,7 @@ def blends_too_similar(blend1, blend2) -> bool:
 
 
 
-def taste_pred(blend, flavor_model, component_flavors, color):
+def taste_pred(blend, flavor_model, component_flavors, color, prediction_cache=None):
     """
     Predict a flavor profile of a given input blend.
     Parameters
@@ -338,26 +846,23 @@ def taste_pred(blend, flavor_model, component_flavors, color):
     flavor_model : The full name and path of the trained model used to predict flavor profile.
     component_flavors : A full list of flavors for all components available, not just those included in the blend.
     color : The target color of the blend.
+    prediction_cache : A PredictionCache for the flavor model and component flavors, which is used instead of
+        the flavor model if given.
     Returns
     -------
     A list with the predicted flavor profile of the input blend.
     """
     
-    D = len(component_flavors[0, :])
+    if prediction_cache is not None:
+        return np.round(prediction_cache.predict([blend], color) ,1)[0]
+
     size = len(blend)
     components = [blend[i][0] for i in range(size) if blend[i][0] != -1]
     proportions = [blend[i][1] for i in range(size) if blend[i][0] != -1]
-    num_components = len(components)
-
-    model_input = np.array([])
-    for c, p in zip(components, proportions):
-        model_input = np.concatenate((model_input, component_flavors[c, :]))
-        model_input = np.concatenate((model_input, [p]))
 
-    model_input = np.concatenate((model_input, [0] * ((D + 1) * (size - num_components))))
-    model_input = np.concatenate((model_input, [color]))
+    model_input = encode_model_input(component_flavors[components, :], proportions, color)
 
-    predicted_flavors = np.round(flavor_model.predict(np.array(model_input).reshape(1, -1)) ,1)
+    predicted_flavors = np.round(flavor_model.predict(model_input.reshape(1, -1)) ,1)
 
     return predicted_flavors[0]
 
@@ -9,13 +9,15 @@ from sklearn.metrics import mean_absolute_error, mean_squared_error
 import joblib
 import time
 import ti_data_preprocessing as tdp
+import ti_flavor_surrogate as tfs
+import ti_flavor_inference as tfi
 import bki_functions as bf
 
 
 # Grab Currrent Time Before Running the Code for logging of total execution time
 start_time = time.time()
 # Write into log that script has started
-bf.log_insert("ti_train_model_no_robusta.py", "Training of model has started.")
+bf.log_insert("ti_train_model_no_robusta.py", "Training of model has started.", flush=True)
 
 
 def row_swapper(x):
@@ -28,7 +30,13 @@ model_name = "flavor_predictor_no_robusta.sav"
 
 
 
-X,Y = tdp.get_blend_grade_data(robusta=False)
+# Only process products graded since the last run, the earlier samples are read from the locally stored dataset
+incremental_data = False
+
+if incremental_data:
+    X,Y = tdp.get_blend_grade_data_incremental(robusta=False)
+else:
+    X,Y = tdp.get_blend_grade_data(robusta=False)
 
 X_train, X_test, y_train, y_test = train_test_split(X, Y, test_size=0.2)
 perm = np.random.permutation(len(X_train)) # Shuffle data, bare for god ordens skyld..
@@ -48,6 +56,8 @@ y_train_ext = y_augmented[perm, :]
 regr = MLPRegressor(hidden_layer_sizes=(300, 200, 100, 100), alpha=0.01, activation="tanh", max_iter=2000).fit(X_train_ext, y_train_ext)
 # Save trained model
 joblib.dump(regr, model_name)
+# Export the weights for the lightweight FlavorPredictor used when predicting blends
+flavor_predictor = tfi.export_flavor_model(regr, model_name)
 
 
 # Evaluate model
@@ -56,6 +66,25 @@ y_hat = regr.predict(X_test[0:n,:])
 print("NN: \t\tMSE: {0}, \n\t\tMAE: {1}"\
       .format(mean_squared_error(y_test, y_hat, multioutput="raw_values"),
               mean_absolute_error(y_test, y_hat, multioutput="raw_values")))
+# The exported FlavorPredictor must give the same predictions as the model within the tolerance
+inference_difference = np.abs(flavor_predictor.predict(X_test) - y_hat).max()
+print(f"FlavorPredictor max difference to model: {inference_difference}")
+if inference_difference > tfi.tolerance:
+    bf.log_insert("ti_train_model_no_robusta.py", f"FlavorPredictor differs {inference_difference} from the model, more than the tolerance {tfi.tolerance}.")
+
+
+# Fit a linear surrogate of the model, used to discard blends before they are predicted by the model.
+# The margin is calibrated on part of the training data held out from the fit, so it is not optimistic.
+X_fit, X_calibration = train_test_split(X_train, test_size=0.2)
+surrogate = tfs.FlavorSurrogate().fit(X_fit, regr.predict(X_fit)).set_flavor_model(model_name)
+surrogate.calibrate(X_calibration, regr.predict(X_calibration))
+joblib.dump(surrogate, tfs.surrogate_file_name(model_name))
+if surrogate.margin >= 0.5:
+    bf.log_insert("ti_train_model_no_robusta.py", f"Flavor surrogate margin {surrogate.margin:.3f} is not below the cut-off 0.5, the surrogate is not used.")
+# Report how often the surrogate discards blends the model accepts, on the test set which was not used for fitting
+surrogate_statistics = surrogate.statistics(X_test, y_hat, y_test, cut_off_value=0.5)
+print(surrogate_statistics)
+bf.log_insert("ti_train_model_no_robusta.py", surrogate_statistics)
     
 
 # Grab Currrent Time After Running the Code for logging of total execution time
@@ -63,8 +92,8 @@ end_time = time.time()
 total_time = end_time - start_time
 #Subtract Start Time from The End Time
 total_time_seconds = int(total_time) % 60
-total_time_minutes = total_time // 60
-total_time_hours = total_time // 60
+total_time_minutes = total_time // 60 % 60
+total_time_hours = total_time // 3600
 execution_time = str("%d:%02d:%02d" % (total_time_hours, total_time_minutes, total_time_seconds))
 # Write into log that script has completed
 bf.log_insert("ti_train_model_no_robusta.py", f"Training of model has completed. Total time: {execution_time}")